@@ -0,0 +1,355 @@
+""" Script to measure the cost of a training step for each backbone x aggregator combination,
+before launching a full training. Each combination runs in a fresh process on synthetic
+GSVCities-shaped batches (places x img_per_place images), and we time the forward pass,
+the miner + loss and the backward pass separately.
+
+Example:
+    python benchmark.py --places 8 --img_per_place 4 --steps 5 --out ./LOGS/benchmark.json
+    python benchmark.py --backbones resnet50 --aggregators MixVPR --precision fp32 bf16
+    python benchmark.py --backbones resnet50 --aggregators MixVPR --checkpoint_layers 3 --checkpoint_mixers
+
+With --ckpt, the script instead runs the validation of a trained model once per precision,
+to compare the recalls and the validation time of bf16 against fp32:
+    python benchmark.py --ckpt ./LOGS/resnet50_MixVPR.ckpt --precision fp32 bf16 --val_set_names pitts30k_val
+
+With --xbm_sizes, the same model is trained on GSVCities for a few batches with each cross-batch memory
+size (0 is without XBM) and then validated, to compare the recalls against the training time per step:
+    python benchmark.py --backbones resnet50 --aggregators MixVPR --xbm_sizes 0 1024 4096 --train_batches 500
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from prettytable import PrettyTable
+
+
+BACKBONES = [
+    'resnet18',
+    'resnet50',
+    'resnet101',
+    'resnext50_32x4d',
+    'efficientnet_b0',
+    'efficientnet_b1',
+    'efficientnet_b2',
+    'swinv2_base_window12to16_192to256_22kft1k',
+]
+
+# the aggregators handled by helper.get_aggregator
+AGGREGATORS = ['CosPlace', 'GeM', 'ConvAP', 'MixVPR']
+
+# the names used by this script and their Lightning Trainer precision
+PRECISIONS = {'fp32': 32, 'bf16': 'bf16'}
+
+
+def get_image_size(backbone_arch):
+    # swinv2 is pretrained on 256x256 images, the rest of the backbones are trained on 320x320
+    return (256, 256) if 'swin' in backbone_arch.lower() else (320, 320)
+
+
+def get_agg_config(agg_arch, in_channels, in_h, in_w, checkpoint_mixers=False):
+    """Aggregator config matching the backbone feature maps, with the output sizes used in main.py"""
+    if 'cosplace' in agg_arch.lower():
+        return {'in_dim': in_channels, 'out_dim': 2048}
+    elif 'gem' in agg_arch.lower():
+        return {'p': 3}
+    elif 'convap' in agg_arch.lower():
+        return {'in_channels': in_channels, 'out_channels': 2048}
+    elif 'mixvpr' in agg_arch.lower():
+        return {'in_channels': in_channels,
+                'in_h': in_h,
+                'in_w': in_w,
+                'out_channels': 1024,
+                'mix_depth': 4,
+                'mlp_ratio': 1,
+                'out_rows': 4,
+                'checkpointing': checkpoint_mixers}
+    raise NotImplementedError(f'No benchmark config for aggregator {agg_arch}')
+
+
+def run_combination(backbone_arch, agg_arch, precision, config):
+    """Builds VPRModel and times its training steps, runs in its own process so that
+    the peak RSS only accounts for this combination.
+    """
+    from main import VPRModel
+    from models import helper
+
+    if config['threads']:
+        torch.set_num_threads(config['threads'])
+    torch.manual_seed(0)
+    h, w = get_image_size(backbone_arch)
+    layers_to_crop = [4] if 'resn' in backbone_arch.lower() else []
+    checkpoint_layers = config['checkpoint_layers'] if 'resn' in backbone_arch.lower() else []
+
+    # probe the shape of the feature maps to configure the aggregator
+    with torch.no_grad():
+        backbone = helper.get_backbone(backbone_arch, False, config['layers_to_freeze'], layers_to_crop)
+        _, c, fh, fw = backbone.eval()(torch.zeros(1, 3, h, w)).shape
+        del backbone
+
+    model = VPRModel(backbone_arch=backbone_arch,
+                     pretrained=config['pretrained'],
+                     layers_to_freeze=config['layers_to_freeze'],
+                     layers_to_crop=layers_to_crop,
+                     checkpoint_layers=checkpoint_layers,
+                     agg_arch=agg_arch,
+                     agg_config=get_agg_config(agg_arch, c, fh, fw, config['checkpoint_mixers']),
+                     loss_name=config['loss_name'],
+                     miner_name=config['miner_name'])
+    model.train()
+
+    # a GSVCities batch: BS places x N images, all images of a place share its label
+    BS, N = config['places'], config['img_per_place']
+    images = torch.randn(BS * N, 3, h, w)
+    labels = torch.arange(BS).repeat_interleave(N)
+    # the memory used by the steps (activations, gradients) is what grows with the batch size
+    # ru_maxrss is in KB on Linux
+    rss_before_steps = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    timings = {'forward': [], 'loss': [], 'backward': []}
+    for step in range(config['warmup'] + config['steps']):
+        t0 = time.perf_counter()
+        with torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=precision == 'bf16'):
+            descriptors = model(images)
+        t1 = time.perf_counter()
+        # as in VPRModel.loss_function, mining and the loss run in float32
+        descriptors = descriptors.float()
+        if model.miner is not None:
+            loss = model.loss_fn(descriptors, labels, model.miner(descriptors, labels))
+        else:
+            loss = model.loss_fn(descriptors, labels)
+            loss = loss[0] if type(loss) == tuple else loss
+        t2 = time.perf_counter()
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+        t3 = time.perf_counter()
+        if step >= config['warmup']:
+            timings['forward'].append(t1 - t0)
+            timings['loss'].append(t2 - t1)
+            timings['backward'].append(t3 - t2)
+
+    step_time = sum(np.median(v) for v in timings.values())
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {
+        'backbone': backbone_arch,
+        'aggregator': agg_arch,
+        'precision': precision,
+        'checkpoint_layers': checkpoint_layers,
+        'checkpoint_mixers': config['checkpoint_mixers'] and 'mixvpr' in agg_arch.lower(),
+        'image_size': [h, w],
+        'descriptor_dim': int(descriptors.shape[1]),
+        'params_total': sum(p.numel() for p in model.parameters()),
+        'params_trainable': sum(p.numel() for p in model.parameters() if p.requires_grad),
+        'forward_ms': 1e3 * float(np.median(timings['forward'])),
+        'loss_ms': 1e3 * float(np.median(timings['loss'])),
+        'backward_ms': 1e3 * float(np.median(timings['backward'])),
+        'images_per_sec': BS * N / step_time,
+        'peak_rss_mb': peak_rss,
+        # approximate, the high-water mark before the steps also counts the model and the batch
+        'step_mb_per_image': (peak_rss - rss_before_steps) / (BS * N),
+    }
+
+
+def print_results(results):
+    table = PrettyTable()
+    table.field_names = ['Backbone', 'Aggregator', 'Precision', 'Dim', 'Params (M)', 'Trainable (M)',
+                         'Fwd (ms)', 'Loss (ms)', 'Bwd (ms)', 'img/s', 'Peak RSS (MB)', 'Step MB/img']
+    for r in results:
+        if 'error' in r:
+            table.add_row([r['backbone'], r['aggregator'], r['precision']] + ['-'] * 8 + [r['error'][:30]])
+            continue
+        table.add_row([r['backbone'], r['aggregator'], r['precision'], r['descriptor_dim'],
+                       f"{r['params_total']/1e6:.2f}", f"{r['params_trainable']/1e6:.2f}",
+                       f"{r['forward_ms']:.0f}", f"{r['loss_ms']:.0f}", f"{r['backward_ms']:.0f}",
+                       f"{r['images_per_sec']:.2f}", f"{r['peak_rss_mb']:.0f}", f"{r['step_mb_per_image']:.1f}"])
+    print(table.get_string(title='Training step cost per backbone x aggregator'))
+
+
+def compare_precisions(args):
+    """Runs the validation of a trained checkpoint once per precision (CPU),
+    and returns the recalls and validation time of each run.
+    """
+    import pytorch_lightning as pl
+    from main import VPRModel
+    from dataloaders.GSVCitiesDataloader import GSVCitiesDataModule
+
+    results = []
+    for precision in args.precision:
+        # the backbone weights come from the checkpoint, no need to download the pretrained ones
+        model = VPRModel.load_from_checkpoint(args.ckpt, pretrained=False)
+        datamodule = GSVCitiesDataModule(batch_size=args.places * args.img_per_place,
+                                         image_size=get_image_size(model.encoder_arch),
+                                         num_workers=args.num_workers,
+                                         show_data_stats=False,
+                                         val_set_names=args.val_set_names)
+        trainer = pl.Trainer(accelerator='cpu', devices=1, precision=PRECISIONS[precision],
+                             logger=False, enable_checkpointing=False)
+        metrics = {}
+        # with several validation sets, Lightning returns one dict per dataloader
+        for d in trainer.validate(model=model, datamodule=datamodule, verbose=False):
+            metrics.update(d)
+        results.append({'precision': precision, **{k: float(v) for k, v in metrics.items()}})
+    return results
+
+
+def compare_xbm(args):
+    """Trains the same model (same seed) for train_batches batches with each XBM size, then validates it.
+
+    Returns:
+        list: for each XBM size, the recalls, the training time per step and the memory held by the XBM.
+    """
+    import pytorch_lightning as pl
+    from pytorch_lightning.callbacks import Callback
+    from main import VPRModel
+    from models import helper
+    from dataloaders.GSVCitiesDataloader import GSVCitiesDataModule
+
+    class StepTimer(Callback):
+        """Sums the time of the training steps (forward, loss, backward and optimizer step, without data loading)"""
+        def __init__(self):
+            self.step_time = 0.
+            self.num_steps = 0
+
+        def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+            self.start = time.perf_counter()
+
+        def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            self.step_time += time.perf_counter() - self.start
+            self.num_steps += 1
+
+    backbone_arch, agg_arch = args.backbones[0], args.aggregators[0]
+    h, w = get_image_size(backbone_arch)
+    layers_to_crop = [4] if 'resn' in backbone_arch.lower() else []
+    with torch.no_grad():
+        backbone = helper.get_backbone(backbone_arch, False, args.layers_to_freeze, layers_to_crop)
+        _, c, fh, fw = backbone.eval()(torch.zeros(1, 3, h, w)).shape
+        del backbone
+
+    results = []
+    for xbm_size in args.xbm_sizes:
+        pl.seed_everything(0, workers=True)
+        model = VPRModel(backbone_arch=backbone_arch,
+                         pretrained=not args.no_pretrained,
+                         layers_to_freeze=args.layers_to_freeze,
+                         layers_to_crop=layers_to_crop,
+                         agg_arch=agg_arch,
+                         agg_config=get_agg_config(agg_arch, c, fh, fw),
+                         loss_name=args.loss_name,
+                         miner_name=args.miner_name,
+                         xbm_size=xbm_size,
+                         xbm_start_step=0)
+        datamodule = GSVCitiesDataModule(batch_size=args.places,
+                                         img_per_place=args.img_per_place,
+                                         image_size=(h, w),
+                                         num_workers=args.num_workers,
+                                         show_data_stats=False,
+                                         val_set_names=args.val_set_names)
+        step_timer = StepTimer()
+        trainer = pl.Trainer(accelerator='auto', devices=1, max_epochs=1, limit_train_batches=args.train_batches,
+                             num_sanity_val_steps=0, logger=False, enable_checkpointing=False,
+                             callbacks=[step_timer])
+        trainer.fit(model=model, datamodule=datamodule)
+        metrics = {}
+        for d in trainer.validate(model=model, datamodule=datamodule, verbose=False):
+            metrics.update(d)
+        xbm_mb = 0. if model.xbm is None or model.xbm.feats is None else \
+            (model.xbm.feats.nbytes + model.xbm.labels.nbytes) / 2**20
+        results.append({'xbm_size': xbm_size,
+                        'step_ms': 1e3 * step_timer.step_time / max(step_timer.num_steps, 1),
+                        'xbm_mb': xbm_mb,
+                        **{k: float(v) for k, v in metrics.items()}})
+    return results
+
+
+def print_xbm_results(results, val_set_names):
+    table = PrettyTable()
+    table.field_names = ['XBM size'] + [f'{name} R@{k}' for name in val_set_names for k in (1, 5)] \
+        + ['Step (ms)', 'R@1 gain / extra ms', 'XBM (MB)']
+    base = results[0]
+    for r in results:
+        extra_ms = r['step_ms'] - base['step_ms']
+        gain = 100 * (r[f'{val_set_names[0]}/R1'] - base[f'{val_set_names[0]}/R1'])
+        table.add_row([r['xbm_size']] + [f"{100*r[f'{name}/R{k}']:.2f}" for name in val_set_names for k in (1, 5)]
+                      + [f"{r['step_ms']:.1f}", f'{gain / extra_ms:.3f}' if extra_ms > 0 else '-', f"{r['xbm_mb']:.1f}"])
+    print(table.get_string(title=f'Recall versus compute of the cross-batch memory (vs. XBM size {base["xbm_size"]})'))
+
+
+def print_precision_results(results, val_set_names):
+    table = PrettyTable()
+    table.field_names = ['Precision'] + [f'{name} R@{k}' for name in val_set_names for k in (1, 5, 10)] + ['Val time (s)']
+    for r in results:
+        table.add_row([r['precision']] + [f"{100*r[f'{name}/R{k}']:.2f}" for name in val_set_names for k in (1, 5, 10)]
+                      + [f"{r['val_time']:.1f}"])
+    print(table.get_string(title='Validation per precision'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark VPRModel training steps on synthetic batches (CPU)')
+    parser.add_argument('--backbones', nargs='+', default=BACKBONES)
+    parser.add_argument('--aggregators', nargs='+', default=AGGREGATORS)
+    parser.add_argument('--places', type=int, default=8, help='number of places per batch')
+    parser.add_argument('--img_per_place', type=int, default=4)
+    parser.add_argument('--steps', type=int, default=5, help='number of timed steps')
+    parser.add_argument('--warmup', type=int, default=1, help='number of untimed steps')
+    parser.add_argument('--layers_to_freeze', type=int, default=2)
+    parser.add_argument('--no_pretrained', action='store_true',
+                        help='random weights (no download), note that the backbones only freeze layers of pretrained models')
+    parser.add_argument('--loss_name', type=str, default='MultiSimilarityLoss')
+    parser.add_argument('--miner_name', type=str, default='MultiSimilarityMiner')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads (0 keeps the default)')
+    parser.add_argument('--precision', nargs='+', default=['fp32'], choices=list(PRECISIONS),
+                        help='bf16 runs the forward pass under bfloat16 autocast')
+    parser.add_argument('--checkpoint_layers', type=int, nargs='*', default=[],
+                        help='resnet layers to run with activation checkpointing (ex. 3)')
+    parser.add_argument('--checkpoint_mixers', action='store_true',
+                        help='activation checkpointing of the MixVPR mixer blocks')
+    parser.add_argument('--ckpt', type=str, default=None,
+                        help='compare the validation recalls of this checkpoint for each precision instead')
+    parser.add_argument('--val_set_names', nargs='+', default=['pitts30k_val'])
+    parser.add_argument('--num_workers', type=int, default=8, help='dataloader workers (with --ckpt or --xbm_sizes)')
+    parser.add_argument('--xbm_sizes', type=int, nargs='+', default=None,
+                        help='compare the recalls and the step time of these cross-batch memory sizes instead (0 disables XBM)')
+    parser.add_argument('--train_batches', type=int, default=500, help='training batches per XBM size (with --xbm_sizes)')
+    parser.add_argument('--out', type=str, default='./LOGS/benchmark.json')
+    args = parser.parse_args()
+
+    config = vars(args).copy()
+    config['pretrained'] = not args.no_pretrained
+
+    if args.xbm_sizes is not None:
+        results = compare_xbm(args)
+        print_xbm_results(results, args.val_set_names)
+    elif args.ckpt is not None:
+        results = compare_precisions(args)
+        print_precision_results(results, args.val_set_names)
+    else:
+        results = []
+        for backbone_arch in args.backbones:
+            for agg_arch in args.aggregators:
+                for precision in args.precision:
+                    print(f'Benchmarking {backbone_arch} + {agg_arch} ({precision})')
+                    # one fresh process per combination, so that peak RSS is not polluted by the previous ones
+                    with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as executor:
+                        try:
+                            results.append(executor.submit(run_combination, backbone_arch, agg_arch,
+                                                           precision, config).result())
+                        except Exception as e:
+                            results.append({'backbone': backbone_arch, 'aggregator': agg_arch,
+                                            'precision': precision, 'error': repr(e)})
+        print_results(results)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, 'w') as f:
+        json.dump({'config': config, 'results': results}, f, indent=2)
+    print(f'Results written to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,6 @@ import os
 from typing import Tuple
 
 import torch
-from PIL import Image
 from torch.utils import data
 import numpy as np
 import torchvision.transforms as tvf
@@ -15,6 +14,9 @@ import cv2
 import matplotlib.pyplot as plt
 
 from main import VPRModel
+from dataloaders import ImageLoader
+from loop_candidates import find_loop_candidates
+from keyframe_database import build_keyframe_database
 
 
 class BaseDataset(data.Dataset):
@@ -40,13 +42,16 @@ class BaseDataset(data.Dataset):
 
 
 class InferencePipeline:
-    def __init__(self, model, dataset, feature_dim, batch_size=4, num_workers=4, device='cuda'):
+    def __init__(self, model, dataset, feature_dim, batch_size=4, num_workers=4, device='cuda', precision='fp32'):
         self.model = model
         self.dataset = dataset
         self.feature_dim = feature_dim
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.device = device
+        # 'bf16' runs the model under bfloat16 autocast (CPU or GPU), 'fp16' under float16 autocast (GPU)
+        assert precision in ('fp32', 'bf16', 'fp16'), f'Unsupported precision {precision}'
+        self.precision = precision
 
         self.dataloader = data.DataLoader(self.dataset,
                                           batch_size=self.batch_size,
@@ -62,7 +67,9 @@ class InferencePipeline:
             return np.load(f'./LOGS/global_descriptors_{split}.npy')
 
         self.model.to(self.device)
-        with torch.no_grad():
+        autocast_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}.get(self.precision)
+        with torch.no_grad(), torch.autocast(device_type=torch.device(self.device).type,
+                                             dtype=autocast_dtype, enabled=autocast_dtype is not None):
             global_descriptors = np.zeros((len(self.dataset), self.feature_dim))
             for batch in tqdm(self.dataloader, ncols=100, desc=f'Extracting {split} features'):
                 imgs, indices = batch
@@ -70,7 +77,7 @@ class InferencePipeline:
 
                 # model inference
                 descriptors = self.model(imgs)
-                descriptors = descriptors.detach().cpu().numpy()
+                descriptors = descriptors.detach().float().cpu().numpy()
 
                 # add to global descriptors
                 global_descriptors[np.array(indices), :] = descriptors
@@ -81,7 +88,8 @@ class InferencePipeline:
 
 
 def load_image(path):
-    image_pil = Image.open(path).convert("RGB")
+    # JPEGs are decoded at the smallest DCT scale that is still above 320x320
+    image_pil = ImageLoader.load_image(path, decode_size=(320, 320))
 
     # add transforms
     transforms = tvf.Compose([
@@ -119,18 +127,16 @@ def load_model(ckpt_path):
 
 
 def simluarity_matrix(q_matrix: np.ndarray,
-                    db_matrix: np.ndarray) -> np.ndarray:
+                    db_matrix: np.ndarray,
+                    db_ids: np.ndarray = None) -> np.ndarray:
     # compute similarity matrix
     similarity_matrix = np.matmul(q_matrix, db_matrix.T)  # shape: (num_query, num_db)
 
-    #Set the images in the future to 0 similarity
-    num_rows, num_cols = similarity_matrix.shape
-    for i in range(num_rows):
-        for j in range(num_cols):
-            if j > i:  # above the diagonal line
-                similarity_matrix[i, j] = 0 #set to 1
-
-    return similarity_matrix
+    #Set the images in the future (above the diagonal) to 0 similarity
+    if db_ids is None:
+        return np.tril(similarity_matrix)
+    # the database only holds keyframes, column j is frame db_ids[j]
+    return np.where(db_ids[None, :] <= np.arange(len(q_matrix))[:, None], similarity_matrix, 0)
 
 def save_sim_matrix(similarity_matrix: np.ndarray, path: str):
     np.savetxt(path, similarity_matrix, fmt='%1.4f', delimiter='\t')
@@ -147,12 +153,14 @@ def get_loop_canditates_from_text(file_path: str,
 def get_loop_candidates(similarity_matrix: np.ndarray, 
                     query_index: int,
                     top_k: int,
-                    sim_threshold: int):
+                    sim_threshold: int,
+                    db_ids: np.ndarray = None):
     
-    top_k_matches = np.argsort(-similarity_matrix, axis=1)[:, :top_k]  # shape: (num_query_images, 10)
-    db_indices = top_k_matches[query_index]
-    scores = similarity_matrix[query_index, db_indices]
-    filtered_indices = db_indices[scores >= sim_threshold]
+    # only the query row is searched (top-k and threshold applied together),
+    # with a keyframe database the candidates are the frame ids db_ids of the columns
+    candidates = find_loop_candidates(similarity_matrix[query_index:query_index+1], top_k=top_k,
+                                      sim_threshold=sim_threshold, query_ids=[query_index], db_ids=db_ids)
+    filtered_indices, _ = candidates[0]
 
     return filtered_indices.tolist()
 
@@ -188,10 +196,15 @@ def main():
     # db_global_descriptors = database_pipeline.run(split='db')  # shape: (num_db, feature_dim)
     # query_global_descriptors = query_pipeline.run(split='query')  # shape: (num_query, feature_dim)
 
+    # # only the keyframes admitted by the database policy are searched (see keyframe_database.py),
+    # # ex. dict(novelty_threshold=0.9, max_size=2000, thin_by='temporal'), an empty policy keeps all the frames
+    # keyframe_policy = dict()
+    # db_ids, db_keyframes = build_keyframe_database(db_global_descriptors, **keyframe_policy).keyframes()
+
     # # calculate top-k matches
-    # simluarity_mat = simluarity_matrix(q_matrix=query_global_descriptors, db_matrix=db_global_descriptors)
+    # simluarity_mat = simluarity_matrix(q_matrix=query_global_descriptors, db_matrix=db_keyframes, db_ids=db_ids)
 
-    # filtered_indices = get_loop_candidates(simluarity_mat, query_index=1000, top_k=10, sim_threshold=0.8)
+    # filtered_indices = get_loop_candidates(simluarity_mat, query_index=1000, top_k=10, sim_threshold=0.8, db_ids=db_ids)
     # save_sim_matrix(simluarity_mat, 'similarity_matrix_08.txt')
     # new_indices = get_loop_canditates_from_text('/home/java/MixVPR/similarity_matrix_05.txt', query_index=100, top_k=10, sim_threshold=0.5)
     # print(new_indices)
@@ -5,9 +5,14 @@ from torchvision import transforms as T
 from dataloaders.GSVCitiesDataset import GSVCitiesDataset
 from . import PittsburgDataset
 from . import MapillaryDataset
+from .ValidationCache import CachedValidationDataset
+from .ValidationSubset import ValidationSubset
+from .StageTimer import StageTimer, TimedCollate
 
 from prettytable import PrettyTable
 
+from utils.validation import get_references_and_positives
+
 IMAGENET_MEAN_STD = {'mean': [0.485, 0.456, 0.406], 
                      'std': [0.229, 0.224, 0.225]}
 
@@ -54,7 +59,13 @@ class GSVCitiesDataModule(pl.LightningDataModule):
                  mean_std=IMAGENET_MEAN_STD,
                  batch_sampler=None,
                  random_sample_from_each_place=True,
-                 val_set_names=['pitts30k_val', 'msls_val']
+                 val_set_names=['pitts30k_val', 'msls_val'],
+                 val_cache_dir=None,
+                 val_cache_dtype='uint8',
+                 reduced_decode=True,
+                 profile_data=False,
+                 val_subset_queries=None,
+                 full_val_every_n_epochs=5,
                  ):
         super().__init__()
         self.batch_size = batch_size
@@ -70,6 +81,19 @@ class GSVCitiesDataModule(pl.LightningDataModule):
         self.std_dataset = mean_std['std']
         self.random_sample_from_each_place = random_sample_from_each_place
         self.val_set_names = val_set_names
+        self.val_cache_dir = val_cache_dir # if set, validation images are resized once and served from a memmap
+        self.val_cache_dtype = val_cache_dtype # 'uint8' (resized images) or 'float16' (normalized tensors)
+        # decode JPEGs directly at the smallest 1/2, 1/4 or 1/8 scale that is still larger than image_size
+        self.decode_size = image_size if reduced_decode else None
+        self.profile_data = profile_data # record per-stage loading times (see StageTimer and DataPipelineMonitor)
+        # if set, most epochs are validated on a fixed subset of this many queries per validation set,
+        # the full sets are used every full_val_every_n_epochs epochs and at the last epoch. The choice is
+        # made when the validation loaders are built, so the Trainer must rebuild them every epoch
+        # (reload_dataloaders_every_n_epochs=1, checked in setup)
+        self.val_subset_queries = val_subset_queries
+        self.full_val_every_n_epochs = full_val_every_n_epochs
+        # whether the current validation loaders are the full sets, decided once when they are built
+        self.val_full = True
         self.save_hyperparameters() # save hyperparameter with Pytorch Lightening
 
         self.train_transform = T.Compose([
@@ -98,45 +122,106 @@ class GSVCitiesDataModule(pl.LightningDataModule):
             'pin_memory': True,
             'shuffle': False}
 
+        self.train_timer = None
+        self.val_timer = None
+        if self.profile_data:
+            # the timers are shared by all the DataLoader workers (one histogram row per worker)
+            self.train_timer = StageTimer(StageTimer.stages_for(self.train_transform), self.train_loader_config['num_workers'])
+            self.val_timer = StageTimer(StageTimer.stages_for(self.valid_transform), self.valid_loader_config['num_workers'])
+            self.train_loader_config['collate_fn'] = TimedCollate(self.train_timer)
+            self.valid_loader_config['collate_fn'] = TimedCollate(self.val_timer)
+
+    def prepare_data(self):
+        # Lightning calls prepare_data on a single process per node (before setup on all the ranks),
+        # the validation caches (dbStruct, resized images) are built there, the other DDP ranks
+        # then only open them in setup instead of all writing the same files
+        self.load_val_datasets()
+
     def setup(self, stage):
+        if stage == 'fit' and self.val_subset_queries is not None and self.trainer is not None \
+                and self.trainer.reload_dataloaders_every_n_epochs != 1:
+            # otherwise the subset/full choice of the first epoch would be kept for the whole training
+            raise ValueError('val_subset_queries needs a Trainer with reload_dataloaders_every_n_epochs=1, '
+                             'the validation sets are chosen when the validation loaders are built')
+
         if stage == 'fit':
             # load train dataloader with reload routine
             self.reload()
 
+        if stage in ('fit', 'validate'):
             # load validation sets (pitts_val, msls_val, ...etc)
-            self.val_datasets = []
-            for valid_set_name in self.val_set_names:
-                if valid_set_name.lower() == 'pitts30k_test':
-                    self.val_datasets.append(PittsburgDataset.get_whole_test_set(
-                        input_transform=self.valid_transform))
-                elif valid_set_name.lower() == 'pitts30k_val':
-                    self.val_datasets.append(PittsburgDataset.get_whole_val_set(
-                        input_transform=self.valid_transform))
-                elif valid_set_name.lower() == 'msls_val':
-                    self.val_datasets.append(MapillaryDataset.MSLS(
-                        input_transform=self.valid_transform))
-                else:
-                    print(
-                        f'Validation set {valid_set_name} does not exist or has not been implemented yet')
-                    raise NotImplementedError
-            if self.show_data_stats:
+            self.val_datasets = self.load_val_datasets()
+
+            self.val_subsets = []
+            if self.val_subset_queries is not None:
+                for valid_set_name, val_dataset in zip(self.val_set_names, self.val_datasets):
+                    num_references, positives = get_references_and_positives(valid_set_name.lower(), val_dataset)
+                    self.val_subsets.append(ValidationSubset(
+                        val_dataset, num_references, positives, num_queries=self.val_subset_queries))
+            if self.show_data_stats and stage == 'fit':
                 self.print_stats()
 
+    def load_val_datasets(self):
+        val_datasets = []
+        for valid_set_name in self.val_set_names:
+            if valid_set_name.lower() == 'pitts30k_test':
+                val_datasets.append(PittsburgDataset.get_whole_test_set(
+                    input_transform=self.valid_transform, decode_size=self.decode_size))
+            elif valid_set_name.lower() == 'pitts30k_val':
+                val_datasets.append(PittsburgDataset.get_whole_val_set(
+                    input_transform=self.valid_transform, decode_size=self.decode_size))
+            elif valid_set_name.lower() == 'msls_val':
+                val_datasets.append(MapillaryDataset.MSLS(
+                    input_transform=self.valid_transform, decode_size=self.decode_size))
+            else:
+                print(
+                    f'Validation set {valid_set_name} does not exist or has not been implemented yet')
+                raise NotImplementedError
+
+            if self.val_cache_dir is None:
+                if self.val_timer is not None:
+                    val_datasets[-1].timer = self.val_timer
+            else:
+                val_datasets[-1] = CachedValidationDataset(
+                    val_datasets[-1],
+                    transform=self.valid_transform,
+                    cache_dir=self.val_cache_dir,
+                    name=valid_set_name.lower(),
+                    dtype=self.val_cache_dtype,
+                    num_workers=self.num_workers)
+        return val_datasets
+
     def reload(self):
         self.train_dataset = GSVCitiesDataset(
             cities=self.cities,
             img_per_place=self.img_per_place,
             min_img_per_place=self.min_img_per_place,
             random_sample_from_each_place=self.random_sample_from_each_place,
-            transform=self.train_transform)
+            transform=self.train_transform,
+            decode_size=self.decode_size,
+            timer=self.train_timer)
 
     def train_dataloader(self):
         self.reload()
         return DataLoader(dataset=self.train_dataset, **self.train_loader_config)
 
+    def is_full_validation(self):
+        """Whether the validation of the current epoch should run on the full validation sets or on their subsets"""
+        if self.val_subset_queries is None or self.trainer is None or self.trainer.state.fn != 'fit':
+            return True
+        epoch = self.trainer.current_epoch
+        return (epoch + 1) % self.full_val_every_n_epochs == 0 or epoch + 1 >= self.trainer.max_epochs
+
+    def current_val_datasets(self):
+        """The validation sets of the current loaders (the decision of the last val_dataloader call)"""
+        return self.val_datasets if self.val_full else self.val_subsets
+
     def val_dataloader(self):
+        # the full/subset decision is taken here and stored, the model reads val_full
+        # (and current_val_datasets) instead of evaluating it again later in the epoch
+        self.val_full = self.is_full_validation()
         val_dataloaders = []
-        for val_dataset in self.val_datasets:
+        for val_dataset in self.current_val_datasets():
             val_dataloaders.append(DataLoader(
                 dataset=val_dataset, **self.valid_loader_config))
         return val_dataloaders
@@ -2,11 +2,13 @@
 
 import pandas as pd
 from pathlib import Path
-from PIL import Image
 import torch
 from torch.utils.data import Dataset
 import torchvision.transforms as T
 
+from dataloaders.ImageLoader import load_image
+from dataloaders.StageTimer import NullTimer
+
 default_transform = T.Compose([
     T.ToTensor(),
     T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
@@ -27,7 +29,9 @@ class GSVCitiesDataset(Dataset):
                  min_img_per_place=4,
                  random_sample_from_each_place=True,
                  transform=default_transform,
-                 base_path=BASE_PATH
+                 base_path=BASE_PATH,
+                 decode_size=None,
+                 timer=None,
                  ):
         super(GSVCitiesDataset, self).__init__()
         self.base_path = base_path
@@ -39,6 +43,9 @@ class GSVCitiesDataset(Dataset):
         self.min_img_per_place = min_img_per_place
         self.random_sample_from_each_place = random_sample_from_each_place
         self.transform = transform
+        self.decode_size = decode_size # (h, w) JPEGs are decoded at the smallest DCT scale above it
+        # optional StageTimer recording the time spent in each loading stage
+        self.timer = NullTimer() if timer is None else timer
         
         # generate the dataframe contraining images metadata
         self.dataframe = self.__getdataframes()
@@ -104,10 +111,8 @@ class GSVCitiesDataset(Dataset):
             img_name = self.get_img_name(row)
             img_path = self.base_path + 'Images/' + \
                 row['city_id'] + '/' + img_name
-            img = self.image_loader(img_path)
-
-            if self.transform is not None:
-                img = self.transform(img)
+            img = self.timer.load(img_path, self.decode_size)
+            img = self.timer.apply(self.transform, img)
 
             imgs.append(img)
 
@@ -122,8 +127,8 @@ class GSVCitiesDataset(Dataset):
         return len(self.places_ids)
 
     @staticmethod
-    def image_loader(path):
-        return Image.open(path).convert('RGB')
+    def image_loader(path, decode_size=None):
+        return load_image(path, decode_size)
 
     @staticmethod
     def get_img_name(row):
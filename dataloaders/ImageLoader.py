@@ -0,0 +1,76 @@
+"""Shared image loading for the training, validation and inference datasets.
+
+JPEG images can be decoded directly at 1/2, 1/4 or 1/8 of their resolution (DCT scaling),
+which is much cheaper than decoding the full image and downscaling it afterwards.
+`load_image` picks the smallest DCT-scaled decode that is still at least as large as the
+target size, the resizing transform (ex. T.Resize) then finishes with its own interpolation.
+Non-JPEG images (ex. the KITTI png frames) are decoded as usual.
+
+Running this file benchmarks full vs reduced decoding on a folder of images:
+    python -m dataloaders.ImageLoader /path/to/images --image_size 320 320
+"""
+import argparse
+import glob
+import time
+
+import numpy as np
+from PIL import Image
+
+
+def load_image(path, decode_size=None):
+    """Opens an image as RGB
+
+    Args:
+        path (str or file): path to the image file, or a file object.
+        decode_size (tuple, optional): (height, width) the image will be resized to afterwards.
+                                       If given, JPEGs are decoded at the smallest scale (1, 1/2, 1/4 or 1/8)
+                                       that is at least as large. Defaults to None (full resolution).
+
+    Returns:
+        PIL.Image: the decoded image.
+    """
+    img = Image.open(path)
+    if decode_size is not None:
+        # draft() is a no-op for formats that don't support it, and never goes below the requested size
+        img.draft('RGB', (decode_size[1], decode_size[0]))
+    return img.convert('RGB')
+
+
+def benchmark(paths, image_size=(320, 320), interpolation=Image.BILINEAR):
+    """Measures decode+resize throughput with and without reduced decoding,
+    and the mean absolute difference (in [0, 255]) between the resized images.
+    """
+    results = {}
+    resized = {}
+    for name, decode_size in [('full', None), ('reduced', image_size)]:
+        start = time.perf_counter()
+        resized[name] = [np.asarray(load_image(p, decode_size).resize((image_size[1], image_size[0]), interpolation))
+                         for p in paths]
+        results[f'{name}_img_per_sec'] = len(paths) / (time.perf_counter() - start)
+
+    diffs = [np.abs(a.astype(np.float32) - b.astype(np.float32)).mean()
+             for a, b in zip(resized['full'], resized['reduced'])]
+    results['speedup'] = results['reduced_img_per_sec'] / results['full_img_per_sec']
+    results['mean_abs_diff'] = float(np.mean(diffs))
+    results['max_abs_diff'] = float(np.max(diffs))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark reduced-resolution JPEG decoding')
+    parser.add_argument('image_dir', type=str)
+    parser.add_argument('--image_size', type=int, nargs=2, default=[320, 320])
+    parser.add_argument('--max_images', type=int, default=500)
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(f'{args.image_dir}/**/*.jp*g', recursive=True))[:args.max_images]
+    assert len(paths) > 0, f'No JPEG images found in {args.image_dir}'
+    results = benchmark(paths, tuple(args.image_size))
+    print(f"{len(paths)} images from {args.image_dir}")
+    print(f"full decode    : {results['full_img_per_sec']:.1f} img/s")
+    print(f"reduced decode : {results['reduced_img_per_sec']:.1f} img/s (x{results['speedup']:.2f})")
+    print(f"mean |diff|    : {results['mean_abs_diff']:.3f} (max {results['max_abs_diff']:.3f}) on a 0-255 scale")
+
+
+if __name__ == '__main__':
+    main()
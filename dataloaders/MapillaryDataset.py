@@ -1,8 +1,9 @@
 from pathlib import Path
 import numpy as np
-from PIL import Image
 from torch.utils.data import Dataset
 
+from .StageTimer import NullTimer
+
 # NOTE: you need to download the mapillary_sls dataset from  https://github.com/FrederikWarburg/mapillary_sls
 # make sure the path where the mapillary_sls validation dataset resides on your computer is correct.
 # the folder named train_val should reside in DATASET_ROOT path (that's the only folder you need from mapillary_sls)
@@ -18,9 +19,11 @@ if not path_obj.joinpath('train_val'):
     raise Exception(f'Please make sure the directory train_val from mapillary_sls dataset is situated in the directory {DATASET_ROOT}')
 
 class MSLS(Dataset):
-    def __init__(self, input_transform = None):
+    def __init__(self, input_transform = None, decode_size = None):
         
         self.input_transform = input_transform
+        self.decode_size = decode_size # (h, w) JPEGs are decoded at the smallest DCT scale above it
+        self.timer = NullTimer() # or a StageTimer recording the time spent in each loading stage
         
         # hard coded reference image names, this avoids the hassle of listing them at each epoch.
         self.dbImages = np.load('../datasets/msls_val/msls_val_dbImages.npy')
@@ -42,10 +45,8 @@ class MSLS(Dataset):
         self.num_references = len(self.dbImages)
     
     def __getitem__(self, index):
-        img = Image.open(DATASET_ROOT+self.images[index])
-
-        if self.input_transform:
-            img = self.input_transform(img)
+        img = self.timer.load(DATASET_ROOT+self.images[index], self.decode_size)
+        img = self.timer.apply(self.input_transform, img)
 
         return img, index
 
@@ -1,14 +1,19 @@
-from os.path import join, exists
+import hashlib
+import os
+from os.path import join, exists, basename, splitext, abspath
 from collections import namedtuple
 from scipy.io import loadmat
 
+import numpy as np
+
 import torchvision.transforms as T
 import torch.utils.data as data
 
 
-from PIL import Image
 from sklearn.neighbors import NearestNeighbors
 
+from .StageTimer import NullTimer
+
 root_dir = '../datasets/Pittsburgh/'
 root_dir = '/home/java/AnyFeature-Benchmark/KITTI/02/rgb_db'
 
@@ -18,6 +23,9 @@ if not exists(root_dir):
 
 struct_dir = join(root_dir, 'datasets/')
 queries_dir = join(root_dir, 'queries_real')
+# parsed .mat structs and groundtruth positives are cached here, so that
+# we don't have to run loadmat and the radius search at each run
+cache_dir = join(struct_dir, 'cache/')
 
 
 def input_transform(image_size=None):
@@ -29,24 +37,24 @@ def input_transform(image_size=None):
 
 
 
-def get_whole_val_set(input_transform):
+def get_whole_val_set(input_transform, decode_size=None):
     structFile = join(struct_dir, 'pitts30k_val.mat')
-    return WholeDatasetFromStruct(structFile, input_transform=input_transform)
+    return WholeDatasetFromStruct(structFile, input_transform=input_transform, decode_size=decode_size)
 
 
-def get_250k_val_set(input_transform):
+def get_250k_val_set(input_transform, decode_size=None):
     structFile = join(struct_dir, 'pitts250k_val.mat')
-    return WholeDatasetFromStruct(structFile, input_transform=input_transform)
+    return WholeDatasetFromStruct(structFile, input_transform=input_transform, decode_size=decode_size)
 
 
-def get_whole_test_set(input_transform):
+def get_whole_test_set(input_transform, decode_size=None):
     structFile = join(struct_dir, 'pitts30k_test.mat')
-    return WholeDatasetFromStruct(structFile, input_transform=input_transform)
+    return WholeDatasetFromStruct(structFile, input_transform=input_transform, decode_size=decode_size)
 
 
-def get_250k_test_set(input_transform):
+def get_250k_test_set(input_transform, decode_size=None):
     structFile = join(struct_dir, 'pitts250k_test.mat')
-    return WholeDatasetFromStruct(structFile, input_transform=input_transform)
+    return WholeDatasetFromStruct(structFile, input_transform=input_transform, decode_size=decode_size)
 
 def get_whole_training_set(onlyDB=False):
     structFile = join(struct_dir, 'pitts30k_train.mat')
@@ -59,7 +67,41 @@ dbStruct = namedtuple('dbStruct', ['whichSet', 'dataset',
                                    'posDistThr', 'posDistSqThr', 'nonTrivPosDistSqThr'])
 
 
+def get_cache_file(structFile, suffix):
+    """Returns the cache file for the given struct file, the key changes
+    whenever the struct file is moved or modified.
+    """
+    st = os.stat(structFile)
+    key = f'{abspath(structFile)}:{st.st_size}:{st.st_mtime_ns}'
+    key = hashlib.sha1(key.encode()).hexdigest()[:12]
+    return join(cache_dir, f'{splitext(basename(structFile))[0]}_{key}_{suffix}.npz')
+
+
+def save_cache(cache_file, **arrays):
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first, a crash never leaves a truncated cache,
+    # and one per process, concurrent writers (ex. DDP ranks) never write to the same file
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_file, cache_file)
+
+
 def parse_dbStruct(path):
+    cache_file = get_cache_file(path, 'dbStruct')
+    if exists(cache_file):
+        c = np.load(cache_file)
+        return dbStruct(c['whichSet'].item(), c['dataset'].item(),
+                        c['dbImage'].tolist(), c['utmDb'], c['qImage'].tolist(),
+                        c['utmQ'], c['numDb'].item(), c['numQ'].item(), c['posDistThr'].item(),
+                        c['posDistSqThr'].item(), c['nonTrivPosDistSqThr'].item())
+
+    struct = parse_mat_dbStruct(path)
+    save_cache(cache_file, **{k: np.asarray(v) for k, v in struct._asdict().items()})
+    return struct
+
+
+def parse_mat_dbStruct(path):
     mat = loadmat(path)
     matStruct = mat['dbStruct'].item()
 
@@ -89,11 +131,14 @@ def parse_dbStruct(path):
 
 
 class WholeDatasetFromStruct(data.Dataset):
-    def __init__(self, structFile, input_transform=None, onlyDB=False):
+    def __init__(self, structFile, input_transform=None, onlyDB=False, decode_size=None):
         super().__init__()
 
         self.input_transform = input_transform
+        self.decode_size = decode_size # (h, w) JPEGs are decoded at the smallest DCT scale above it
+        self.timer = NullTimer() # or a StageTimer recording the time spent in each loading stage
 
+        self.structFile = structFile
         self.dbStruct = parse_dbStruct(structFile)
         self.images = [join(root_dir, dbIm) for dbIm in self.dbStruct.dbImage]
         if not onlyDB:
@@ -107,10 +152,8 @@ class WholeDatasetFromStruct(data.Dataset):
         self.distances = None
 
     def __getitem__(self, index):
-        img = Image.open(self.images[index])
-
-        if self.input_transform:
-            img = self.input_transform(img)
+        img = self.timer.load(self.images[index], self.decode_size)
+        img = self.timer.apply(self.input_transform, img)
 
         return img, index
 
@@ -120,11 +163,33 @@ class WholeDatasetFromStruct(data.Dataset):
     def getPositives(self):
         # positives for evaluation are those within trivial threshold range
         # fit NN to find them, search by radius
+        # they are computed once and cached (as CSR arrays) next to the parsed struct
         if self.positives is None:
-            knn = NearestNeighbors(n_jobs=-1)
-            knn.fit(self.dbStruct.utmDb)
-
-            self.distances, self.positives = knn.radius_neighbors(self.dbStruct.utmQ,
-                                                                  radius=self.dbStruct.posDistThr)
+            cache_file = get_cache_file(self.structFile, 'positives')
+            if exists(cache_file):
+                c = np.load(cache_file)
+                self.positives = csr_to_ragged(c['indptr'], c['indices'])
+                self.distances = csr_to_ragged(c['indptr'], c['distances'])
+            else:
+                knn = NearestNeighbors(n_jobs=-1)
+                knn.fit(self.dbStruct.utmDb)
+
+                self.distances, self.positives = knn.radius_neighbors(self.dbStruct.utmQ,
+                                                                      radius=self.dbStruct.posDistThr)
+                indptr = np.concatenate(([0], np.cumsum([len(p) for p in self.positives])))
+                save_cache(cache_file,
+                           indptr=indptr,
+                           indices=np.concatenate(self.positives),
+                           distances=np.concatenate(self.distances))
 
         return self.positives
+
+
+def csr_to_ragged(indptr, values):
+    """Converts CSR arrays back to an object array of per-row arrays
+    (the format returned by NearestNeighbors.radius_neighbors)
+    """
+    ragged = np.empty(len(indptr) - 1, dtype=object)
+    for i in range(len(ragged)):
+        ragged[i] = values[indptr[i]:indptr[i+1]]
+    return ragged
@@ -0,0 +1,174 @@
+import io
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import pytorch_lightning as pl
+from torch.utils.data import get_worker_info
+from torch.utils.data.dataloader import default_collate
+import torchvision.transforms as T
+
+from dataloaders.ImageLoader import load_image
+
+
+class StageTimer:
+    """Opt-in time histograms of the data loading stages (file read, JPEG decode,
+    each transform and collation), recorded inside the DataLoader worker processes.
+
+    The histograms live in shared memory tensors with one row per worker (row 0 is
+    the main process when num_workers=0), so workers never write to the same memory
+    and the main process can aggregate them at any time.
+
+    Args:
+        stages (list): names of the stages to time.
+        num_workers (int): number of workers of the DataLoader using this timer.
+    """
+    # log-spaced bins from 10us to 10s (plus underflow and overflow bins)
+    BIN_EDGES = np.logspace(-5, 1, 61)
+
+    def __init__(self, stages, num_workers):
+        self.stages = list(stages)
+        self.stage_index = {s: i for i, s in enumerate(self.stages)}
+        self.counts = torch.zeros(num_workers + 1, len(self.stages), len(self.BIN_EDGES) + 1,
+                                  dtype=torch.float64).share_memory_()
+        self.totals = torch.zeros(num_workers + 1, len(self.stages), dtype=torch.float64).share_memory_()
+
+    @staticmethod
+    def stages_for(transform):
+        """Returns the stages timed for a dataset using the given transform:
+        read, decode, one stage per transform of the Compose, and collate.
+        """
+        transforms = transform.transforms if isinstance(transform, T.Compose) else [transform]
+        return ['read', 'decode'] + [type(t).__name__ for t in transforms if t is not None] + ['collate']
+
+    def record(self, stage, seconds):
+        info = get_worker_info()
+        w = 0 if info is None else info.id + 1
+        s = self.stage_index[stage]
+        self.counts[w, s, np.searchsorted(self.BIN_EDGES, seconds)] += 1
+        self.totals[w, s] += seconds
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        yield
+        self.record(stage, time.perf_counter() - start)
+
+    def load(self, path, decode_size=None):
+        """Same as ImageLoader.load_image, but times reading the file and decoding it separately"""
+        with self.time('read'):
+            with open(path, 'rb') as f:
+                buffer = io.BytesIO(f.read())
+        with self.time('decode'):
+            return load_image(buffer, decode_size)
+
+    def apply(self, transform, img):
+        """Applies the transform, timing each transform of a Compose separately"""
+        if transform is None:
+            return img
+        transforms = transform.transforms if isinstance(transform, T.Compose) else [transform]
+        for t in transforms:
+            with self.time(type(t).__name__):
+                img = t(img)
+        return img
+
+    def summary(self):
+        """Aggregates the histograms of all workers
+
+        Returns:
+            dict: {stage: {'count', 'total_s', 'mean_ms', 'p50_ms', 'p90_ms'}} for every stage that was recorded
+        """
+        counts = self.counts.sum(0).numpy()
+        totals = self.totals.sum(0).numpy()
+        # upper edge of each bin, the overflow bin is reported as the last edge
+        upper_edges = np.append(self.BIN_EDGES, self.BIN_EDGES[-1])
+        summary = {}
+        for s, stage in enumerate(self.stages):
+            n = counts[s].sum()
+            if n == 0:
+                continue
+            cdf = np.cumsum(counts[s]) / n
+            summary[stage] = {
+                'count': int(n),
+                'total_s': float(totals[s]),
+                'mean_ms': 1e3 * float(totals[s] / n),
+                'p50_ms': 1e3 * float(upper_edges[np.searchsorted(cdf, 0.5)]),
+                'p90_ms': 1e3 * float(upper_edges[np.searchsorted(cdf, 0.9)]),
+            }
+        return summary
+
+    def reset(self):
+        self.counts.zero_()
+        self.totals.zero_()
+
+
+class NullTimer:
+    """Timer used when profiling is off, the datasets always load through a timer so that
+    the profiled and the normal loading paths are the same code.
+    """
+    @contextmanager
+    def time(self, stage):
+        yield
+
+    def load(self, path, decode_size=None):
+        return load_image(path, decode_size)
+
+    def apply(self, transform, img):
+        return img if transform is None else transform(img)
+
+
+class TimedCollate:
+    """Collate function that records the collation time in the given StageTimer"""
+    def __init__(self, timer, collate_fn=default_collate):
+        self.timer = timer
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        with self.timer.time('collate'):
+            return self.collate_fn(batch)
+
+
+class DataPipelineMonitor(pl.Callback):
+    """Logs the per-stage data loading times recorded by the datamodule's StageTimers,
+    together with the fraction of the training time spent waiting for data.
+
+    The data wait is the time between the end of a training step and the start of
+    the next one, which is when the trainer fetches (and transfers) the next batch.
+    """
+    def __init__(self):
+        super().__init__()
+        self.last_batch_end = None
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self.last_batch_end = None
+        self.wait_time = 0.
+        self.step_time = 0.
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        self.batch_start = time.perf_counter()
+        if self.last_batch_end is not None:
+            self.wait_time += self.batch_start - self.last_batch_end
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        self.last_batch_end = time.perf_counter()
+        self.step_time += self.last_batch_end - self.batch_start
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        metrics = self.timer_metrics(trainer.datamodule.train_timer, 'data/train')
+        if self.wait_time + self.step_time > 0:
+            metrics['data/wait_fraction'] = self.wait_time / (self.wait_time + self.step_time)
+        pl_module.log_dict(metrics, logger=True)
+        trainer.datamodule.train_timer.reset()
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        pl_module.log_dict(self.timer_metrics(trainer.datamodule.val_timer, 'data/val'), logger=True)
+        trainer.datamodule.val_timer.reset()
+
+    @staticmethod
+    def timer_metrics(timer, prefix):
+        metrics = {}
+        for stage, stats in timer.summary().items():
+            for k in ['mean_ms', 'p50_ms', 'p90_ms', 'total_s']:
+                metrics[f'{prefix}/{stage}_{k}'] = stats[k]
+        return metrics
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import time
+from os.path import join, exists
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+import torchvision.transforms as T
+from tqdm import tqdm
+
+
+class CachedValidationDataset(Dataset):
+    """Serves a validation dataset (Pittsburgh, MSLS) from an on-disk memmap
+    of already resized images, so that each JPEG is decoded and resized only once.
+
+    The validation transform is split at its ToTensor: the PIL transforms before it (ex. the resize)
+    are applied once when building the cache, the tensor transforms after it (ex. the normalization)
+    on every read ('uint8' cache). The cache is keyed by the list of images, the storage dtype and
+    the transform itself (the repr of each transform, with its size, interpolation, mean/std, ...),
+    so any change of the transform builds a new cache.
+
+    Args:
+        dataset (Dataset): the validation dataset to wrap, it must have the `images` and `input_transform` attributes.
+        transform (T.Compose): the validation transform, it must contain a T.ToTensor.
+        cache_dir (str): the folder where the memmap files are written.
+        name (str, optional): prefix of the cache file name. Defaults to 'val'.
+        dtype (str, optional): 'uint8' stores the images before ToTensor (3 bytes/pixel),
+                               'float16' stores the fully transformed tensors (6 bytes/pixel). Defaults to 'uint8'.
+        num_workers (int, optional): number of workers used to build the cache. Defaults to 4.
+    """
+    def __init__(self,
+                 dataset,
+                 transform,
+                 cache_dir,
+                 name='val',
+                 dtype='uint8',
+                 num_workers=4,
+                 ):
+        super().__init__()
+        assert dtype in ('uint8', 'float16'), f'Unsupported cache dtype {dtype}'
+        to_tensor = [i for i, t in enumerate(transform.transforms) if isinstance(t, T.ToTensor)]
+        assert len(to_tensor) == 1, 'The validation transform must contain one T.ToTensor'
+        self.dataset = dataset
+        self.transform = transform
+        self.pil_transform = T.Compose(transform.transforms[:to_tensor[0]])
+        self.tensor_transform = T.Compose(transform.transforms[to_tensor[0] + 1:])
+        self.dtype = dtype
+        self.num_workers = num_workers
+
+        self.cache_path = join(cache_dir, f'{name}_{self.cache_key()}.npy')
+        if not exists(self.cache_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            self.build()
+        self.cache = np.load(self.cache_path, mmap_mode='r')
+
+    def cache_key(self):
+        config = {
+            'dataset': type(self.dataset).__name__,
+            'images': [str(img) for img in self.dataset.images],
+            'decode_size': getattr(self.dataset, 'decode_size', None),
+            # the repr of torchvision transforms lists all their parameters
+            'transform': [repr(t) for t in self.transform.transforms],
+            'dtype': self.dtype,
+        }
+        return hashlib.sha1(json.dumps(config).encode()).hexdigest()[:16]
+
+    def build(self):
+        if self.dtype == 'uint8':
+            build_transform = T.Compose([self.pil_transform, T.PILToTensor()])
+        else:
+            build_transform = self.transform
+
+        # temporarily swap the transform of the wrapped dataset, so that
+        # it yields the tensors we want to store
+        input_transform = self.dataset.input_transform
+        self.dataset.input_transform = build_transform
+        start = time.perf_counter()
+        try:
+            loader = DataLoader(self.dataset, batch_size=32, num_workers=self.num_workers, shuffle=False)
+            # write to a temporary file first, so that an interrupted build never leaves a truncated cache,
+            # its name is unique per process in case several processes build the same cache at once
+            tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+            cache = None
+            for imgs, indices in tqdm(loader, ncols=100, desc=f'Caching {os.path.basename(self.cache_path)}'):
+                if cache is None:
+                    # the image shape is the output shape of the transform
+                    cache = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=self.dtype,
+                                                      shape=(len(self.dataset), *imgs.shape[1:]))
+                cache[indices.numpy()] = imgs.numpy()
+            cache.flush()
+            del cache
+            os.replace(tmp_path, self.cache_path)
+        finally:
+            self.dataset.input_transform = input_transform
+
+        size = os.path.getsize(self.cache_path) / 2**30
+        print(f'Built validation cache {self.cache_path} ({size:.2f} GB) in {time.perf_counter()-start:.1f}s')
+
+    def __getitem__(self, index):
+        # np.array copies the image out of the memmap
+        img = torch.from_numpy(np.array(self.cache[index]))
+        if self.dtype == 'uint8':
+            img = self.tensor_transform(img.float().div_(255))
+        else:
+            img = img.float()
+        return img, index
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getattr__(self, name):
+        # everything else (dbStruct, getPositives, num_references, pIdx, ...)
+        # is read from the wrapped dataset
+        if 'dataset' not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
@@ -0,0 +1,55 @@
+import numpy as np
+from torch.utils.data import Dataset
+
+
+class ValidationSubset(Dataset):
+    """A fixed subset of a validation set (Pittsburgh, MSLS), used for a cheaper validation
+    between the full ones.
+
+    The queries are evenly spaced over the query list, which follows the order of the
+    capture (places, cities), so the subset covers the whole set. The references are the
+    positives of these queries plus randomly sampled distractors, so that the subset keeps
+    the reference/query ratio of the full set. The subset yields the references then the
+    queries [R1, R2, ..., Rn, Q1, Q2, ...] like the full validation sets.
+
+    Args:
+        dataset (Dataset): the full validation set, it yields (image, index) and its references come first.
+        num_references (int): number of references in the full set.
+        positives (array): groundtruth positives (reference indices) of each query of the full set.
+        num_queries (int): number of queries to keep.
+        seed (int, optional): seed of the distractor sampling. Defaults to 0.
+    """
+    def __init__(self, dataset, num_references, positives, num_queries, seed=0):
+        super().__init__()
+        self.dataset = dataset
+        self.is_subset = True
+        self.full_num_queries = len(dataset) - num_references
+        num_queries = min(num_queries, self.full_num_queries)
+
+        q_indices = np.unique(np.linspace(0, self.full_num_queries - 1, num_queries).round().astype(np.int64))
+
+        # the positives of the selected queries, then distractors up to the ratio of the full set
+        ref_indices = np.unique(np.concatenate([np.asarray(positives[q], dtype=np.int64) for q in q_indices]))
+        num_distractors = int(round(num_references * len(q_indices) / self.full_num_queries)) - len(ref_indices)
+        if num_distractors > 0:
+            rng = np.random.default_rng(seed)
+            candidates = np.setdiff1d(np.arange(num_references), ref_indices)
+            distractors = rng.choice(candidates, min(num_distractors, len(candidates)), replace=False)
+            ref_indices = np.sort(np.concatenate([ref_indices, distractors]))
+
+        # groundtruth expressed with the reference indices of the subset
+        self.positives = np.empty(len(q_indices), dtype=object)
+        for i, q in enumerate(q_indices):
+            self.positives[i] = np.searchsorted(ref_indices, np.asarray(positives[q], dtype=np.int64))
+
+        self.num_references = len(ref_indices)
+        self.num_queries = len(q_indices)
+        # indices of the subset samples in the full set
+        self.indices = np.concatenate([ref_indices, num_references + q_indices])
+
+    def __getitem__(self, index):
+        img, _ = self.dataset[self.indices[index]]
+        return img, index
+
+    def __len__(self):
+        return len(self.indices)
@@ -1,9 +1,10 @@
 import glob
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from typing import Tuple
 
 import torch
-from PIL import Image
 from torch.utils import data
 import numpy as np
 import torchvision.transforms as tvf
@@ -11,6 +12,8 @@ from tqdm import tqdm
 import cv2
 
 from main import VPRModel
+from dataloaders import ImageLoader
+from keyframe_database import build_keyframe_database
 
 
 class BaseDataset(data.Dataset):
@@ -42,13 +45,16 @@ class BaseDataset(data.Dataset):
 
 
 class InferencePipeline:
-    def __init__(self, model, dataset, feature_dim, batch_size=4, num_workers=4, device='cuda'):
+    def __init__(self, model, dataset, feature_dim, batch_size=4, num_workers=4, device='cuda', precision='fp32'):
         self.model = model
         self.dataset = dataset
         self.feature_dim = feature_dim
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.device = device
+        # 'bf16' runs the model under bfloat16 autocast (CPU or GPU), 'fp16' under float16 autocast (GPU)
+        assert precision in ('fp32', 'bf16', 'fp16'), f'Unsupported precision {precision}'
+        self.precision = precision
 
         self.dataloader = data.DataLoader(self.dataset,
                                           batch_size=self.batch_size,
@@ -64,7 +70,9 @@ class InferencePipeline:
             return np.load(f'./LOGS/global_descriptors_{split}.npy')
 
         self.model.to(self.device)
-        with torch.no_grad():
+        autocast_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}.get(self.precision)
+        with torch.no_grad(), torch.autocast(device_type=torch.device(self.device).type,
+                                             dtype=autocast_dtype, enabled=autocast_dtype is not None):
             global_descriptors = np.zeros((len(self.dataset), self.feature_dim))
             for batch in tqdm(self.dataloader, ncols=100, desc=f'Extracting {split} features'):
                 imgs, indices = batch
@@ -72,7 +80,7 @@ class InferencePipeline:
 
                 # model inference
                 descriptors = self.model(imgs)
-                descriptors = descriptors.detach().cpu().numpy()
+                descriptors = descriptors.detach().float().cpu().numpy()
 
                 # add to global descriptors
                 global_descriptors[np.array(indices), :] = descriptors
@@ -83,7 +91,8 @@ class InferencePipeline:
 
 
 def load_image(path):
-    image_pil = Image.open(path).convert("RGB")
+    # JPEGs are decoded at the smallest DCT scale that is still above 320x320
+    image_pil = ImageLoader.load_image(path, decode_size=(320, 320))
 
     # add transforms
     transforms = tvf.Compose([
@@ -122,54 +131,82 @@ def load_model(ckpt_path):
 
 def calculate_top_k(q_matrix: np.ndarray,
                     db_matrix: np.ndarray,
-                    top_k: int = 10) -> np.ndarray:
+                    top_k: int = 10) -> Tuple[np.ndarray, np.ndarray]:
     # compute similarity matrix
     similarity_matrix = np.matmul(q_matrix, db_matrix.T)  # shape: (num_query, num_db)
 
-    # compute top-k matches
-    top_k_matches = np.argsort(-similarity_matrix, axis=1)[:, :top_k]  # shape: (num_query_images, 10)
+    # compute top-k matches (partition, then sort only the top-k of each row)
+    top_k = min(top_k, similarity_matrix.shape[1])
+    top_k_matches = np.argpartition(-similarity_matrix, top_k - 1, axis=1)[:, :top_k]
+    top_k_scores = np.take_along_axis(similarity_matrix, top_k_matches, axis=1)
+    order = np.argsort(-top_k_scores, axis=1, kind='stable')
+    top_k_matches = np.take_along_axis(top_k_matches, order, axis=1)  # shape: (num_query_images, 10)
+    top_k_scores = np.take_along_axis(top_k_scores, order, axis=1)
 
-    return top_k_matches
+    return top_k_matches, top_k_scores
 
-def record_matches(top_k_matches: np.ndarray,
+def export_matches(top_k_matches: np.ndarray,
+                   top_k_scores: np.ndarray,
                    query_dataset: BaseDataset,
                    database_dataset: BaseDataset,
-                   out_file: str = 'record.txt') -> None:
-    with open(f'{out_file}', 'a') as f:
-        for query_index, db_indices in enumerate(tqdm(top_k_matches, ncols=100, desc='Recording matches')):
-            pred_query_path = query_dataset.img_path_list[query_index]
-            for i in db_indices.tolist():
-                pred_db_paths = database_dataset.img_path_list[i]
-            f.write(f'{pred_query_path} {pred_db_paths}\n')
-        import code
-        code.interact(local=dict(globals(), **locals()))
+                   out_file: str = 'matches.npz') -> None:
+    """Writes every top-k match as one row of a columnar .npz file:
+    query_index, rank, db_index and score, the image paths are stored once in query_paths/db_paths.
+    """
+    num_queries, top_k = top_k_matches.shape
+    np.savez_compressed(out_file,
+                        query_index=np.repeat(np.arange(num_queries, dtype=np.int32), top_k),
+                        rank=np.tile(np.arange(top_k, dtype=np.int16), num_queries),
+                        db_index=top_k_matches.reshape(-1).astype(np.int32),
+                        score=top_k_scores.reshape(-1).astype(np.float32),
+                        query_paths=np.array(query_dataset.img_path_list),
+                        db_paths=np.array(database_dataset.img_path_list))
+
+def load_matches(path: str) -> dict:
+    """Loads the columns written by export_matches, with the query_path/db_path of each match"""
+    with np.load(path) as f:
+        matches = {k: f[k] for k in f.files}
+    matches['query_path'] = matches['query_paths'][matches['query_index']]
+    matches['db_path'] = matches['db_paths'][matches['db_index']]
+    return matches
 
 
 def visualize(top_k_matches: np.ndarray,
               query_dataset: BaseDataset,
               database_dataset: BaseDataset,
               visual_dir: str = './LOGS/visualize',
-              img_resize_size: Tuple = (320, 320)) -> None:
+              img_resize_size: Tuple = (320, 320),
+              cache_size: int = 2048,
+              num_threads: int = 8) -> None:
     if not os.path.exists(visual_dir):
         os.makedirs(visual_dir)
-    for q_idx, db_idx in enumerate(tqdm(top_k_matches, ncols=100, desc='Visualizing matches')):
-        pred_q_path = query_dataset.img_path_list[q_idx]
-        q_array = cv2.imread(pred_q_path, cv2.IMREAD_COLOR)
-        q_array = cv2.resize(q_array, img_resize_size, interpolation=cv2.INTER_CUBIC)
-        gap_array = np.ones((q_array.shape[0], 10, 3)) * 255  # white gap
 
-        for i in db_idx.tolist():
-            pred_db_paths = database_dataset.img_path_list[i]
-            db_array = cv2.imread(pred_db_paths, cv2.IMREAD_COLOR)
-            db_array = cv2.resize(db_array, img_resize_size, interpolation=cv2.INTER_CUBIC)
+    # each image is decoded and resized once, the same database images appear in many strips
+    @lru_cache(maxsize=cache_size)
+    def load_thumbnail(path):
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        return cv2.resize(img, img_resize_size, interpolation=cv2.INTER_CUBIC)
 
-            q_array = np.concatenate((q_array, gap_array, db_array), axis=1)
+    width, height = img_resize_size
+    gap = 10  # white gap between the images
 
-        result_array = q_array.astype(np.uint8)
-        # result_array = cv2.cvtColor(result_array, cv2.COLOR_RGB2BGR)
+    def render(q_idx, db_idx):
+        pred_q_path = query_dataset.img_path_list[q_idx]
+        db_idx = db_idx.tolist()
+        # preallocated strip: query, then the top-k database images
+        strip = np.full((height, (len(db_idx) + 1) * (width + gap) - gap, 3), 255, dtype=np.uint8)
+        strip[:, :width] = load_thumbnail(pred_q_path)
+        for j, i in enumerate(db_idx, start=1):
+            x = j * (width + gap)
+            strip[:, x:x + width] = load_thumbnail(database_dataset.img_path_list[i])
 
-        # save result as image using cv2
-        cv2.imwrite(f'{visual_dir}/{os.path.basename(pred_q_path)}', result_array)
+        # save result as image using cv2 (the encoding and the writing release the GIL)
+        cv2.imwrite(f'{visual_dir}/{os.path.basename(pred_q_path)}', strip)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = [executor.submit(render, q_idx, db_idx) for q_idx, db_idx in enumerate(top_k_matches)]
+        for future in tqdm(as_completed(futures), total=len(futures), ncols=100, desc='Visualizing matches'):
+            future.result()
 
 
 def main():
@@ -193,11 +230,17 @@ def main():
     db_global_descriptors = database_pipeline.run(split='db')  # shape: (num_db, feature_dim)
     query_global_descriptors = query_pipeline.run(split='query')  # shape: (num_query, feature_dim)
 
-    # calculate top-k matches
-    top_k_matches = calculate_top_k(q_matrix=query_global_descriptors, db_matrix=db_global_descriptors, top_k=10)
+    # only the keyframes admitted by the database policy are searched (see keyframe_database.py),
+    # ex. dict(novelty_threshold=0.9, max_size=2000, thin_by='temporal'), an empty policy keeps all the frames
+    keyframe_policy = dict()
+    db_ids, db_keyframes = build_keyframe_database(db_global_descriptors, **keyframe_policy).keyframes()
+
+    # calculate top-k matches (db_ids maps them back to the database images)
+    top_k_matches, top_k_scores = calculate_top_k(q_matrix=query_global_descriptors, db_matrix=db_keyframes, top_k=10)
+    top_k_matches = db_ids[top_k_matches]
 
     # record query_database_matches
-    record_matches(top_k_matches, query_dataset, database_dataset, out_file='/home/java/MixVPR/logs/record.txt')
+    export_matches(top_k_matches, top_k_scores, query_dataset, database_dataset, out_file='/home/java/MixVPR/logs/matches.npz')
 
     # visualize top-k matches
     visualize(top_k_matches, query_dataset, database_dataset, visual_dir='/home/java/MixVPR/logs/visualize')
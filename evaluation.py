@@ -0,0 +1,144 @@
+""" Precision/recall evaluation of loop-closure detection against the KITTI ground truth.
+
+Each query frame predicts a loop with its best-scoring candidate, the prediction is accepted
+when the score is above the threshold and is correct when the candidate is a ground-truth loop
+of the query. Sorting the best scores once gives the precision and recall at every threshold,
+so the whole curve (and the max recall at 100% precision) is computed in one vectorized pass.
+
+Example:
+    python evaluation.py similarity_matrix_05.txt /path/to/kitti05GroundTruth.mat --frame_distance 50 --plot
+"""
+import argparse
+
+import numpy as np
+
+from ground_truth import load_ground_truth
+from loop_candidates import find_loop_candidates
+
+
+def best_matches(similarity, frame_distance=0, causal=True, block_size=1024):
+    """Best candidate of each query in a similarity matrix (rows are queries, columns are database frames).
+    The frames within frame_distance of the query (the query itself included) are excluded, and with
+    causal only the frames before the query are candidates. Runs in blocks of rows to bound the memory.
+
+    Returns:
+        tuple: (query ids, best candidate ids, best scores) of the queries that have at least one candidate.
+    """
+    candidates = find_loop_candidates(similarity, top_k=1, frame_distance=frame_distance, causal=causal,
+                                      block_size=block_size)
+    return candidates.flat_query_ids(), candidates.indices, candidates.scores
+
+
+def best_candidates(query_ids, candidate_ids, scores):
+    """Best candidate of each query from a (flat) list of (query, candidate, score) candidates, ex. top-k lists"""
+    query_ids, candidate_ids, scores = np.asarray(query_ids), np.asarray(candidate_ids), np.asarray(scores)
+    # sort by query then by decreasing score, the first candidate of each query is its best
+    order = np.lexsort((-scores, query_ids))
+    query_ids, candidate_ids, scores = query_ids[order], candidate_ids[order], scores[order]
+    first = np.r_[True, query_ids[1:] != query_ids[:-1]]
+    return query_ids[first], candidate_ids[first], scores[first]
+
+
+def num_loop_queries(ground_truth, frame_distance=0, causal=True, num_queries=None):
+    """Number of queries with at least one ground-truth loop among their allowed candidates"""
+    rows, cols = ground_truth.rows, ground_truth.indices
+    allowed = np.abs(cols - rows) > frame_distance
+    if causal:
+        allowed &= cols < rows
+    rows = rows[allowed]
+    if num_queries is not None:
+        rows = rows[rows < num_queries]
+    return len(np.unique(rows))
+
+
+def precision_recall_curve(scores, is_correct, num_positives):
+    """Precision and recall at every threshold
+
+    Args:
+        scores (array): score of each prediction.
+        is_correct (array): whether each prediction is a true loop.
+        num_positives (int): number of queries with a true loop (the denominator of the recall).
+
+    Returns:
+        tuple: (thresholds, precision, recall), by decreasing threshold.
+    """
+    order = np.argsort(-np.asarray(scores), kind='stable')
+    scores = np.asarray(scores)[order]
+    true_positives = np.cumsum(np.asarray(is_correct)[order])
+    num_predictions = np.arange(1, len(scores) + 1)
+    # with ties, a threshold accepts all the predictions with the same score
+    last_of_threshold = np.r_[scores[1:] != scores[:-1], True] if len(scores) else np.zeros(0, dtype=bool)
+    thresholds = scores[last_of_threshold]
+    precision = true_positives[last_of_threshold] / num_predictions[last_of_threshold]
+    recall = true_positives[last_of_threshold] / max(num_positives, 1)
+    return thresholds, precision, recall
+
+
+def max_recall_at_100_precision(precision, recall):
+    perfect = precision >= 1.0
+    return float(recall[perfect].max()) if perfect.any() else 0.0
+
+
+def evaluate(query_ids, candidate_ids, scores, ground_truth, num_positives):
+    """Precision/recall curve of the best candidate of each query
+
+    Returns:
+        dict: thresholds, precision, recall, the max recall at 100% precision and the average precision.
+    """
+    is_correct = ground_truth.contains(query_ids, candidate_ids)
+    thresholds, precision, recall = precision_recall_curve(scores, is_correct, num_positives)
+    # average precision, the area under the step curve
+    average_precision = float(np.sum(np.diff(np.r_[0., recall]) * precision))
+    return {'thresholds': thresholds,
+            'precision': precision,
+            'recall': recall,
+            'max_recall_at_100_precision': max_recall_at_100_precision(precision, recall),
+            'average_precision': average_precision}
+
+
+def evaluate_similarity_matrix(similarity, ground_truth, frame_distance=0, causal=True, block_size=1024):
+    """Evaluates a (num_frames x num_frames) similarity matrix against the ground truth"""
+    query_ids, candidate_ids, scores = best_matches(similarity, frame_distance, causal, block_size)
+    num_positives = num_loop_queries(ground_truth, frame_distance, causal, num_queries=similarity.shape[0])
+    return evaluate(query_ids, candidate_ids, scores, ground_truth, num_positives)
+
+
+def evaluate_candidates(query_ids, candidate_ids, scores, ground_truth, frame_distance=0, causal=True):
+    """Evaluates candidate lists (flat arrays of (query, candidate, score), ex. top-k loop candidates),
+    which are assumed to already respect the exclusion window and the causality.
+    """
+    query_ids, candidate_ids, scores = best_candidates(query_ids, candidate_ids, scores)
+    num_positives = num_loop_queries(ground_truth, frame_distance, causal)
+    return evaluate(query_ids, candidate_ids, scores, ground_truth, num_positives)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precision/recall of loop closures from a similarity matrix')
+    parser.add_argument('similarity_matrix', type=str, help='.npy file or tab separated text file')
+    parser.add_argument('ground_truth', type=str, help='kittiXXGroundTruth.mat or gnd_kittiXX.mat')
+    parser.add_argument('--frame_distance', type=int, default=50, help='frames around the query excluded from the candidates')
+    parser.add_argument('--non_causal', action='store_true', help='also consider the frames after the query')
+    parser.add_argument('--plot', action='store_true')
+    args = parser.parse_args()
+
+    if args.similarity_matrix.endswith('.npy'):
+        similarity = np.load(args.similarity_matrix, mmap_mode='r')
+    else:
+        similarity = np.loadtxt(args.similarity_matrix, delimiter='\t')
+    ground_truth = load_ground_truth(args.ground_truth)
+    results = evaluate_similarity_matrix(similarity, ground_truth, args.frame_distance, not args.non_causal)
+
+    print(f"max recall @ 100% precision: {results['max_recall_at_100_precision']:.4f}")
+    print(f"average precision: {results['average_precision']:.4f}")
+    if args.plot:
+        import matplotlib.pyplot as plt
+        plt.plot(results['recall'], results['precision'])
+        plt.xlabel('Recall')
+        plt.ylabel('Precision')
+        plt.title('Loop closure precision-recall')
+        plt.grid(linestyle='--', alpha=0.7)
+        plt.show()
+
+
+if __name__ == '__main__':
+    main()
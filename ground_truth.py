@@ -0,0 +1,137 @@
+""" Loop-closure ground truth of the KITTI sequences, as a sparse (CSR) adjacency between frames.
+
+Both ground-truth formats are supported:
+    - kittiXXGroundTruth.mat ('truth'): N x N binary matrix, entry (i, j) is 1 when frames i and j are the same place.
+    - gnd_kittiXX.mat ('gnd'): for each frame, the (1-based) indices of the frames regarded as the same place.
+
+The .mat file is converted once and cached next to it (cache/<name>_<key>_gt.npz),
+the cache key changes whenever the .mat file is moved or modified.
+
+Example:
+    gt = GroundTruth.from_mat('/path/to/KITTI_GroundTruth/kitti05GroundTruth.mat')
+    gt.neighbours(1500)        # frames that are the same place as frame 1500
+    gt.frames_with_loops()     # frames with at least one loop closure
+    gt.contains(rows, cols)    # vectorized lookup of (query, candidate) pairs
+"""
+import hashlib
+import os
+from functools import lru_cache
+from os.path import abspath, basename, dirname, exists, join, splitext
+
+import numpy as np
+import scipy.io as sio
+import scipy.sparse as sp
+
+
+def get_cache_file(mat_path, cache_dir=None):
+    st = os.stat(mat_path)
+    key = f'{abspath(mat_path)}:{st.st_size}:{st.st_mtime_ns}'
+    key = hashlib.sha1(key.encode()).hexdigest()[:12]
+    cache_dir = cache_dir or join(dirname(abspath(mat_path)), 'cache')
+    return join(cache_dir, f'{splitext(basename(mat_path))[0]}_{key}_gt.npz')
+
+
+def cell_indices(cell):
+    """The indices stored in a cell of gnd_kittiXX.mat, whatever the nesting of the matlab cells/structs"""
+    cell = np.asarray(cell)
+    if cell.dtype.names: # matlab struct
+        parts = [cell_indices(cell[name]) for name in cell.dtype.names]
+    elif cell.dtype == object: # matlab cell
+        parts = [cell_indices(c) for c in cell.ravel()]
+    else:
+        return cell.ravel().astype(np.int64)
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+
+class GroundTruth:
+    """Loop closures of a sequence, row i of the CSR adjacency holds the frames (sorted) that
+    are the same place as frame i, frame i itself excluded.
+
+    Args:
+        indptr (array): CSR row pointers, of size num_frames + 1.
+        indices (array): CSR column indices, sorted within each row.
+    """
+    def __init__(self, indptr, indices):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.num_frames = len(self.indptr) - 1
+        self.rows = np.repeat(np.arange(self.num_frames), np.diff(self.indptr))
+        # the (row, col) keys are globally sorted, since the rows are in order and their columns are sorted
+        self.keys = self.rows * self.num_frames + self.indices
+
+    @classmethod
+    def from_mat(cls, mat_path, cache_dir=None):
+        """Loads the ground truth of a kittiXXGroundTruth.mat or gnd_kittiXX.mat file (cached on disk)"""
+        cache_file = get_cache_file(mat_path, cache_dir)
+        if exists(cache_file):
+            c = np.load(cache_file)
+            return cls(c['indptr'], c['indices'])
+
+        mat_file = sio.loadmat(mat_path)
+        if 'truth' in mat_file:
+            truth = sp.coo_matrix(mat_file['truth'])
+            rows, cols = truth.row[truth.data != 0], truth.col[truth.data != 0]
+            num_frames = truth.shape[0]
+        elif 'gnd' in mat_file:
+            # one cell of 1-based indices per frame
+            gnd = mat_file['gnd'].ravel()
+            cols = [cell_indices(cell) - 1 for cell in gnd]
+            rows = np.repeat(np.arange(len(gnd)), [len(c) for c in cols])
+            cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+            num_frames = len(gnd)
+        else:
+            raise KeyError(f'{mat_path} contains neither a "truth" nor a "gnd" variable')
+
+        # a frame is not a loop closure of itself
+        keep = rows != cols
+        adjacency = sp.csr_matrix((np.ones(keep.sum(), dtype=np.int8), (rows[keep], cols[keep])),
+                                  shape=(num_frames, num_frames))
+        adjacency.sum_duplicates() # also sorts the indices of each row
+
+        os.makedirs(dirname(cache_file), exist_ok=True)
+        # write to a temporary file first, a crash never leaves a truncated cache,
+        # and one per process, concurrent writers (ex. DDP ranks, workers) never write to the same file
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, indptr=adjacency.indptr, indices=adjacency.indices)
+        os.replace(tmp_file, cache_file)
+        return cls(adjacency.indptr, adjacency.indices)
+
+    def neighbours(self, frame):
+        """Frames that are the same place as the given frame"""
+        return self.indices[self.indptr[frame]:self.indptr[frame + 1]]
+
+    def num_neighbours(self):
+        """Number of loop-closure frames of each frame"""
+        return np.diff(self.indptr)
+
+    def has_loop(self, frames=None):
+        """Whether each of the given frames (all frames by default) has at least one loop closure"""
+        has_loop = self.num_neighbours() > 0
+        return has_loop if frames is None else has_loop[frames]
+
+    def frames_with_loops(self):
+        return np.flatnonzero(self.has_loop())
+
+    def contains(self, rows, cols):
+        """Whether each (rows[i], cols[i]) pair is a loop closure"""
+        keys = np.asarray(rows, dtype=np.int64) * self.num_frames + np.asarray(cols, dtype=np.int64)
+        pos = np.searchsorted(self.keys, keys)
+        found = np.zeros(keys.shape, dtype=bool)
+        valid = pos < len(self.keys)
+        found[valid] = self.keys[pos[valid]] == keys[valid]
+        return found
+
+    def to_sparse(self):
+        return sp.csr_matrix((np.ones(len(self.indices), dtype=bool), self.indices, self.indptr),
+                             shape=(self.num_frames, self.num_frames))
+
+    def __len__(self):
+        """Number of loop-closure pairs"""
+        return len(self.indices)
+
+
+@lru_cache(maxsize=None)
+def load_ground_truth(mat_path):
+    """GroundTruth.from_mat, kept in memory for the repeated calls of a script"""
+    return GroundTruth.from_mat(mat_path)
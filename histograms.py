@@ -5,67 +5,30 @@ Designed as part of EGH400-1 and EGH400-2 project at QUT
 
 import numpy as np
 import matplotlib.pyplot as plt
-import re
-import scipy.io as sio
-
-
-def Fetch_ground_truth_loop_closures(gnd_truth_location: str)
-    mat_file = sio.loadmat(gnd_truth_location + sequence + 'GroundTruth.mat')
-    truth_data = mat_file['truth']
-    return np.sum(truth_data, axis=1)
-
-def Fetch_Orbslam_loop_closures(orbslam_location: str):
-    orbslam_dict = {}
-    with open(orbslam_location, 'r') as file:
-        for line in file:
-            match = re.search(r'DetectLoopCandidates: mnFrameID\s*=\s*(\d+)\s+inital matches:\s*(\d+)\s+1st Filter matches.*?=\s*(\d+)\s+2nd Filter matches.*?=\s*(\d+)\s+3rd Filter matches.*?=\s*(\d+)', line)
-            if match:
-                mnFrameID = int(match.group(1))
-                initial_matches = int(match.group(2))
-                first_filter_matches = int(match.group(3))
-                third_filter_matches = int(match.group(5))
-                # Store the extracted numbers
-                orbslam_dict[mnFrameID] = {
-                    'initial': initial_matches,
-                    'one_filter': first_filter_matches,
-                    '3rd_filter': third_filter_matches
-                }
-    ORBmnFramneID = sorted(orbslam_dict.keys())  # Sort ORBmnFramneID for better plotting
-    initial_matches = [orbslam_dict[mnFrameID]['initial'] for mnFrameID in ORBmnFramneID]
-    first_filter_matches = [orbslam_dict[mnFrameID]['one_filter'] for mnFrameID in ORBmnFramneID]
-    third_filter_matches = [orbslam_dict[mnFrameID]['3rd_filter'] for mnFrameID in ORBmnFramneID]
-    return np.array(ORBmnFramneID)
-
-def Fetch_MixVPR_loop_closures(mix_vpr_location: str):
-    mix_vpr_dict = {}
-    with open(mix_vpr_location, 'r') as file:
-        for line in file:
-            match = re.search(r'vpFilteredLoopCandidate:\s*mnFrameId\s*=\s*(\d+)\s+inital matches:\s*(\d+)\s+vp 1st filtered matches:\s*(\d+)\s+vp 2nd filtered matches:\s*(\d+)', line)
-            if match:
-                mnFrameID = int(match.group(1))
-                matches = int(match.group(2))
-                one_filter = int(match.group(3))
-                two_filter = int(match.group(4))
-
-                # Store the extracted numbers
-                mix_vpr_dict[mnFrameID] = {
-                    'matches': matches,
-                    'one_filter': one_filter,
-                    'two_filter': two_filter,
-                }
-    MIXVPRmnFramneID = sorted(mix_vpr_dict.keys())  # Sort MIXVPRmnFramneID for better plotting
-    mix_vpr_matches = [mix_vpr_dict[mnFrameID]['matches'] for mnFrameID in MIXVPRmnFramneID]
-    one_filter = [mix_vpr_dict[mnFrameID]['one_filter'] for mnFrameID in MIXVPRmnFramneID]
-    two_filter = [mix_vpr_dict[mnFrameID]['two_filter'] for mnFrameID in MIXVPRmnFramneID]
-    return np.array(MIXVPRmnFramneID)
-
-
-
-def Plot_ORB_n_GT(ORBmnFramneID, num_loop_closures): #ORBSLAM and GT
+
+from ground_truth import load_ground_truth
+from slam_logs import parse_logs, last_per_frame
+
+
+def Fetch_ground_truth_loop_closures(gnd_truth_location: str, sequence: str):
+    # number of ground truth loop closures of each frame (from the cached sparse ground truth)
+    return load_ground_truth(gnd_truth_location + sequence + 'GroundTruth.mat').num_neighbours()
+
+def Fetch_Orbslam_loop_closures(orbslam_events: dict):
+    # last DetectLoopCandidates event of each frame, sorted by frame ID for plotting
+    return last_per_frame(orbslam_events['detect_loop_candidates'])
+
+def Fetch_MixVPR_loop_closures(mix_vpr_events: dict):
+    # last vpFilteredLoopCandidate event of each frame, sorted by frame ID for plotting
+    return last_per_frame(mix_vpr_events['vp_filtered_candidates'])
+
+
+
+def Plot_ORB_n_GT(orbslam, num_loop_closures): #ORBSLAM and GT
     bar_width = 0.5
     plt.figure(figsize=(10, 6))
-    plt.bar(ORBmnFramneID + bar_width, first_filter_matches, bar_width, label='1st Filter Matches', color='green')
-    plt.bar(ORBmnFramneID + 3 * bar_width, third_filter_matches, bar_width, label='3rd Filter Matches', color='red')
+    plt.bar(orbslam['frame_id'] + bar_width, orbslam['filter1'], bar_width, label='1st Filter Matches', color='green')
+    plt.bar(orbslam['frame_id'] + 3 * bar_width, orbslam['filter3'], bar_width, label='3rd Filter Matches', color='red')
     plt.bar(np.arange(len(num_loop_closures)), num_loop_closures, label='Ground Truth Loop Closures', color='skyblue')
     plt.xlabel('Image Number')
     plt.ylabel('Number of Matches')
@@ -74,26 +37,24 @@ def Plot_ORB_n_GT(ORBmnFramneID, num_loop_closures): #ORBSLAM and GT
     plt.tight_layout()
     plt.show()
 
-def Plot_ORB(ORBmnFramneID):#ORBSLAM
+def Plot_ORB(orbslam):#ORBSLAM
     bar_width = 0.5
     plt.figure(figsize=(10, 6))
-    ORBmnFramneID = np.array(ORBmnFramneID)
-    plt.bar(ORBmnFramneID + bar_width, first_filter_matches, bar_width, label='1st Filter Matches', color='green')
-    plt.bar(ORBmnFramneID + 3 * bar_width, third_filter_matches, bar_width, label='3rd Filter Matches', color='red')
+    plt.bar(orbslam['frame_id'] + bar_width, orbslam['filter1'], bar_width, label='1st Filter Matches', color='green')
+    plt.bar(orbslam['frame_id'] + 3 * bar_width, orbslam['filter3'], bar_width, label='3rd Filter Matches', color='red')
     plt.xlabel('Frame Number')
     plt.ylabel('Number of Matches')
     plt.title('Matches per Key ID')
-    plt.xticks(ORBmnFramneID[::100])  # Use ORBmnFramneID for x-ticks
+    plt.xticks(orbslam['frame_id'][::100])  # Use the frame IDs for x-ticks
     plt.legend()
     plt.tight_layout()
     plt.show()
 
-def Plot_MIX_n_GT(MIXVPRmnFramneID, num_loop_closures, threashold):
-    bar_width = 0.5
+def Plot_MIX_n_GT(mix_vpr, num_loop_closures, threashold):
     plt.figure(figsize=(10, 6))
     plt.bar(np.arange(len(num_loop_closures)), num_loop_closures, label='Ground Truth Loop Closures', color='skyblue')
-    plt.bar(MIXVPRmnFramneID, one_filter, label='Similarity Filter', color='green')
-    plt.bar(MIXVPRmnFramneID, two_filter, label='Filter Connected Images', color='red')
+    plt.bar(mix_vpr['frame_id'], mix_vpr['filter1'], label='Similarity Filter', color='green')
+    plt.bar(mix_vpr['frame_id'], mix_vpr['filter2'], label='Filter Connected Images', color='red')
     plt.xlabel('Image Number')
     plt.ylabel('Number of Matches')
     plt.title(f'Loop Candidates with MIXVPR, similarity threashold {threashold}')
@@ -102,14 +63,14 @@ def Plot_MIX_n_GT(MIXVPRmnFramneID, num_loop_closures, threashold):
     plt.tight_layout()
     plt.show()
 
-def Plot_Mix(MIXVPRmnFramneID, threashold):
+def Plot_Mix(mix_vpr, threashold):
     plt.figure(figsize=(10, 6))
-    plt.bar(MIXVPRmnFramneID, one_filter, label='Similarity Filter', color='green')
-    plt.bar(MIXVPRmnFramneID, two_filter, label='Filter Connected Images', color='red')
+    plt.bar(mix_vpr['frame_id'], mix_vpr['filter1'], label='Similarity Filter', color='green')
+    plt.bar(mix_vpr['frame_id'], mix_vpr['filter2'], label='Filter Connected Images', color='red')
     plt.xlabel('Image Number')
     plt.ylabel('Number of Matches')
     plt.title(f'Loop Candidates with MIXVPR, similarity threashold {threashold}')
-    plt.xticks(MIXVPRmnFramneID[::100])  # Use MIXVPRmnFramneID for x-ticks
+    plt.xticks(mix_vpr['frame_id'][::100])  # Use the frame IDs for x-ticks
     plt.legend()
     plt.tight_layout()
     plt.show()
@@ -132,15 +93,17 @@ def main():
     Mix_threashold = 0.2
     orbslam_location = '/home/java/VSLAM-LAB-Evaluation/exp_demo_anyfeature/KITTI/'+sequence+'/system_output_00000.txt'
     mix_vpr_location = '/home/java/VSLAM-LAB-Evaluation/exp_demo_anyfeature/KITTI/'+sequence+'/system_output_'+run+'.txt'
-    num_loop_closures = Fetch_ground_truth_loop_closures(gnd_truth_location)
-    ORBmnFramneID = Fetch_Orbslam_loop_closures(orbslam_location)
-    MIXVPRmnFramneID = Fetch_MixVPR_loop_closures(mix_vpr_location)
+    num_loop_closures = Fetch_ground_truth_loop_closures(gnd_truth_location, sequence)
+    # both logs are parsed in parallel, each in a single pass
+    orbslam_events, mix_vpr_events = parse_logs([orbslam_location, mix_vpr_location])
+    orbslam = Fetch_Orbslam_loop_closures(orbslam_events)
+    mix_vpr = Fetch_MixVPR_loop_closures(mix_vpr_events)
 
     ## Plot
-    Plot_ORB_n_GT(ORBmnFramneID, num_loop_closures)
-    Plot_ORB(ORBmnFramneID)
-    Plot_MIX_n_GT(MIXVPRmnFramneID, num_loop_closures, Mix_threashold)
-    Plot_Mix(MIXVPRmnFramneID, Mix_threashold)
+    Plot_ORB_n_GT(orbslam, num_loop_closures)
+    Plot_ORB(orbslam)
+    Plot_MIX_n_GT(mix_vpr, num_loop_closures, Mix_threashold)
+    Plot_Mix(mix_vpr, Mix_threashold)
     Plot_GT(num_loop_closures)
 
 
@@ -6,43 +6,29 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 import cv2
-import scipy.io as sio
+
+from ground_truth import load_ground_truth
+from loop_candidates import find_loop_candidates
 
 
 def get_ground_truth(groundtruth_path: str, query_img_no: int):
-    mat_file = sio.loadmat(groundtruth_path)
-    truth_data = mat_file['truth']
-    num_images = truth_data.shape[0]
-    image_groups = {}
-    # Iterate through the binary matrix to identify images with loop closures
-    for i in range(num_images):
-        for j in range(num_images):
-            if truth_data[i, j] == 1 and i != j:
-                if i not in image_groups:
-                    image_groups[i] = []
-                if j not in image_groups:
-                    image_groups[j] = []
-                image_groups[i].append(i)
-                image_groups[i].append(j)
-    image_groups = {k: v for k, v in image_groups.items() if v} #remove nums
-    image_groups = {k: [x for x in v if x != k] for k, v in image_groups.items()} #remove self
-    try:
-        groundtruth_nos = image_groups[query_img_no]
-    except KeyError:
+    # the .mat file is converted once to a sparse adjacency (cached on disk), we only read the query row
+    groundtruth_nos = load_ground_truth(groundtruth_path).neighbours(query_img_no).tolist()
+    if not groundtruth_nos:
         print(f'No groundtruth for query image {query_img_no}')
         groundtruth_nos = None
     return groundtruth_nos
 
 def get_loop_candidates(similarity_matrix: np.ndarray, query_index: int, top_k: int, frame_distance: int):
-    array = similarity_matrix[query_index, :]
-    sorted_indices = np.argsort(array)
-    top_K_indices = sorted_indices[-top_k:]
-    filtered_indices = [i for i in top_K_indices if not (i == query_index or (query_index - frame_distance < i < query_index + frame_distance))]
-    mix_vpr_no = filtered_indices[-1]
-    mix_vpr_score = array[mix_vpr_no]
+    # best candidate outside of the frames strictly closer than frame_distance to the query
+    candidates = find_loop_candidates(similarity_matrix[query_index:query_index+1], top_k=top_k,
+                                      frame_distance=max(frame_distance - 1, 0), query_ids=[query_index])
+    indices, scores = candidates[0]
+    mix_vpr_no = int(indices[0])
+    mix_vpr_score = scores[0]
     return mix_vpr_no, mix_vpr_score
 
-def plot_read_imgs(query_img, database_img, mix_vpr_img, query_img_no, database_img_no, database_img_score, mix_vpr_no, mix_vpr_score, groundtruth_no, groundtruth_nos, groundtruth_img_score):
+def plot_read_imgs(query_img, database_img, mix_vpr_img, query_img_no, database_img_no, database_img_score, mix_vpr_no, mix_vpr_score, groundtruth_no, groundtruth_nos, groundtruth_img_score, image_location):
     plt.figure(figsize=(12, 6))
     plt.subplot(2, 2, 1)
     plt.imshow(query_img)
@@ -70,10 +56,10 @@ def plot_read_imgs(query_img, database_img, mix_vpr_img, query_img_no, database_
         plt.axis('off')
     plt.show()
 
-def plot_info(query_img_no, database_img_no, similarity_mat, frame_distance):
+def plot_info(query_img_no, database_img_no, similarity_mat, frame_distance, image_location, groundtruth_path, top_k=10):
     groundtruth_nos = get_ground_truth(groundtruth_path, query_img_no)
     groundtruth_no = groundtruth_nos[0] if groundtruth_nos else None
-    mix_vpr_no, mix_vpr_score = get_loop_candidates(similarity_mat, query_img_no, frame_distance)
+    mix_vpr_no, mix_vpr_score = get_loop_candidates(similarity_mat, query_img_no, top_k, frame_distance)
     database_img_score = similarity_mat[query_img_no, database_img_no]
     groundtruth_img_score = similarity_mat[query_img_no, groundtruth_no] if groundtruth_no else None
 
@@ -86,7 +72,7 @@ def plot_info(query_img_no, database_img_no, similarity_mat, frame_distance):
 
     plot_read_imgs(query_img, database_img, mix_vpr_img, query_img_no, 
                    database_img_no, database_img_score, mix_vpr_no, mix_vpr_score, 
-                   groundtruth_no, groundtruth_nos, groundtruth_img_score)
+                   groundtruth_no, groundtruth_nos, groundtruth_img_score, image_location)
 
 
 def main():
@@ -99,7 +85,7 @@ def main():
     frame_distance = 15 #how many frames around the query image to exclude from potential loop candidates
     #plot_info(query_img_no, database_img_no, similarity_mat)
     #plot_info(50, database_img_no, similarity_mat)
-    plot_info(1500, 1900, similarity_mat, frame_distance)
+    plot_info(1500, 1900, similarity_mat, frame_distance, image_location, groundtruth_path)
 
 
 if __name__ == '__main__':
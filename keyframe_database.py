@@ -0,0 +1,279 @@
+""" Keyframe descriptor database with an admission policy and a size cap, for long runs.
+
+The KITTI frames (10 Hz) are very redundant, adding all of them makes the memory and the search
+cost grow linearly with the drive time. Two policies bound the database:
+    - admission: a frame is only inserted when its descriptor differs enough from the last
+      admitted keyframes (its max similarity to them is below novelty_threshold),
+    - thinning: when the database exceeds max_size it is thinned down to thin_ratio * max_size
+      by repeatedly removing the keyframe whose removal leaves the smallest gap between its
+      neighbours, in descriptor space, in space (positions) or in time (frame ids). The first
+      and the last keyframes are always kept.
+
+Running this file reports the recall versus database size trade-off on KITTI sequences:
+    python keyframe_database.py --descriptors ./LOGS/global_descriptors_{seq}.npy \\
+        --ground_truth /path/to/kitti{seq}GroundTruth.mat --sequences 00 02 05 08 \\
+        --novelty_thresholds 1.0 0.9 0.8 --max_sizes 0 500 --thin_by temporal
+"""
+import argparse
+import heapq
+
+import numpy as np
+
+from evaluation import evaluate, num_loop_queries
+from ground_truth import load_ground_truth
+from loop_candidates import find_loop_candidates
+
+
+class KeyframeDatabase:
+    """Descriptors of the admitted keyframes, in preallocated arrays grown by doubling
+
+    Args:
+        feature_dim (int): descriptor size.
+        capacity (int, optional): initial capacity. Defaults to 1024.
+        novelty_threshold (float, optional): frames with a similarity >= novelty_threshold to one of the
+                                             last novelty_window keyframes are not admitted. Defaults to None (admit all).
+        novelty_window (int, optional): number of recent keyframes compared for the admission. Defaults to 10.
+        max_size (int, optional): maximum number of keyframes. Defaults to None (no cap).
+        thin_ratio (float, optional): the database is thinned down to thin_ratio * max_size at once,
+                                      so the thinning cost is amortized over many insertions. Defaults to 0.9.
+        thin_by (str, optional): the gap between two keyframes used by the thinning, 'descriptor' (1 - similarity),
+                                 'spatial' (distance between the positions) or 'temporal' (number of frames).
+                                 Defaults to None ('spatial' when all the keyframes have a position, else 'descriptor').
+    """
+    def __init__(self, feature_dim, capacity=1024, novelty_threshold=None, novelty_window=10, max_size=None,
+                 thin_ratio=0.9, thin_by=None):
+        if thin_by not in (None, 'descriptor', 'spatial', 'temporal'):
+            raise ValueError(f'Unknown thinning criterion {thin_by}')
+        self.novelty_threshold = novelty_threshold
+        self.novelty_window = novelty_window
+        self.max_size = max_size
+        self.thin_ratio = thin_ratio
+        self.thin_by = thin_by
+        self.descriptors = np.zeros((capacity, feature_dim), dtype=np.float32)
+        self.frame_ids = np.zeros(capacity, dtype=np.int64)
+        self.positions = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def keyframes(self):
+        """(frame_ids, descriptors) of the keyframes, views on the stored arrays"""
+        return self.frame_ids[:self.size], self.descriptors[:self.size]
+
+    def nbytes(self):
+        """Memory of the stored keyframes (not of the preallocated capacity)"""
+        return self.size * (self.descriptors.itemsize * self.descriptors.shape[1] + self.frame_ids.itemsize)
+
+    def is_novel(self, descriptor):
+        if self.novelty_threshold is None or self.size == 0:
+            return True
+        recent = self.descriptors[max(self.size - self.novelty_window, 0):self.size]
+        return (recent @ descriptor).max() < self.novelty_threshold
+
+    def _append(self, frame_id, descriptor, position):
+        if self.size == len(self.frame_ids):
+            capacity = 2 * len(self.frame_ids)
+            self.descriptors = np.resize(self.descriptors, (capacity, self.descriptors.shape[1]))
+            self.frame_ids = np.resize(self.frame_ids, capacity)
+            if self.positions is not None:
+                self.positions = np.resize(self.positions, (capacity, self.positions.shape[1]))
+        if position is not None and self.positions is None:
+            self.positions = np.full((len(self.frame_ids), len(position)), np.nan)
+        if self.positions is not None:
+            self.positions[self.size] = np.nan if position is None else position
+        self.descriptors[self.size] = descriptor
+        self.frame_ids[self.size] = frame_id
+        self.size += 1
+
+    def insert(self, frame_ids, descriptors, positions=None):
+        """Inserts the admitted frames (in order), the database is thinned as soon as it exceeds max_size,
+        so it never holds more than max_size keyframes, whatever the batch size
+
+        Args:
+            frame_ids (array): frame id of each frame.
+            descriptors (array): (num_frames x feature_dim) L2 normalized descriptors.
+            positions (array, optional): (num_frames x 3) positions used by the thinning. Defaults to None.
+
+        Returns:
+            array: whether each frame was admitted.
+        """
+        admitted = np.zeros(len(frame_ids), dtype=bool)
+        for i, (frame_id, descriptor) in enumerate(zip(frame_ids, descriptors)):
+            if self.is_novel(descriptor):
+                self._append(frame_id, descriptor, None if positions is None else positions[i])
+                admitted[i] = True
+                if self.max_size is not None and self.size > self.max_size:
+                    self.thin(int(self.thin_ratio * self.max_size))
+        return admitted
+
+    def _thin_criterion(self):
+        has_positions = self.positions is not None and not np.isnan(self.positions[:self.size]).any()
+        if self.thin_by is None:
+            return 'spatial' if has_positions else 'descriptor'
+        if self.thin_by == 'spatial' and not has_positions:
+            raise ValueError('The spatial thinning needs the position of every keyframe')
+        return self.thin_by
+
+    def _gaps(self, i, j, criterion):
+        """Distances between the keyframes i and j (arrays of indices) for the thinning criterion"""
+        if criterion == 'spatial':
+            return np.linalg.norm(self.positions[i] - self.positions[j], axis=-1)
+        if criterion == 'temporal':
+            return np.abs(self.frame_ids[i] - self.frame_ids[j]).astype(np.float64)
+        return 1 - np.einsum('ij,ij->i', self.descriptors[i], self.descriptors[j])
+
+    def _gap(self, i, j, criterion):
+        """Distance between the keyframes i and j (one pair, without the overhead of _gaps)"""
+        if criterion == 'spatial':
+            return float(np.linalg.norm(self.positions[i] - self.positions[j]))
+        if criterion == 'temporal':
+            return float(abs(self.frame_ids[i] - self.frame_ids[j]))
+        return float(1 - self.descriptors[i] @ self.descriptors[j])
+
+    def thin(self, target_size):
+        """Removes the most redundant keyframes until target_size are left"""
+        n = self.size
+        if n <= max(target_size, 2):
+            return
+        criterion = self._thin_criterion()
+        # doubly linked list of the kept keyframes, gaps[i] is the distance to the previous kept one
+        # (python lists, the loop below touches single elements)
+        prev, nxt = list(range(-1, n - 1)), list(range(1, n + 1))
+        gaps = [np.inf] + self._gaps(np.arange(1, n), np.arange(n - 1), criterion).tolist() + [np.inf]
+        # removing i leaves a gap of about gaps[i] + gaps[nxt[i]], the endpoints are never removed
+        scores = [np.inf] + [gaps[i] + gaps[i + 1] for i in range(1, n - 1)] + [np.inf]
+        keep = np.ones(n, dtype=bool)
+
+        # min-heap of (score, keyframe), the entries of removed keyframes and the outdated
+        # scores are left in the heap and skipped when popped
+        heap = [(scores[i], i) for i in range(1, n - 1)]
+        heapq.heapify(heap)
+        num_removed = 0
+        while num_removed < n - target_size and heap:
+            score, i = heapq.heappop(heap)
+            if score != scores[i] or not keep[i]:
+                continue
+            keep[i] = False
+            num_removed += 1
+            p, q = prev[i], nxt[i]
+            nxt[p], prev[q] = q, p
+            gaps[q] = self._gap(p, q, criterion)
+            if prev[p] >= 0:
+                scores[p] = gaps[p] + gaps[q]
+                heapq.heappush(heap, (scores[p], p))
+            if nxt[q] < n:
+                scores[q] = gaps[q] + gaps[nxt[q]]
+                heapq.heappush(heap, (scores[q], q))
+
+        # compact the kept keyframes at the start of the arrays
+        kept = np.flatnonzero(keep)
+        self.descriptors[:len(kept)] = self.descriptors[kept]
+        self.frame_ids[:len(kept)] = self.frame_ids[kept]
+        if self.positions is not None:
+            self.positions[:len(kept)] = self.positions[kept]
+        self.size = len(kept)
+
+    def search(self, frame_ids, descriptors, top_k, sim_threshold=None, frame_distance=None, causal=True):
+        """Loop candidates of a batch of frames among the keyframes (the frames of the batch are not candidates)"""
+        similarity = descriptors @ self.descriptors[:self.size].T
+        return find_loop_candidates(similarity, top_k=top_k, sim_threshold=sim_threshold,
+                                    frame_distance=frame_distance, causal=causal,
+                                    query_ids=frame_ids, db_ids=self.frame_ids[:self.size])
+
+
+def build_keyframe_database(descriptors, frame_ids=None, positions=None, **policy):
+    """Inserts the frames of a sequence in order into a KeyframeDatabase, ex. to search
+    the admitted keyframes only instead of all the frames (see calc_sim.py and demo.py)
+
+    Args:
+        descriptors (array): (num_frames x feature_dim) L2 normalized descriptors.
+        frame_ids (array, optional): frame id of each frame. Defaults to 0..num_frames-1.
+        positions (array, optional): (num_frames x 3) positions for the spatial thinning. Defaults to None.
+        **policy: novelty_threshold, novelty_window, max_size, thin_ratio and thin_by of the KeyframeDatabase.
+
+    Returns:
+        KeyframeDatabase: the database, its keyframes() are the frame ids and descriptors to search.
+    """
+    frame_ids = np.arange(len(descriptors)) if frame_ids is None else np.asarray(frame_ids)
+    database = KeyframeDatabase(descriptors.shape[1], **policy)
+    database.insert(frame_ids, np.asarray(descriptors, dtype=np.float32), positions)
+    return database
+
+
+def recall_vs_database_size(descriptors, ground_truth, frame_distance=50, positions=None, **policy):
+    """Runs the frames of a sequence through a KeyframeDatabase, querying every frame before its insertion
+
+    Args:
+        descriptors (array): (num_frames x feature_dim) L2 normalized descriptors of the sequence.
+        ground_truth (GroundTruth): the loop-closure ground truth of the sequence.
+        frame_distance (int, optional): the frames within frame_distance of a query are not candidates. Defaults to 50.
+        positions (array, optional): (num_frames x 3) positions for the spatial thinning. Defaults to None.
+        **policy: novelty_threshold, novelty_window, max_size, thin_ratio and thin_by of the KeyframeDatabase.
+
+    Returns:
+        dict: the final and peak database sizes, its memory in MB, the max recall at 100% precision
+              and the average precision of the best candidate of each frame.
+    """
+    num_frames = len(descriptors)
+    database = KeyframeDatabase(descriptors.shape[1], **policy)
+    # the frames of a batch are within frame_distance of each other, so querying a whole batch
+    # before inserting it gives the same candidates as querying the frames one by one
+    batch_size = max(frame_distance, 1)
+    query_ids, candidate_ids, scores = [], [], []
+    peak_size = 0
+    for start in range(0, num_frames, batch_size):
+        frame_ids = np.arange(start, min(start + batch_size, num_frames))
+        batch = np.asarray(descriptors[frame_ids], dtype=np.float32)
+        if len(database):
+            candidates = database.search(frame_ids, batch, top_k=1, frame_distance=frame_distance)
+            query_ids.append(candidates.flat_query_ids())
+            candidate_ids.append(candidates.indices)
+            scores.append(candidates.scores)
+        database.insert(frame_ids, batch, None if positions is None else positions[frame_ids])
+        peak_size = max(peak_size, len(database))
+
+    num_positives = num_loop_queries(ground_truth, frame_distance, causal=True, num_queries=num_frames)
+    if query_ids:
+        results = evaluate(np.concatenate(query_ids), np.concatenate(candidate_ids), np.concatenate(scores),
+                           ground_truth, num_positives)
+    else:
+        results = {'max_recall_at_100_precision': 0., 'average_precision': 0.}
+    return {'database_size': len(database),
+            'peak_size': peak_size,
+            'memory_mb': database.nbytes() / 2**20,
+            'max_recall_at_100_precision': results['max_recall_at_100_precision'],
+            'average_precision': results['average_precision']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recall versus keyframe database size on KITTI sequences')
+    parser.add_argument('--descriptors', type=str, required=True, help='.npy descriptors path, {seq} is replaced by the sequence')
+    parser.add_argument('--ground_truth', type=str, required=True, help='.mat ground truth path, {seq} is replaced by the sequence')
+    parser.add_argument('--sequences', type=str, nargs='+', default=['00', '02', '05', '08'])
+    parser.add_argument('--novelty_thresholds', type=float, nargs='+', default=[1.0, 0.95, 0.9, 0.8])
+    parser.add_argument('--max_sizes', type=int, nargs='+', default=[0], help='0 for no cap')
+    parser.add_argument('--novelty_window', type=int, default=10)
+    parser.add_argument('--thin_by', type=str, default=None, choices=['descriptor', 'spatial', 'temporal'],
+                        help='gap between the keyframes used by the thinning (default: descriptor)')
+    parser.add_argument('--frame_distance', type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'seq':>4} {'novelty':>8} {'max_size':>8} {'size':>6} {'peak':>6} {'MB':>8} {'R@100P':>8} {'AP':>8}")
+    for seq in args.sequences:
+        descriptors = np.load(args.descriptors.format(seq=seq), mmap_mode='r')
+        ground_truth = load_ground_truth(args.ground_truth.format(seq=seq))
+        for novelty_threshold in args.novelty_thresholds:
+            for max_size in args.max_sizes:
+                r = recall_vs_database_size(descriptors, ground_truth, args.frame_distance,
+                                            novelty_threshold=novelty_threshold,
+                                            novelty_window=args.novelty_window,
+                                            max_size=max_size or None,
+                                            thin_by=args.thin_by)
+                print(f"{seq:>4} {novelty_threshold:>8.2f} {max_size or '-':>8} {r['database_size']:>6} "
+                      f"{r['peak_size']:>6} {r['memory_mb']:>8.1f} {r['max_recall_at_100_precision']:>8.4f} "
+                      f"{r['average_precision']:>8.4f}")
+
+
+if __name__ == '__main__':
+    main()
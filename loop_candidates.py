@@ -0,0 +1,111 @@
+""" Loop-candidate queries over a whole similarity matrix at once.
+
+For every query (row) the candidates are the database frames (columns) that pass all the rules:
+    - exclusion window: frames within frame_distance of the query are not candidates,
+    - causal: only the frames before the query are candidates (online SLAM),
+    - threshold: the similarity must be at least sim_threshold,
+    - top-k: only the top_k most similar remaining frames are kept.
+The rows are processed in blocks, so the memory stays bounded for long sequences, and the
+result is a compact ragged array (offsets, indices, scores) sorted by decreasing score.
+
+Example:
+    candidates = find_loop_candidates(similarity, top_k=10, frame_distance=50, causal=True)
+    indices, scores = candidates[1500]   # candidates of query 1500
+"""
+import numpy as np
+
+
+class LoopCandidates:
+    """Ragged array of loop candidates, the candidates of the i-th query are
+    indices[offsets[i]:offsets[i+1]] (database frame ids), by decreasing score.
+
+    Args:
+        query_ids (array): frame id of each query.
+        offsets (array): of size len(query_ids) + 1.
+        indices (array): database frame id of each candidate.
+        scores (array): similarity of each candidate.
+    """
+    def __init__(self, query_ids, offsets, indices, scores):
+        self.query_ids = query_ids
+        self.offsets = offsets
+        self.indices = indices
+        self.scores = scores
+
+    def __len__(self):
+        return len(self.query_ids)
+
+    def __getitem__(self, i):
+        """(indices, scores) of the i-th query"""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.indices[start:end], self.scores[start:end]
+
+    def num_candidates(self):
+        return np.diff(self.offsets)
+
+    def flat_query_ids(self):
+        """The query frame id of each candidate, ex. to evaluate the candidates as (query, candidate) pairs"""
+        return np.repeat(self.query_ids, self.num_candidates())
+
+
+def find_loop_candidates(similarity, top_k=None, sim_threshold=None, frame_distance=None, causal=False,
+                         query_ids=None, db_ids=None, block_size=1024):
+    """Loop candidates of all the queries of a similarity matrix
+
+    Args:
+        similarity (array): (num_queries x num_db) similarity matrix, can be a memmap.
+        top_k (int, optional): maximum number of candidates per query. Defaults to None (no limit).
+        sim_threshold (float, optional): minimum similarity of a candidate. Defaults to None.
+        frame_distance (int, optional): frames with |db_id - query_id| <= frame_distance are excluded
+                                        (0 excludes the query itself). Defaults to None (no exclusion).
+        causal (bool, optional): only frames before the query are candidates. Defaults to False.
+        query_ids (array, optional): frame id of each row. Defaults to 0..num_queries-1.
+        db_ids (array, optional): frame id of each column. Defaults to 0..num_db-1.
+        block_size (int, optional): number of rows processed at once. Defaults to 1024.
+
+    Returns:
+        LoopCandidates: the candidates of each query, by decreasing similarity.
+    """
+    num_queries, num_db = similarity.shape
+    query_ids = np.arange(num_queries) if query_ids is None else np.asarray(query_ids)
+    db_ids = np.arange(num_db) if db_ids is None else np.asarray(db_ids)
+    k = num_db if top_k is None else min(top_k, num_db)
+
+    counts, indices, scores = [], [], []
+    for start in range(0, num_queries, block_size):
+        end = min(start + block_size, num_queries)
+        block = np.array(similarity[start:end], dtype=np.float32)
+        rows = query_ids[start:end, None]
+
+        # the rules are applied together by masking the rejected frames
+        rejected = np.zeros(block.shape, dtype=bool)
+        if frame_distance is not None:
+            rejected |= np.abs(db_ids[None, :] - rows) <= frame_distance
+        if causal:
+            rejected |= db_ids[None, :] > rows
+        if sim_threshold is not None:
+            rejected |= block < sim_threshold
+        block[rejected] = -np.inf
+
+        # top-k of each row (argpartition, then sorted by decreasing similarity)
+        if k < num_db:
+            top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(num_db), block.shape)
+        top_scores = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        # the rejected frames are -inf, they are sorted last
+        valid = np.isfinite(top_scores)
+        counts.append(valid.sum(1))
+        indices.append(db_ids[top[valid]])
+        scores.append(top_scores[valid])
+
+    offsets = np.zeros(num_queries + 1, dtype=np.int64)
+    if counts:
+        np.cumsum(np.concatenate(counts), out=offsets[1:])
+    return LoopCandidates(query_ids,
+                          offsets,
+                          np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64),
+                          np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32))
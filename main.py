@@ -1,11 +1,34 @@
+import argparse
+import time
+
 import pytorch_lightning as pl
 import torch
 from pytorch_lightning.callbacks import Callback, ModelCheckpoint
+from pytorch_lightning.strategies import DDPStrategy
 from torch.optim import lr_scheduler, optimizer
 import utils
 
-from dataloaders.GSVCitiesDataloader import GSVCitiesDataModule
+from dataloaders.StageTimer import DataPipelineMonitor
 from models import helper
+from models.batchnorm import frozen_batchnorm_stats
+
+# the values of K for which we compute recall@K during validation
+VAL_K_VALUES = [1, 5, 10, 15, 20, 50, 100]
+
+
+class FullValidationCheckpoint(ModelCheckpoint):
+    """ModelCheckpoint that only considers the epochs validated on the full validation sets.
+    On the subset epochs (see GSVCitiesDataModule.val_subset_queries) the monitored full-set key
+    is not logged, and Lightning would rank the checkpoint with the value of the last full validation.
+    """
+    # depending on the validation interval, ModelCheckpoint saves at the end of the training epoch or of the validation
+    def on_train_epoch_end(self, trainer, pl_module):
+        if getattr(trainer.datamodule, 'val_full', True):
+            super().on_train_epoch_end(trainer, pl_module)
+
+    def on_validation_end(self, trainer, pl_module):
+        if getattr(trainer.datamodule, 'val_full', True):
+            super().on_validation_end(trainer, pl_module)
 
 
 class VPRModel(pl.LightningModule):
@@ -22,6 +45,7 @@ class VPRModel(pl.LightningModule):
                 pretrained=True,
                 layers_to_freeze=1,
                 layers_to_crop=[],
+                checkpoint_layers=[], # resnet layers recomputed during backward instead of storing their activations
                 
                 #---- Aggregator
                 agg_arch='ConvAP', #CosPlace, NetVLAD, GeM
@@ -40,13 +64,25 @@ class VPRModel(pl.LightningModule):
                 loss_name='MultiSimilarityLoss', 
                 miner_name='MultiSimilarityMiner', 
                 miner_margin=0.1,
-                faiss_gpu=False
+                faiss_gpu=False,
+
+                #----- Cross-batch memory (XBM)
+                xbm_size=0, # number of past descriptors kept in memory (0 disables XBM)
+                xbm_weight=1.0, # weight of the loss computed against the memory
+                xbm_start_step=0, # start using the memory after this many steps (the descriptors drift fast early on)
+
+                #----- Gradient accumulation
+                micro_batch_size=None, # if set, the batch is processed in chunks of this many images (GradCache)
+
+                #----- Validation
+                val_streaming=False, # build the faiss index and recall counts on the fly, without keeping the descriptors
                  ):
         super().__init__()
         self.encoder_arch = backbone_arch
         self.pretrained = pretrained
         self.layers_to_freeze = layers_to_freeze
         self.layers_to_crop = layers_to_crop
+        self.checkpoint_layers = checkpoint_layers
 
         self.agg_arch = agg_arch
         self.agg_config = agg_config
@@ -67,13 +103,24 @@ class VPRModel(pl.LightningModule):
         
         self.loss_fn = utils.get_loss(loss_name)
         self.miner = utils.get_miner(miner_name, miner_margin)
-        self.batch_acc = [] # we will keep track of the % of trivial pairs/triplets at the loss level 
+        self.batch_acc = utils.RunningMean() # we will keep track of the % of trivial pairs/triplets at the loss level 
 
         self.faiss_gpu = faiss_gpu
+
+        # optional cross-batch memory, the miner and loss draw extra negatives from it
+        self.xbm_weight = xbm_weight
+        self.xbm_start_step = xbm_start_step
+        self.xbm = utils.CrossBatchMemory(xbm_size) if xbm_size > 0 else None
+
+        # with micro-batching we do the backward passes ourselves (see micro_batch_training_step)
+        self.micro_batch_size = micro_batch_size
+        self.automatic_optimization = micro_batch_size is None
+
+        self.val_streaming = val_streaming
         
         # ----------------------------------
         # get the backbone and the aggregator
-        self.backbone = helper.get_backbone(backbone_arch, pretrained, layers_to_freeze, layers_to_crop)
+        self.backbone = helper.get_backbone(backbone_arch, pretrained, layers_to_freeze, layers_to_crop, checkpoint_layers)
         self.aggregator = helper.get_aggregator(agg_arch, agg_config)
         
     # the forward pass of the lightning model
@@ -106,43 +153,64 @@ class VPRModel(pl.LightningModule):
     def optimizer_step(self,  epoch, batch_idx,
                         optimizer, optimizer_idx, optimizer_closure,
                         on_tpu, using_native_amp, using_lbfgs):
+        self.warmup_lr(optimizer)
+        optimizer.step(closure=optimizer_closure)
+
+    def warmup_lr(self, optimizer):
         # warm up lr
         if self.trainer.global_step < self.warmpup_steps:
             lr_scale = min(1., float(self.trainer.global_step + 1) / self.warmpup_steps)
             for pg in optimizer.param_groups:
                 pg['lr'] = lr_scale * self.lr
-        optimizer.step(closure=optimizer_closure)
         
     #  The loss function call (this method will be called at each training iteration)
     def loss_function(self, descriptors, labels):
-        # we mine the pairs/triplets if there is an online mining strategy
-        if self.miner is not None:
-            miner_outputs = self.miner(descriptors, labels)
-            loss = self.loss_fn(descriptors, labels, miner_outputs)
+        # mining and the loss are computed in float32, even under autocast (bf16/fp16),
+        # the exponentials of losses like MultiSimilarityLoss overflow or lose precision otherwise
+        with torch.autocast(device_type=descriptors.device.type, enabled=False):
+            descriptors = descriptors.float()
+            # we mine the pairs/triplets if there is an online mining strategy
+            if self.miner is not None:
+                miner_outputs = self.miner(descriptors, labels)
+                loss = self.loss_fn(descriptors, labels, miner_outputs)
             
-            # calculate the % of trivial pairs/triplets 
-            # which do not contribute in the loss value
-            nb_samples = descriptors.shape[0]
-            nb_mined = len(set(miner_outputs[0].detach().cpu().numpy()))
-            batch_acc = 1.0 - (nb_mined/nb_samples)
-
-        else: # no online mining
-            loss = self.loss_fn(descriptors, labels)
-            batch_acc = 0.0
-            if type(loss) == tuple: 
-                # somes losses do the online mining inside (they don't need a miner objet), 
-                # so they return the loss and the batch accuracy
-                # for example, if you are developping a new loss function, you might be better
-                # doing the online mining strategy inside the forward function of the loss class, 
-                # and return a tuple containing the loss value and the batch_accuracy (the % of valid pairs or triplets)
-                loss, batch_acc = loss
-
-        # keep accuracy of every batch and later reset it at epoch start
-        self.batch_acc.append(batch_acc)
-        # log it
-        self.log('b_acc', sum(self.batch_acc) /
-                len(self.batch_acc), prog_bar=True, logger=True)
-        return loss
+                # calculate the % of trivial pairs/triplets 
+                # which do not contribute in the loss value (on device, without syncing)
+                batch_acc = utils.mined_batch_accuracy(miner_outputs, descriptors.shape[0])
+
+            else: # no online mining
+                loss = self.loss_fn(descriptors, labels)
+                batch_acc = 0.0
+                if type(loss) == tuple: 
+                    # somes losses do the online mining inside (they don't need a miner objet), 
+                    # so they return the loss and the batch accuracy
+                    # for example, if you are developping a new loss function, you might be better
+                    # doing the online mining strategy inside the forward function of the loss class, 
+                    # and return a tuple containing the loss value and the batch_accuracy (the % of valid pairs or triplets)
+                    loss, batch_acc = loss
+
+            if self.xbm is not None:
+                # the current batch is added first so the miner sees its positives, but only
+                # the pairs with the past batches are kept (the in-batch pairs are already in loss)
+                positions = self.xbm.enqueue(descriptors, labels)
+                if self.global_step >= self.xbm_start_step:
+                    xbm_loss = self.xbm_loss_function(descriptors, labels, positions)
+                    loss = loss + self.xbm_weight * xbm_loss
+                    self.log('xbm_loss', xbm_loss.detach(), logger=True)
+
+            # keep the running accuracy of the epoch and later reset it at epoch start
+            self.batch_acc.update(batch_acc)
+            # log it (also in the progress bar) only at the logging intervals, the progress bar
+            # moves the value to the host, so logging it at every step would sync every step
+            trainer = self._trainer
+            if trainer is None or trainer.global_step % trainer.log_every_n_steps == 0:
+                self.log('b_acc', self.batch_acc.compute().detach(), prog_bar=True, logger=True)
+            return loss
+    
+    # The loss between the current batch and the descriptors stored in the cross-batch memory
+    # (positions are the memory slots of the current batch, the pairs with these slots are dropped)
+    def xbm_loss_function(self, descriptors, labels, positions):
+        return utils.xbm_loss(self.xbm, descriptors, labels, positions, self.loss_fn, self.miner)
     
     # This is the training step that's executed at each iteration
     def training_step(self, batch, batch_idx):
@@ -156,25 +224,118 @@ class VPRModel(pl.LightningModule):
         images = places.view(BS*N, ch, h, w)
         labels = labels.view(-1)
 
-        # Feed forward the batch to the model
-        descriptors = self(images) # Here we are calling the method forward that we defined above
-        loss = self.loss_function(descriptors, labels) # Call the loss_function we defined above
+        if self.micro_batch_size is not None:
+            loss = self.micro_batch_training_step(images, labels)
+        else:
+            # Feed forward the batch to the model
+            descriptors = self(images) # Here we are calling the method forward that we defined above
+            loss = self.loss_function(descriptors, labels) # Call the loss_function we defined above
         
-        self.log('loss', loss.item(), logger=True)
+        self.log('loss', loss.detach(), logger=True)
         return {'loss': loss}
     
+    def micro_batch_training_step(self, images, labels):
+        """Training step with gradient caching (as in https://arxiv.org/abs/2101.06983),
+        used when the full batch does not fit in memory. Mining and loss still see the full
+        logical batch, so the gradients are the same as with one big forward/backward pass
+        (up to BatchNorm statistics, which are computed per micro-batch).
+        The BatchNorm running statistics are frozen during the first pass, so they are updated
+        once per micro-batch (by the recompute), not twice.
+
+        1. compute the descriptors chunk by chunk without storing activations
+        2. compute the loss on all descriptors and its gradient w.r.t. the descriptors
+        3. recompute each chunk with autograd and backpropagate its slice of that gradient
+        """
+        optimizer = self.optimizers()
+        chunks = images.split(self.micro_batch_size)
+
+        with torch.no_grad(), frozen_batchnorm_stats(self):
+            descriptors = torch.cat([self(chunk) for chunk in chunks])
+
+        descriptors = descriptors.float().requires_grad_()
+        loss = self.loss_function(descriptors, labels)
+        descriptors_grad, = torch.autograd.grad(loss, descriptors)
+
+        optimizer.zero_grad()
+        for chunk, chunk_grad in zip(chunks, descriptors_grad.split(self.micro_batch_size)):
+            self.manual_backward(torch.sum(self(chunk).float() * chunk_grad))
+        self.warmup_lr(optimizer)
+        optimizer.step()
+        return loss.detach()
+
     # This is called at the end of eatch training epoch
     def training_epoch_end(self, training_step_outputs):
-        # we empty the batch_acc list for next epoch
-        self.batch_acc = []
+        # we reset the batch_acc running mean for next epoch
+        self.batch_acc.reset()
+        # with manual optimization, Lightning leaves the lr scheduler to us
+        if not self.automatic_optimization:
+            self.lr_schedulers().step()
+
+    # This is called at the start of each validation epoch
+    def on_validation_epoch_start(self):
+        # we time the whole validation pass (feature extraction + recall@K)
+        self.val_start_time = time.perf_counter()
+
+        if self.val_streaming:
+            dm = self.trainer.datamodule
+            self.streaming_recalls = []
+            for val_set_name, val_dataset in zip(dm.val_set_names, dm.current_val_datasets()):
+                num_references, positives = utils.get_references_and_positives(val_set_name, val_dataset)
+                self.streaming_recalls.append(utils.StreamingRecall(num_references=num_references,
+                                                                    num_queries=len(val_dataset)-num_references,
+                                                                    gt=positives,
+                                                                    k_values=VAL_K_VALUES,
+                                                                    faiss_gpu=self.faiss_gpu))
 
     # For validation, we will also iterate step by step over the validation set
     # this is the way Pytorch Lghtning is made. All about modularity, folks.
     def validation_step(self, batch, batch_idx, dataloader_idx=None):
-        places, _ = batch
+        places, indices = batch
         # calculate descriptors
         descriptors = self(places)
-        return descriptors.detach().cpu()
+        if self.val_streaming:
+            self.streaming_validation_step(descriptors.detach(), indices, dataloader_idx or 0)
+            return None
+        # we keep the dataset indices, with DDP each rank only sees a shard of the dataset
+        return descriptors.detach().cpu(), indices.cpu()
+
+    def streaming_validation_step(self, descriptors, indices, dataloader_idx):
+        streaming_recall = self.streaming_recalls[dataloader_idx]
+        if self.trainer.world_size > 1:
+            # every rank needs all the references in its index, so we gather them at each step
+            # (the ranks see their last references at the same step, before any query is searched)
+            all_feats = self.all_gather(descriptors).flatten(0, 1).float().cpu().numpy()
+            all_indices = self.all_gather(indices).flatten(0, 1).cpu().numpy()
+            is_ref = all_indices < streaming_recall.num_references
+            streaming_recall.add_references(all_feats[is_ref], all_indices[is_ref])
+        # local references that were already added are skipped, local queries are searched
+        streaming_recall.update(descriptors.float().cpu().numpy(), indices.cpu().numpy())
+
+    def compute_streaming_recalls(self, streaming_recall, val_set_name):
+        if self.trainer.world_size > 1:
+            # each rank searched its own queries, we sum the counts of all ranks
+            counts = torch.tensor(list(streaming_recall.correct_at_k) + [streaming_recall.num_queries],
+                                  dtype=torch.float64, device=self.device)
+            counts = self.all_gather(counts).sum(0).cpu().numpy()
+            streaming_recall.correct_at_k, streaming_recall.num_queries = counts[:-1], counts[-1]
+        return streaming_recall.compute(print_results=self.trainer.is_global_zero, dataset_name=val_set_name)
+
+    def gather_val_descriptors(self, outputs, dataset_len):
+        """Returns the descriptors of the whole validation set in dataset index order.
+        With DDP, each rank computed the descriptors of its own shard (DistributedSampler),
+        so we gather the shards of all ranks before reordering them.
+        """
+        feats = torch.concat([f for f, _ in outputs], dim=0)
+        indices = torch.concat([idx for _, idx in outputs], dim=0)
+        if self.trainer.world_size > 1:
+            # all ranks hold the same number of samples (the sampler pads the last shards),
+            # and the tensors have to live on the device of the process group backend
+            feats = self.all_gather(feats.to(self.device)).flatten(0, 1).cpu()
+            indices = self.all_gather(indices.to(self.device)).flatten(0, 1).cpu()
+        # the samples duplicated by the padding just overwrite themselves
+        ordered_feats = torch.zeros((dataset_len, feats.shape[1]), dtype=feats.dtype)
+        ordered_feats[indices] = feats
+        return ordered_feats
     
     def validation_epoch_end(self, val_step_outputs):
         """this return descriptors in their order
@@ -183,47 +344,69 @@ class VPRModel(pl.LightningModule):
         [R1, R2, ..., Rn, Q1, Q2, ...]
         """
         dm = self.trainer.datamodule
+        # the full validation sets, or their subsets on the epochs with partial validation
+        val_datasets = dm.current_val_datasets()
         # The following line is a hack: if we have only one validation set, then
         # we need to put the outputs in a list (Pytorch Lightning does not do it presently)
-        if len(dm.val_datasets)==1: # we need to put the outputs in a list
+        if len(val_datasets)==1: # we need to put the outputs in a list
             val_step_outputs = [val_step_outputs]
         
-        for i, (val_set_name, val_dataset) in enumerate(zip(dm.val_set_names, dm.val_datasets)):
-            feats = torch.concat(val_step_outputs[i], dim=0)
-            
-            if 'pitts' in val_set_name:
-                # split to ref and queries
-                num_references = val_dataset.dbStruct.numDb
-                num_queries = len(val_dataset)-num_references
-                positives = val_dataset.getPositives()
-            elif 'msls' in val_set_name:
-                # split to ref and queries
-                num_references = val_dataset.num_references
-                num_queries = len(val_dataset)-num_references
-                positives = val_dataset.pIdx
+        for i, (val_set_name, val_dataset) in enumerate(zip(dm.val_set_names, val_datasets)):
+            if self.val_streaming:
+                pitts_dict = self.compute_streaming_recalls(self.streaming_recalls[i], val_set_name)
             else:
-                print(f'Please implement validation_epoch_end for {val_set_name}')
-                raise NotImplemented
-
-            r_list = feats[ : num_references]
-            q_list = feats[num_references : ]
-            pitts_dict = utils.get_validation_recalls(r_list=r_list, 
-                                                q_list=q_list,
-                                                k_values=[1, 5, 10, 15, 20, 50, 100],
-                                                gt=positives,
-                                                print_results=True,
-                                                dataset_name=val_set_name,
-                                                faiss_gpu=self.faiss_gpu
-                                                )
-            del r_list, q_list, feats, num_references, positives
-
-            self.log(f'{val_set_name}/R1', pitts_dict[1], prog_bar=False, logger=True)
-            self.log(f'{val_set_name}/R5', pitts_dict[5], prog_bar=False, logger=True)
-            self.log(f'{val_set_name}/R10', pitts_dict[10], prog_bar=False, logger=True)
-        print('\n\n')
+                feats = self.gather_val_descriptors(val_step_outputs[i], len(val_dataset))
+
+                # split to ref and queries
+                num_references, positives = utils.get_references_and_positives(val_set_name, val_dataset)
+
+                r_list = feats[ : num_references]
+                q_list = feats[num_references : ]
+                pitts_dict = utils.get_validation_recalls(r_list=r_list, 
+                                                    q_list=q_list,
+                                                    k_values=VAL_K_VALUES,
+                                                    gt=positives,
+                                                    print_results=self.trainer.is_global_zero,
+                                                    dataset_name=val_set_name,
+                                                    faiss_gpu=self.faiss_gpu
+                                                    )
+                del r_list, q_list, feats, num_references, positives
+
+            # the recalls of a subset are noisier and biased upward (its queries are searched among fewer references),
+            # they are logged under their own keys, {val_set_name}/R1 is only logged on full validations
+            suffix = '' if dm.val_full else '_subset'
+            self.log(f'{val_set_name}/R1{suffix}', pitts_dict[1], prog_bar=False, logger=True)
+            self.log(f'{val_set_name}/R5{suffix}', pitts_dict[5], prog_bar=False, logger=True)
+            self.log(f'{val_set_name}/R10{suffix}', pitts_dict[10], prog_bar=False, logger=True)
+            if not dm.val_full:
+                # standard error of the subset R1 w.r.t. the recall of the full set
+                num_references, _ = utils.get_references_and_positives(val_set_name, val_dataset)
+                num_queries = len(val_dataset) - num_references
+                self.log(f'{val_set_name}/R1_stderr', utils.recall_stderr(pitts_dict[1], num_queries,
+                                                                          val_dataset.full_num_queries),
+                         prog_bar=False, logger=True)
+
+        val_time = time.perf_counter() - self.val_start_time
+        self.log('val_time', val_time, prog_bar=False, logger=True)
+        self.log('val_full', float(dm.val_full), prog_bar=False, logger=True)
+        if self.trainer.is_global_zero:
+            print(f'Validation wall time: {val_time:.1f}s')
+            print('\n\n')
             
             
 if __name__ == '__main__':
+    # imported here, the dataset modules check their hardcoded paths at import time
+    # and VPRModel should be importable without them (ex. in demo.py or benchmark.py)
+    from dataloaders.GSVCitiesDataloader import GSVCitiesDataModule
+
+    parser = argparse.ArgumentParser(description='Trains a VPR model on GSV-Cities')
+    parser.add_argument('--devices', type=int, default=1,
+                        help='number of GPUs (or CPU processes without GPU), more than 1 trains with DDP')
+    parser.add_argument('--async_validation', action='store_true',
+                        help='validate the checkpoint of each epoch in a separate process (see utils.AsyncValidation), '
+                             'training does not wait: no in-loop validation, AsyncValidation keeps the best checkpoints')
+    args = parser.parse_args()
+
     pl.utilities.seed.seed_everything(seed=190223, workers=True)
         
     datamodule = GSVCitiesDataModule(
@@ -236,6 +419,11 @@ if __name__ == '__main__':
         num_workers=28,
         show_data_stats=True,
         val_set_names=['pitts30k_val', 'pitts30k_test', 'msls_val'], # pitts30k_val, pitts30k_test, msls_val
+        val_cache_dir=None, # ex. './LOGS/val_cache' to decode and resize validation images only once
+        val_cache_dtype='uint8', # uint8 (resized images) or float16 (normalized tensors)
+        profile_data=False, # log per-stage data loading times and the data-wait fraction
+        val_subset_queries=None, # ex. 1000 to validate on 1000 queries per set, except every full_val_every_n_epochs
+        full_val_every_n_epochs=5,
     )
     
     # examples of backbones
@@ -249,6 +437,7 @@ if __name__ == '__main__':
         pretrained=True,
         layers_to_freeze=2,
         layers_to_crop=[4], # 4 crops the last resnet layer, 3 crops the 3rd, ...etc
+        checkpoint_layers=[], # ex. [3] to trade layer3 activations memory for recomputation (bigger batches)
         
         #---- Aggregator
         # agg_arch='CosPlace',
@@ -268,7 +457,8 @@ if __name__ == '__main__':
                 'out_channels' : 1024,
                 'mix_depth' : 4,
                 'mlp_ratio' : 1,
-                'out_rows' : 4}, # the output dim will be (out_rows * out_channels)
+                'out_rows' : 4, # the output dim will be (out_rows * out_channels)
+                'checkpointing' : False}, # recompute the mixer activations during backward (less memory)
         
         #---- Train hyperparameters
         lr=0.05, # 0.0002 for adam, 0.05 or sgd (needs to change according to batch size)
@@ -285,12 +475,23 @@ if __name__ == '__main__':
         loss_name='MultiSimilarityLoss',
         miner_name='MultiSimilarityMiner', # example: TripletMarginMiner, MultiSimilarityMiner, PairMarginMiner
         miner_margin=0.1,
-        faiss_gpu=False
+        faiss_gpu=False,
+
+        #----- Cross-batch memory
+        xbm_size=0, # ex. 8192 to mine negatives from the last ~17 batches (0 disables it)
+        xbm_weight=1.0,
+        xbm_start_step=1000,
+
+        #----- Gradient accumulation
+        micro_batch_size=None, # ex. 120 to process the 480 images of a batch in 4 chunks
+
+        #----- Validation
+        val_streaming=False, # stream descriptors into the faiss index instead of keeping them all in memory
     )
     
     # model params saving using Pytorch Lightning
-    # we save the best 3 models accoring to Recall@1 on pittsburg val
-    checkpoint_cb = ModelCheckpoint(
+    # we save the best 3 models accoring to Recall@1 on pittsburg val (full validations only)
+    checkpoint_cb = FullValidationCheckpoint(
         monitor='pitts30k_val/R1',
         filename=f'{model.encoder_arch}' +
         '_epoch({epoch:02d})_step({step:04d})_R1[{pitts30k_val/R1:.4f}]_R5[{pitts30k_val/R5:.4f}]',
@@ -299,17 +500,45 @@ if __name__ == '__main__':
         save_top_k=3,
         mode='max',)
 
+    # with async_validation, the validation runs in a separate process on the checkpoint saved at each
+    # epoch end, training doesn't wait for it. The callback also keeps the best 3 checkpoints itself.
+    # ex. python main.py --async_validation
+    async_validation = args.async_validation
+    if async_validation:
+        checkpoint_cb = utils.AsyncValidation(
+            dirpath=f'./LOGS/{model.encoder_arch}/async_validation',
+            monitor='pitts30k_val/R1',
+            save_top_k=3,
+            mode='max',
+            k_values=VAL_K_VALUES,
+            num_threads=4, # leave the other cores to the training
+            faiss_gpu=False)
+
     #------------------
+    # data parallel training: with more than one device, Lightning runs one process per device (DDP)
+    # and shards the training and validation sets between them. On CPU-only machines the processes
+    # communicate with gloo. Note that batch_size and num_workers are per process.
+    # ex. python main.py --devices 4
+    num_devices = args.devices
+    accelerator = 'gpu' if torch.cuda.is_available() else 'cpu'
+    strategy = None
+    if num_devices > 1:
+        strategy = DDPStrategy(process_group_backend='nccl' if accelerator == 'gpu' else 'gloo',
+                               find_unused_parameters=False)
+
     # we instanciate a trainer
     trainer = pl.Trainer(
-        accelerator='gpu', devices=[0],
+        accelerator=accelerator, devices=num_devices, strategy=strategy,
+        sync_batchnorm=num_devices > 1,
         default_root_dir=f'./LOGS/{model.encoder_arch}', # Tensorflow can be used to viz 
 
         num_sanity_val_steps=0, # runs a validation step before stating training
-        precision=16, # we use half precision to reduce  memory usage
+        precision=16 if accelerator == 'gpu' else 'bf16', # we use half precision to reduce memory usage, bfloat16 autocast on CPU
         max_epochs=80,
         check_val_every_n_epoch=1, # run validation every epoch
-        callbacks=[checkpoint_cb],# we only run the checkpointing callback (you can add more)
+        limit_val_batches=0 if async_validation else None, # no in-loop validation with async_validation
+        enable_checkpointing=not async_validation, # AsyncValidation saves the checkpoints instead of ModelCheckpoint
+        callbacks=[checkpoint_cb] + ([DataPipelineMonitor()] if datamodule.profile_data else []),
         reload_dataloaders_every_n_epochs=1, # we reload the dataset to shuffle the order
         log_every_n_steps=20,
         # fast_dev_run=True # uncomment or dev mode (only runs a one iteration train and validation, no checkpointing).
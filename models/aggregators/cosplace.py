@@ -11,7 +11,10 @@ class GeM(nn.Module):
         self.eps = eps
 
     def forward(self, x):
-        return F.avg_pool2d(x.clamp(min=self.eps).pow(self.p), (x.size(-2), x.size(-1))).pow(1./self.p)
+        # the pow/clamp overflow or underflow in fp16/bf16, we pool in float32 even under autocast
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x = x.float()
+            return F.avg_pool2d(x.clamp(min=self.eps).pow(self.p), (x.size(-2), x.size(-1))).pow(1./self.p)
 
 class CosPlace(nn.Module):
     """
@@ -27,11 +30,11 @@ class CosPlace(nn.Module):
         self.fc = nn.Linear(in_dim, out_dim)
 
     def forward(self, x):
-        x = F.normalize(x, p=2, dim=1)
+        x = F.normalize(x.float(), p=2, dim=1)
         x = self.gem(x)
         x = x.flatten(1)
         x = self.fc(x)
-        x = F.normalize(x, p=2, dim=1)
+        x = F.normalize(x.float(), p=2, dim=1)
         return x
 
 if __name__ == '__main__':
@@ -12,6 +12,9 @@ class GeMPool(nn.Module):
         self.eps = eps
 
     def forward(self, x):
-        x = F.avg_pool2d(x.clamp(min=self.eps).pow(self.p), (x.size(-2), x.size(-1))).pow(1./self.p)
-        x = x.flatten(1)
-        return F.normalize(x, p=2, dim=1)
\ No newline at end of file
+        # the pow/clamp overflow or underflow in fp16/bf16, we pool in float32 even under autocast
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x = x.float()
+            x = F.avg_pool2d(x.clamp(min=self.eps).pow(self.p), (x.size(-2), x.size(-1))).pow(1./self.p)
+            x = x.flatten(1)
+            return F.normalize(x, p=2, dim=1)
\ No newline at end of file
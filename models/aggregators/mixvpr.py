@@ -1,6 +1,7 @@
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 import numpy as np
 
@@ -34,6 +35,7 @@ class MixVPR(nn.Module):
                  mix_depth=1,
                  mlp_ratio=1,
                  out_rows=4,
+                 checkpointing=False,
                  ) -> None:
         super().__init__()
 
@@ -46,6 +48,7 @@ class MixVPR(nn.Module):
 
         self.mix_depth = mix_depth # L the number of stacked FeatureMixers
         self.mlp_ratio = mlp_ratio # ratio of the mid projection layer in the mixer block
+        self.checkpointing = checkpointing # recompute the activations of each mixer during backward instead of storing them
 
         hw = in_h*in_w
         self.mix = nn.Sequential(*[
@@ -57,12 +60,17 @@ class MixVPR(nn.Module):
 
     def forward(self, x):
         x = x.flatten(2)
-        x = self.mix(x)
+        if self.checkpointing and torch.is_grad_enabled():
+            for mixer in self.mix:
+                x = checkpoint(mixer, x, use_reentrant=False)
+        else:
+            x = self.mix(x)
         x = x.permute(0, 2, 1)
         x = self.channel_proj(x)
         x = x.permute(0, 2, 1)
         x = self.row_proj(x)
-        x = F.normalize(x.flatten(1), p=2, dim=-1)
+        # normalized in float32, the descriptors stay float32 under autocast
+        x = F.normalize(x.flatten(1).float(), p=2, dim=-1)
         return x
 
 
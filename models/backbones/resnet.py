@@ -3,12 +3,15 @@ import torch.nn as nn
 import torchvision
 import numpy as np
 
+from models.batchnorm import checkpoint_frozen_bn
+
 class ResNet(nn.Module):
     def __init__(self,
                  model_name='resnet50',
                  pretrained=True,
                  layers_to_freeze=2,
                  layers_to_crop=[],
+                 checkpoint_layers=[],
                  ):
         """Class representing the resnet backbone used in the pipeline
         we consider resnet network as a list of 5 blocks (from 0 to 4),
@@ -20,6 +23,9 @@ class ResNet(nn.Module):
             pretrained (bool, optional): Whether pretrained or not. Defaults to True.
             layers_to_freeze (int, optional): The number of residual blocks to freeze (starting from 0) . Defaults to 2.
             layers_to_crop (list, optional): Which residual layers to crop, for example [3,4] will crop the third and fourth res blocks. Defaults to [].
+            checkpoint_layers (list, optional): Which residual layers to run with activation checkpointing, for example [3]
+                                                only keeps the input of layer3 and recomputes its activations during the backward pass
+                                                (the recomputation doesn't update the BatchNorm running stats again). Defaults to [].
 
         Raises:
             NotImplementedError: if the model_name corresponds to an unknown architecture. 
@@ -27,6 +33,7 @@ class ResNet(nn.Module):
         super().__init__()
         self.model_name = model_name.lower()
         self.layers_to_freeze = layers_to_freeze
+        self.checkpoint_layers = checkpoint_layers
 
         if pretrained:
             # the new naming of pretrained weights, you can change to V2 if desired.
@@ -86,17 +93,23 @@ class ResNet(nn.Module):
         self.out_channels = out_channels // 2 if self.model.layer4 is None else out_channels
         self.out_channels = self.out_channels // 2 if self.model.layer3 is None else self.out_channels
 
+        # the (index, layer) pairs run by forward, without the cropped layers. This is a plain list
+        # (not a ModuleList), the layers are already registered in self.model and the state_dict keys don't change
+        stem = nn.Sequential(self.model.conv1, self.model.bn1, self.model.relu, self.model.maxpool)
+        layers = [stem, self.model.layer1, self.model.layer2, self.model.layer3, self.model.layer4]
+        self.layers = [(i, layer) for i, layer in enumerate(layers) if layer is not None]
+
     def forward(self, x):
-        x = self.model.conv1(x)
-        x = self.model.bn1(x)
-        x = self.model.relu(x)
-        x = self.model.maxpool(x)
-        x = self.model.layer1(x)
-        x = self.model.layer2(x)
-        if self.model.layer3 is not None:
-            x = self.model.layer3(x)
-        if self.model.layer4 is not None:
-            x = self.model.layer4(x)
+        grad_enabled = torch.is_grad_enabled()
+        for i, layer in self.layers:
+            # the frozen prefix (layers without trainable parameters, with an input that doesn't require grad)
+            # has nothing to backpropagate into, so we run it without building the graph
+            needs_grad = grad_enabled and (x.requires_grad or any(p.requires_grad for p in layer.parameters()))
+            with torch.set_grad_enabled(needs_grad):
+                if needs_grad and i in self.checkpoint_layers:
+                    x = checkpoint_frozen_bn(layer, x)
+                else:
+                    x = layer(x)
         return x
 
 
@@ -0,0 +1,40 @@
+from contextlib import contextmanager
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+
+@contextmanager
+def frozen_batchnorm_stats(module):
+    """BatchNorm layers still normalize with the batch statistics (train mode),
+    but their running statistics are not updated (momentum 0, counters restored).
+    """
+    bns = [m for m in module.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm) and m.training]
+    saved = [(m.momentum, None if m.num_batches_tracked is None else m.num_batches_tracked.clone()) for m in bns]
+    for m in bns:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(bns, saved):
+            m.momentum = momentum
+            if num_batches_tracked is not None:
+                m.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def checkpoint_frozen_bn(module, x):
+    """Activation checkpointing of module, where the forward recomputed during the backward pass
+    doesn't update the BatchNorm running statistics again (they are updated once per step,
+    as without checkpointing).
+    """
+    recomputing = False
+
+    def run(x):
+        nonlocal recomputing
+        if recomputing:
+            with frozen_batchnorm_stats(module):
+                return module(x)
+        recomputing = True
+        return module(x)
+
+    return checkpoint(run, x, use_reentrant=False)
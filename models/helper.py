@@ -6,7 +6,8 @@ from models import backbones
 def get_backbone(backbone_arch='resnet50',
                  pretrained=True,
                  layers_to_freeze=2,
-                 layers_to_crop=[],):
+                 layers_to_crop=[],
+                 checkpoint_layers=[],):
     """Helper function that returns the backbone given its name
 
     Args:
@@ -16,14 +17,19 @@ def get_backbone(backbone_arch='resnet50',
         layers_to_crop (list, optional): This is mostly used with ResNet where 
                                          we sometimes need to crop the last 
                                          residual block (ex. [4]). Defaults to [].
+        checkpoint_layers (list, optional): ResNet residual layers to run with activation
+                                            checkpointing (ex. [3]). Defaults to [].
 
     Returns:
         nn.Module: the backbone as a nn.Model object
     """
-    if 'resnet' in backbone_arch.lower():
-        return backbones.ResNet(backbone_arch, pretrained, layers_to_freeze, layers_to_crop)
+    if 'resnet' in backbone_arch.lower() or 'resnext' in backbone_arch.lower():
+        return backbones.ResNet(backbone_arch, pretrained, layers_to_freeze, layers_to_crop, checkpoint_layers)
 
-    elif 'efficient' in backbone_arch.lower():
+    if checkpoint_layers:
+        raise NotImplementedError('Activation checkpointing is only implemented for the ResNet backbones')
+
+    if 'efficient' in backbone_arch.lower():
         if '_b' in backbone_arch.lower():
             return backbones.EfficientNet(backbone_arch, pretrained, layers_to_freeze+2)
         else:
@@ -6,38 +6,26 @@ import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
 import math
 
+from ground_truth import GroundTruth
+
 sequence = '08'
 
-# Load the .mat file
-mat_file = sio.loadmat('/home/java/AnyFeature-Benchmark/KITTI/KITTI_GroundTruth/kitti'+ sequence + 'GroundTruth.mat')
 ## kittiXXGroundTruth.mat is a binary matrix with size of N x N, where N is the number of images. 
 #Entry (i,j) of the matrix is 0 if image i and image j were taken at the different places. 
 #When entry (i,j) is equal to 1, it indicates that image i and image j are regareded as the same place, i.e. a loop closure.
 mat_file2 = sio.loadmat('/home/java/AnyFeature-Benchmark/KITTI/KITTI_GroundTruth/gnd_kitti'+ sequence + '.mat')
 ## gnd_kittiXX.mat lists, for each image in a sequence, the indices of images that are regarded as the same place.
 
-truth_data = mat_file['truth']
 gnd_data = mat_file2['gnd']
 
-
-num_images = truth_data.shape[0]
+# sparse adjacency of the loop closures (cached on disk after the first conversion),
+# the dense N x N truth matrix is only read by GroundTruth.from_mat on that first conversion
+ground_truth = GroundTruth.from_mat('/home/java/AnyFeature-Benchmark/KITTI/KITTI_GroundTruth/kitti'+ sequence + 'GroundTruth.mat')
+num_images = ground_truth.num_frames
 
 # # Create a dictionary to store groups of images with loop closures
-image_groups = {}
-
-# Iterate through the binary matrix to identify images with loop closures
-for i in range(num_images):
-    for j in range(num_images):
-        if truth_data[i, j] == 1 and i != j:
-            if i not in image_groups:
-                image_groups[i] = []
-            if j not in image_groups:
-                image_groups[j] = []
-            image_groups[i].append(i)
-            image_groups[i].append(j)
-image_groups = {k: v for k, v in image_groups.items() if v} #remove nums
-image_groups = {k: [x for x in v if x != k] for k, v in image_groups.items()} #remove self
-unique_values = list(set(value for values in image_groups.values() for value in values)) #get frames with loop closures
+image_groups = {int(i): ground_truth.neighbours(i).tolist() for i in ground_truth.frames_with_loops()}
+unique_values = np.unique(ground_truth.indices).tolist() #get frames with loop closures
 
 import code
 code.interact(local=dict(globals(), **locals()))
@@ -0,0 +1,155 @@
+""" Evaluates a checkpoint on several KITTI sequences, in parallel and resumable.
+
+Each sequence goes through three stages, each saved to its own file in out_dir/<checkpoint>/<seq>/:
+    1. descriptors.npy     : the global descriptors of the frames (GPU, one sequence at a time),
+    2. candidates_*.npz    : the top-k loop candidates of every frame (worker processes),
+    3. metrics_*.json      : precision/recall of the best candidates against the ground truth (worker processes).
+A stage is skipped when its file exists, and the files are written to a temporary file then renamed,
+so an interrupted run is resumed by running the same command again. The evaluation of a sequence
+starts in the workers as soon as its descriptors are ready, while the next sequence is extracted.
+The metrics of all the sequences are gathered in one results_*.csv table.
+
+Example:
+    python run_kitti.py --ckpt ./LOGS/resnet50_MixVPR_4096_channels\\(1024\\)_rows\\(4\\).ckpt \\
+        --kitti_dir /home/java/AnyFeature-Benchmark/KITTI --ground_truth /path/to/kitti{seq}GroundTruth.mat \\
+        --sequences 00 02 05 08
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from evaluation import best_candidates, evaluate, num_loop_queries
+from ground_truth import load_ground_truth
+from loop_candidates import find_loop_candidates
+
+
+def save_atomic(path, save_fn):
+    """Writes a stage output to a temporary file first, an interrupted run never leaves a truncated file"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        save_fn(f)
+    os.replace(tmp_path, path)
+
+
+def extract_descriptors(model, image_dir, out_file, device='cuda', batch_size=32, num_workers=4):
+    import torch
+    from torch.utils import data
+    from tqdm import tqdm
+
+    from calc_sim import BaseDataset
+
+    dataset = BaseDataset(image_dir)
+    dataloader = data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                                 pin_memory=True, drop_last=False)
+    descriptors = None
+    with torch.no_grad():
+        for imgs, indices in tqdm(dataloader, ncols=100, desc=f'Extracting {image_dir}'):
+            output = model(imgs.to(device)).float().cpu().numpy()
+            if descriptors is None:
+                descriptors = np.zeros((len(dataset), output.shape[1]), dtype=np.float32)
+            descriptors[indices.numpy()] = output
+    save_atomic(out_file, lambda f: np.save(f, descriptors))
+
+
+def evaluate_sequence(seq, descriptors_file, ground_truth_file, candidates_file, metrics_file,
+                      top_k=10, frame_distance=50, block_size=1024):
+    """Candidates and metrics stages of a sequence (runs in a worker process)"""
+    if not os.path.exists(candidates_file):
+        descriptors = np.load(descriptors_file).astype(np.float32)
+        query_ids, counts, indices, scores = [], [], [], []
+        # the similarity matrix is computed and searched by blocks of rows
+        for start in range(0, len(descriptors), block_size):
+            block = descriptors[start:start + block_size]
+            candidates = find_loop_candidates(block @ descriptors.T, top_k=top_k, frame_distance=frame_distance,
+                                              causal=True, query_ids=np.arange(start, start + len(block)))
+            query_ids.append(candidates.query_ids)
+            counts.append(candidates.num_candidates())
+            indices.append(candidates.indices)
+            scores.append(candidates.scores)
+        offsets = np.concatenate([[0], np.cumsum(np.concatenate(counts))])
+        save_atomic(candidates_file, lambda f: np.savez(f, query_ids=np.concatenate(query_ids), offsets=offsets,
+                                                        indices=np.concatenate(indices),
+                                                        scores=np.concatenate(scores)))
+
+    if not os.path.exists(metrics_file):
+        candidates = np.load(candidates_file)
+        flat_query_ids = np.repeat(candidates['query_ids'], np.diff(candidates['offsets']))
+        query_ids, candidate_ids, scores = best_candidates(flat_query_ids, candidates['indices'], candidates['scores'])
+        ground_truth = load_ground_truth(ground_truth_file)
+        num_queries = len(candidates['query_ids'])
+        results = evaluate(query_ids, candidate_ids, scores, ground_truth,
+                           num_loop_queries(ground_truth, frame_distance, causal=True, num_queries=num_queries))
+        metrics = {'sequence': seq,
+                   'num_frames': num_queries,
+                   'top_k': top_k,
+                   'frame_distance': frame_distance,
+                   'max_recall_at_100_precision': results['max_recall_at_100_precision'],
+                   'average_precision': results['average_precision'],
+                   'recall_at_max': float(results['recall'][-1]) if len(results['recall']) else 0.}
+        save_atomic(metrics_file, lambda f: f.write(json.dumps(metrics, indent=2).encode()))
+
+    with open(metrics_file) as f:
+        return json.load(f)
+
+
+def write_results(results, out_file):
+    columns = ['sequence', 'num_frames', 'top_k', 'frame_distance',
+               'max_recall_at_100_precision', 'average_precision', 'recall_at_max']
+    lines = [','.join(columns)] + [','.join(str(r[c]) for c in columns) for r in results]
+    save_atomic(out_file, lambda f: f.write(('\n'.join(lines) + '\n').encode()))
+
+    print(f"{'seq':>4} {'frames':>7} {'R@100P':>8} {'AP':>8} {'R@max':>8}")
+    for r in results:
+        print(f"{r['sequence']:>4} {r['num_frames']:>7} {r['max_recall_at_100_precision']:>8.4f} "
+              f"{r['average_precision']:>8.4f} {r['recall_at_max']:>8.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parallel, resumable KITTI loop-closure evaluation of a checkpoint')
+    parser.add_argument('--ckpt', type=str, required=True)
+    parser.add_argument('--kitti_dir', type=str, required=True, help='the images of a sequence are in <kitti_dir>/<seq>/rgb/')
+    parser.add_argument('--ground_truth', type=str, required=True, help='.mat ground truth path, {seq} is replaced by the sequence')
+    parser.add_argument('--sequences', type=str, nargs='+', default=['00', '02', '05', '08'])
+    parser.add_argument('--out_dir', type=str, default='./LOGS/kitti_eval')
+    parser.add_argument('--top_k', type=int, default=10)
+    parser.add_argument('--frame_distance', type=int, default=50)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_workers', type=int, default=4)
+    args = parser.parse_args()
+
+    # the descriptors depend on the checkpoint, the later stages also on their parameters
+    run_dir = os.path.join(args.out_dir, os.path.splitext(os.path.basename(args.ckpt))[0])
+    suffix = f'k{args.top_k}_d{args.frame_distance}'
+    model = None
+    futures = []
+    # spawn, the workers must not inherit the CUDA state of the extraction
+    with ProcessPoolExecutor(max_workers=args.processes, mp_context=mp.get_context('spawn')) as executor:
+        for seq in args.sequences:
+            seq_dir = os.path.join(run_dir, seq)
+            os.makedirs(seq_dir, exist_ok=True)
+            descriptors_file = os.path.join(seq_dir, 'descriptors.npy')
+            if not os.path.exists(descriptors_file):
+                if model is None:
+                    from calc_sim import load_model
+                    model = load_model(args.ckpt).to(args.device)
+                extract_descriptors(model, os.path.join(args.kitti_dir, seq, 'rgb') + '/', descriptors_file,
+                                    args.device, args.batch_size, args.num_workers)
+            else:
+                print(f'{seq}: reusing {descriptors_file}')
+            futures.append(executor.submit(evaluate_sequence, seq, descriptors_file, args.ground_truth.format(seq=seq),
+                                           os.path.join(seq_dir, f'candidates_{suffix}.npz'),
+                                           os.path.join(seq_dir, f'metrics_{suffix}.json'),
+                                           args.top_k, args.frame_distance))
+        results = [future.result() for future in futures]
+
+    write_results(results, os.path.join(run_dir, f'results_{suffix}.csv'))
+
+
+if __name__ == '__main__':
+    main()
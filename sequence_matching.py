@@ -0,0 +1,184 @@
+""" Sequence matching (SeqSLAM-style) of loop candidates, on streamed similarity rows.
+
+A single frame match is easily a false positive, a loop is a run of consecutive matches: the sequence
+score of (query t, database frame j) is the mean similarity along the diagonal of length seq_len
+ending at (t, j), i.e. the mean of s[t-i, j-i] for i in 0..seq_len-1 (revisits at the same speed).
+
+The similarity rows are consumed one at a time (ex. as the frames arrive in the SLAM, or row blocks
+of a memmapped matrix), the dense N x N matrix is never needed. The diagonal cumulative sums
+    C[t, j] = s[t, j] + C[t-1, j-1]
+make each sequence score a difference C[t, j] - C[t-seq_len, j-seq_len], so only a ring of the
+last seq_len + 1 cumulative rows is kept and each new frame costs O(num_db).
+
+Example:
+    python sequence_matching.py similarity_matrix_05.npy similarity_matrix_08.npy --seq_len 10
+"""
+import argparse
+import time
+
+import numpy as np
+
+from loop_candidates import find_loop_candidates
+
+
+class SequenceMatcher:
+    """Incremental sequence scores of the similarity rows
+
+    Args:
+        seq_len (int): length of the sequences (diagonals) in frames.
+        capacity (int, optional): initial number of database frames, grown as needed. Defaults to 1024.
+    """
+    def __init__(self, seq_len, capacity=1024):
+        self.seq_len = seq_len
+        self.num_frames = 0
+        # ring of the cumulative sums along the diagonals, and of the number of summed values
+        self.cumsum = np.zeros((seq_len + 1, capacity), dtype=np.float64)
+        self.counts = np.zeros((seq_len + 1, capacity), dtype=np.int32)
+
+    def _grow(self, size):
+        capacity = max(size, 2 * self.cumsum.shape[1])
+        pad = capacity - self.cumsum.shape[1]
+        self.cumsum = np.pad(self.cumsum, ((0, 0), (0, pad)))
+        self.counts = np.pad(self.counts, ((0, 0), (0, pad)))
+
+    def add(self, similarity_row, offset=0):
+        """Adds the similarity row of the next frame and returns its sequence scores
+
+        Args:
+            similarity_row (array): similarity of the frame to the database frames offset..offset+len-1,
+                                    (a band of the database for banded/tiled similarity data).
+            offset (int, optional): database id of the first value of the row. Defaults to 0.
+
+        Returns:
+            array: sequence score of each database frame 0..offset+len-1, -inf where the diagonal
+                   is not complete (sequence start, or values missing from the rows).
+        """
+        row = np.asarray(similarity_row, dtype=np.float64)
+        size = offset + len(row)
+        if size > self.cumsum.shape[1]:
+            self._grow(size)
+
+        t = self.num_frames
+        current, previous = t % (self.seq_len + 1), (t - 1) % (self.seq_len + 1)
+        cumsum, counts = self.cumsum[current], self.counts[current]
+
+        # C[t, j] = s[t, j] + C[t-1, j-1]
+        cumsum[0] = 0
+        counts[0] = 0
+        if t > 0:
+            cumsum[1:] = self.cumsum[previous, :-1]
+            counts[1:] = self.counts[previous, :-1]
+        else:
+            cumsum[1:] = 0
+            counts[1:] = 0
+        cumsum[offset:size] += row
+        counts[offset:size] += 1
+        self.num_frames += 1
+
+        # the diagonal of length seq_len ending at (t, j) starts after (t-seq_len, j-seq_len)
+        L = self.seq_len
+        sums, num_values = cumsum[:size].copy(), counts[:size].copy()
+        if t >= L:
+            # the ring slot of t - L is the one after the current one
+            oldest = (t + 1) % (L + 1)
+            sums[L:] -= self.cumsum[oldest, :size - L]
+            num_values[L:] -= self.counts[oldest, :size - L]
+        scores = sums / L
+        scores[num_values < L] = -np.inf
+        return scores
+
+
+def stream_rows(similarity, block_size=1024):
+    """Yields the rows of a (memmapped) similarity matrix, read by blocks"""
+    for start in range(0, similarity.shape[0], block_size):
+        for row in np.asarray(similarity[start:start + block_size], dtype=np.float32):
+            yield row
+
+
+def sequence_loop_candidates(rows, seq_len, top_k=1, sim_threshold=None, frame_distance=None, causal=True,
+                             block_size=1024):
+    """Loop candidates from the sequence scores of streamed similarity rows
+
+    Args:
+        rows (iterable): similarity row of each frame, in order (ex. stream_rows(similarity)).
+        seq_len (int): length of the sequences in frames.
+        top_k, sim_threshold, frame_distance, causal: the candidate rules of find_loop_candidates,
+                                                      applied to the sequence scores.
+        block_size (int, optional): number of scored rows searched at once. Defaults to 1024.
+
+    Returns:
+        tuple: (query ids, candidate ids, sequence scores), flat arrays of all the candidates.
+    """
+    matcher = SequenceMatcher(seq_len)
+    query_ids, candidate_ids, scores = [], [], []
+
+    def search(block, first_query):
+        # pad the scored rows to the same width (the database grows with the frames)
+        width = max(len(r) for r in block)
+        padded = np.full((len(block), width), -np.inf, dtype=np.float32)
+        for i, r in enumerate(block):
+            padded[i, :len(r)] = r
+        candidates = find_loop_candidates(padded, top_k=top_k, sim_threshold=sim_threshold,
+                                          frame_distance=frame_distance, causal=causal,
+                                          query_ids=np.arange(first_query, first_query + len(block)))
+        query_ids.append(candidates.flat_query_ids())
+        candidate_ids.append(candidates.indices)
+        scores.append(candidates.scores)
+
+    block, first_query = [], 0
+    for row in rows:
+        block.append(matcher.add(row))
+        if len(block) == block_size:
+            search(block, first_query)
+            first_query += len(block)
+            block = []
+    if block:
+        search(block, first_query)
+
+    if not query_ids:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    return np.concatenate(query_ids), np.concatenate(candidate_ids), np.concatenate(scores)
+
+
+def measure_throughput(similarity, seq_len, block_size=1024):
+    """Frames per second of the sequence scoring alone, streaming the rows of a similarity matrix"""
+    matcher = SequenceMatcher(seq_len, capacity=similarity.shape[1])
+    start = time.perf_counter()
+    for row in stream_rows(similarity, block_size):
+        matcher.add(row)
+    elapsed = time.perf_counter() - start
+    return similarity.shape[0] / elapsed if elapsed > 0 else float('inf')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sequence matching of loop candidates on similarity matrices')
+    parser.add_argument('similarity_matrices', nargs='*', help='.npy files or tab separated text files, one per sequence')
+    parser.add_argument('--seq_len', type=int, default=10)
+    parser.add_argument('--frame_distance', type=int, default=50)
+    parser.add_argument('--top_k', type=int, default=1)
+    parser.add_argument('--num_frames', type=int, default=2000, help='size of the random matrix without input files')
+    args = parser.parse_args()
+
+    if args.similarity_matrices:
+        sequences = {}
+        for path in args.similarity_matrices:
+            if path.endswith('.npy'):
+                sequences[path] = np.load(path, mmap_mode='r')
+            else:
+                sequences[path] = np.loadtxt(path, delimiter='\t', dtype=np.float32)
+    else:
+        rng = np.random.default_rng(0)
+        sequences = {'random': np.tril(rng.random((args.num_frames, args.num_frames), dtype=np.float32))}
+
+    for name, similarity in sequences.items():
+        fps = measure_throughput(similarity, args.seq_len)
+        start = time.perf_counter()
+        query_ids, _, _ = sequence_loop_candidates(stream_rows(similarity), args.seq_len, top_k=args.top_k,
+                                                   frame_distance=args.frame_distance)
+        total_fps = similarity.shape[0] / (time.perf_counter() - start)
+        print(f'{name}: {similarity.shape[0]} frames, scoring {fps:.0f} fps, '
+              f'scoring + candidates {total_fps:.0f} fps, {len(np.unique(query_ids))} queries with candidates')
+
+
+if __name__ == '__main__':
+    main()
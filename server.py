@@ -0,0 +1,253 @@
+""" Local loop-closure query server, for the SLAM integration.
+
+The model and the keyframe descriptor database stay in memory between the keyframes. The SLAM
+posts each new keyframe (an image path, a base64 encoded image or an already computed descriptor)
+and gets back its loop candidates among the previous keyframes, then the keyframe is inserted
+(when it passes the admission policy of the KeyframeDatabase).
+
+The concurrent requests are batched: a worker thread waits at most max_wait_ms after the first
+queued request for more requests (up to max_batch_size), encodes the images of the batch in one
+forward pass and searches the database for all of them at once.
+
+Endpoints (localhost HTTP, JSON):
+    POST /keyframe  {"frame_id": 12, "image_path": "/path/000012.png"}
+                    {"frame_id": 12, "image": "<base64 png/jpg>"}
+                    {"frame_id": 12, "descriptor": [0.01, ...]}
+                    -> {"frame_id": 12, "candidates": [...], "scores": [...], "inserted": true}
+    GET  /stats     -> latency percentiles (ms), batch sizes, queue depth and database size
+
+Example:
+    python server.py --ckpt ./LOGS/resnet50_MixVPR_4096_channels\\(1024\\)_rows\\(4\\).ckpt --port 8765
+"""
+import argparse
+import base64
+import io
+import json
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from keyframe_database import KeyframeDatabase
+
+
+class Request:
+    def __init__(self, frame_id, image=None, descriptor=None):
+        self.frame_id = frame_id
+        self.image = image
+        self.descriptor = descriptor
+        self.received = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class LoopClosureService:
+    """Batches the keyframe requests and answers them from the descriptor database
+
+    Args:
+        model (torch.nn.Module, optional): the VPR model, None to only accept descriptors. Defaults to None.
+        feature_dim (int, optional): descriptor size. Defaults to 4096.
+        device (str, optional): device of the model. Defaults to 'cuda'.
+        max_batch_size (int, optional): maximum number of requests per batch. Defaults to 16.
+        max_wait_ms (float, optional): latency budget to wait for more requests after the first. Defaults to 5.
+        top_k (int, optional): maximum number of candidates per keyframe. Defaults to 10.
+        sim_threshold (float, optional): minimum similarity of a candidate. Defaults to None.
+        frame_distance (int, optional): the frames within frame_distance of a keyframe are not candidates. Defaults to 50.
+        **database_policy: novelty_threshold, novelty_window, max_size and thin_by of the KeyframeDatabase.
+    """
+    def __init__(self, model=None, feature_dim=4096, device='cuda', max_batch_size=16, max_wait_ms=5.,
+                 top_k=10, sim_threshold=None, frame_distance=50, **database_policy):
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.top_k = top_k
+        self.sim_threshold = sim_threshold
+        self.frame_distance = frame_distance
+        self.database = KeyframeDatabase(feature_dim, **database_policy)
+
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=10000)
+        self.batch_sizes = deque(maxlen=10000)
+        self.stats_lock = threading.Lock()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, request, timeout=None):
+        """Queues a request and waits for its result (called from the HTTP handler threads)"""
+        self.requests.put(request)
+        if not request.done.wait(timeout):
+            raise TimeoutError(f'frame {request.frame_id} was not processed in {timeout}s')
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._process(batch)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            now = time.perf_counter()
+            with self.stats_lock:
+                self.latencies.extend(now - r.received for r in batch)
+                self.batch_sizes.append(len(batch))
+            for request in batch:
+                request.done.set()
+
+    def _encode(self, images):
+        import torch
+
+        with torch.no_grad():
+            descriptors = self.model(torch.stack(images).to(self.device))
+        return descriptors.float().cpu().numpy()
+
+    def _process(self, batch):
+        descriptors = np.zeros((len(batch), self.database.descriptors.shape[1]), dtype=np.float32)
+        with_image = [i for i, r in enumerate(batch) if r.descriptor is None]
+        if with_image:
+            if self.model is None:
+                raise ValueError('The server was started without a model, post descriptors instead of images')
+            descriptors[with_image] = self._encode([batch[i].image for i in with_image])
+        for i, request in enumerate(batch):
+            if request.descriptor is not None:
+                descriptors[i] = request.descriptor
+
+        frame_ids = np.array([r.frame_id for r in batch], dtype=np.int64)
+        candidates = self.database.search(frame_ids, descriptors, self.top_k, self.sim_threshold, self.frame_distance)
+        admitted = self.database.insert(frame_ids, descriptors)
+        for i, request in enumerate(batch):
+            indices, scores = candidates[i]
+            request.result = {'frame_id': request.frame_id,
+                              'candidates': indices.tolist(),
+                              'scores': scores.tolist(),
+                              'inserted': bool(admitted[i])}
+
+    def stats(self):
+        with self.stats_lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+        stats = {'num_requests': len(latencies),
+                 'queue_depth': self.requests.qsize(),
+                 'database_size': len(self.database),
+                 'mean_batch_size': float(batch_sizes.mean()) if len(batch_sizes) else 0.}
+        if len(latencies):
+            for p in (50, 90, 99):
+                stats[f'latency_p{p}_ms'] = float(np.percentile(latencies, p))
+            stats['latency_max_ms'] = float(latencies.max())
+        return stats
+
+
+def parse_request(body):
+    """Request from the JSON body of a POST /keyframe"""
+    frame_id = int(body['frame_id'])
+    if 'descriptor' in body:
+        return Request(frame_id, descriptor=np.asarray(body['descriptor'], dtype=np.float32))
+
+    # the image is decoded and transformed in the handler thread, only the forward pass is batched
+    from demo import load_image
+    if 'image_path' in body:
+        image = load_image(body['image_path'])
+    elif 'image' in body:
+        image = load_image(io.BytesIO(base64.b64decode(body['image'])))
+    else:
+        raise ValueError('A keyframe needs one of "descriptor", "image_path" or "image"')
+    return Request(frame_id, image=image)
+
+
+def make_handler(service, timeout=30.):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, content):
+            data = json.dumps(content).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, service.stats())
+            else:
+                self._reply(404, {'error': f'unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/keyframe':
+                self._reply(404, {'error': f'unknown path {self.path}'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                request = parse_request(body)
+            except (ValueError, KeyError, OSError) as e:
+                self._reply(400, {'error': str(e)})
+                return
+            try:
+                self._reply(200, service.submit(request, timeout))
+            except Exception as e:
+                self._reply(500, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            # the per-request logs of BaseHTTPRequestHandler would flood the SLAM output
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local loop-closure query server')
+    parser.add_argument('--ckpt', type=str, default=None, help='MixVPR checkpoint, without it only descriptors are accepted')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--feature_dim', type=int, default=4096)
+    parser.add_argument('--max_batch_size', type=int, default=16)
+    parser.add_argument('--max_wait_ms', type=float, default=5.)
+    parser.add_argument('--top_k', type=int, default=10)
+    parser.add_argument('--sim_threshold', type=float, default=None)
+    parser.add_argument('--frame_distance', type=int, default=50)
+    parser.add_argument('--novelty_threshold', type=float, default=None, help='only insert the keyframes less similar than this to the recent ones')
+    parser.add_argument('--max_keyframes', type=int, default=None, help='thin the database above this size')
+    parser.add_argument('--thin_by', type=str, default=None, choices=['descriptor', 'spatial', 'temporal'],
+                        help='gap between the keyframes used by the thinning (default: descriptor)')
+    args = parser.parse_args()
+
+    model = None
+    if args.ckpt is not None:
+        from demo import load_model
+        model = load_model(args.ckpt).to(args.device)
+
+    service = LoopClosureService(model, args.feature_dim, args.device, args.max_batch_size, args.max_wait_ms,
+                                 args.top_k, args.sim_threshold, args.frame_distance,
+                                 novelty_threshold=args.novelty_threshold, max_size=args.max_keyframes,
+                                 thin_by=args.thin_by)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print(f'Serving loop candidates on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
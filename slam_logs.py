@@ -0,0 +1,143 @@
+""" Single-pass parser of the ORB-SLAM / MixVPR system_output_*.txt logs.
+
+Each log is read once, line by line, and every line is dispatched to all the registered
+patterns (a cheap keyword test first, the regex only runs on the lines that contain the keyword).
+The events of each type are returned as columnar numpy arrays, for example:
+
+    events = parse_log('system_output_00001.txt')
+    events['loop_closure']['frame_id']             # frames where a loop was closed
+    events['detect_loop_candidates']['filter3']    # ORB-SLAM matches after the 3rd filter
+
+Many runs and sequences can be parsed in parallel with parse_logs:
+    python slam_logs.py /path/to/KITTI/*/system_output_*.txt --processes 8
+"""
+import argparse
+import re
+from multiprocessing import Pool
+
+import numpy as np
+
+
+class LogPattern:
+    """A type of event in the logs.
+
+    Args:
+        name (str): name of the event type, the key of its columns in the parsed events.
+        keyword (str): only the lines containing this string are matched against the regex.
+        regex (str): the regex, with one group per field.
+        fields (list): names of the (integer) fields, in the order of the regex groups.
+        ragged (str, optional): name of an extra field read from the last regex group, a whitespace-separated
+                                list of integers of variable length. It is stored flat, with `<ragged>_offsets`
+                                (event i owns values[offsets[i]:offsets[i+1]]). Defaults to None.
+    """
+    def __init__(self, name, keyword, regex, fields, ragged=None):
+        self.name = name
+        self.keyword = keyword
+        self.regex = re.compile(regex)
+        self.fields = fields
+        self.ragged = ragged
+
+
+PATTERNS = []
+
+
+def register_pattern(pattern):
+    """Adds a type of event to the ones parsed by default"""
+    PATTERNS.append(pattern)
+    return pattern
+
+
+# ORB-SLAM loop detection: DBoW candidates and the matches left after each filter
+register_pattern(LogPattern(
+    'detect_loop_candidates', 'DetectLoopCandidates',
+    r'DetectLoopCandidates: mnFrameID\s*=\s*(\d+)\s+inital matches:\s*(\d+)\s+1st Filter matches.*?=\s*(\d+)\s+2nd Filter matches.*?=\s*(\d+)\s+3rd Filter matches.*?=\s*(\d+)',
+    ['frame_id', 'initial', 'filter1', 'filter2', 'filter3']))
+
+# MixVPR loop detection: candidates above the similarity threshold, then the connected-images filter
+register_pattern(LogPattern(
+    'vp_filtered_candidates', 'vpFilteredLoopCandidate',
+    r'vpFilteredLoopCandidate:\s*mnFrameId\s*=\s*(\d+)\s+inital matches:\s*(\d+)\s+vp 1st filtered matches:\s*(\d+)\s+vp 2nd filtered matches:\s*(\d+)',
+    ['frame_id', 'initial', 'filter1', 'filter2']))
+
+register_pattern(LogPattern('loop_detected', 'DetectLoop done and true at', r'DetectLoop done and true at: (\d+)', ['frame_id']))
+
+register_pattern(LogPattern('loop_closure', 'Loop Closure at', r'Loop Closure at: (\d+)', ['frame_id']))
+
+register_pattern(LogPattern('loop_candidates', 'loop_candidates', r'Frame ID: (\d+) loop_candidates: (.+)',
+                            ['frame_id'], ragged='candidates'))
+
+
+def parse_log(path, patterns=None):
+    """Parses a log in one pass
+
+    Args:
+        path (str): path to the log file.
+        patterns (list, optional): the LogPatterns to look for. Defaults to all the registered ones.
+
+    Returns:
+        dict: {event name: {field: int64 array}}, the events are in the order of the log.
+    """
+    patterns = PATTERNS if patterns is None else patterns
+    columns = {p.name: {f: [] for f in p.fields} for p in patterns}
+    for p in patterns:
+        if p.ragged:
+            columns[p.name][p.ragged] = []
+            columns[p.name][p.ragged + '_offsets'] = [0]
+
+    with open(path, 'r', errors='replace') as file:
+        for line in file:
+            for p in patterns:
+                if p.keyword not in line:
+                    continue
+                match = p.regex.search(line)
+                if match is None:
+                    continue
+                event = columns[p.name]
+                for f, value in zip(p.fields, match.groups()):
+                    event[f].append(int(value))
+                if p.ragged:
+                    values = event[p.ragged]
+                    values.extend(int(x) for x in match.group(len(p.fields) + 1).split())
+                    event[p.ragged + '_offsets'].append(len(values))
+
+    return {name: {f: np.array(v, dtype=np.int64) for f, v in event.items()} for name, event in columns.items()}
+
+
+def parse_logs(paths, patterns=None, processes=None):
+    """Parses many logs (ex. several runs of several sequences) in parallel
+
+    Returns:
+        list: the parsed events of each log, in the order of paths.
+    """
+    with Pool(processes) as pool:
+        return pool.starmap(parse_log, [(path, patterns) for path in paths])
+
+
+def last_per_frame(event, key='frame_id'):
+    """Keeps the last event of each frame, sorted by frame (for event types without ragged fields)"""
+    frame_ids = event[key]
+    # the first occurrence in the reversed log is the last one
+    _, first_in_reversed = np.unique(frame_ids[::-1], return_index=True)
+    keep = len(frame_ids) - 1 - first_in_reversed
+    return {f: v[keep] for f, v in event.items()}
+
+
+def ragged_values(event, field, i):
+    """Values of the ragged field for the i-th event"""
+    offsets = event[field + '_offsets']
+    return event[field][offsets[i]:offsets[i + 1]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parse ORB-SLAM / MixVPR system_output logs')
+    parser.add_argument('logs', nargs='+')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    for path, events in zip(args.logs, parse_logs(args.logs, processes=args.processes)):
+        counts = ', '.join(f'{name}: {len(next(iter(cols.values())))}' for name, cols in events.items())
+        print(f'{path}: {counts}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+import copy
+
+import torch
+
+from models.backbones import ResNet
+
+
+def test_checkpointed_layers_update_batchnorm_stats_once():
+    torch.manual_seed(0)
+    model = ResNet('resnet18', pretrained=False, layers_to_crop=[4])
+    checkpointed = copy.deepcopy(model)
+    checkpointed.checkpoint_layers = [1, 2, 3]
+    x = torch.randn(2, 3, 64, 64)
+
+    for m in (model, checkpointed):
+        m.train()
+        m(x).square().mean().backward()
+
+    for (name, a), b in zip(model.state_dict().items(), checkpointed.state_dict().values()):
+        assert torch.allclose(a.float(), b.float(), atol=1e-6), name
+    for a, b in zip(model.parameters(), checkpointed.parameters()):
+        assert torch.allclose(a.grad, b.grad, atol=1e-5)
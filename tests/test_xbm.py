@@ -0,0 +1,64 @@
+import torch
+import torch.nn.functional as F
+from pytorch_metric_learning.utils import loss_and_miner_utils as lmu
+
+from utils.losses import get_loss, get_miner
+from utils.xbm import CrossBatchMemory, remove_batch_pairs, xbm_loss
+
+
+def gsv_like_batches(num_batches, places, img_per_place, dim, noise=1.0, seed=0):
+    """Batches where every label (place) appears in a single batch, as GSVCities yields each place once per epoch"""
+    generator = torch.Generator().manual_seed(seed)
+    for b in range(num_batches):
+        labels = torch.arange(b * places, (b + 1) * places).repeat_interleave(img_per_place)
+        # the images of a place are noisy copies of the place center
+        centers = torch.randn(places, dim, generator=generator).repeat_interleave(img_per_place, 0)
+        descriptors = F.normalize(centers + noise * torch.randn(centers.shape, generator=generator), dim=1)
+        yield descriptors, labels
+
+
+def test_xbm_loss_with_labels_never_repeated_across_batches():
+    loss_fn = get_loss('MultiSimilarityLoss')
+    miner = get_miner('MultiSimilarityMiner', 0.1)
+    memory = CrossBatchMemory(size=64)
+
+    for b, (descriptors, labels) in enumerate(gsv_like_batches(num_batches=4, places=8, img_per_place=4, dim=32)):
+        descriptors = descriptors.clone().requires_grad_()
+        positions = memory.enqueue(descriptors, labels)
+        ref_emb, ref_labels = memory.get()
+        _, _, a2, _ = remove_batch_pairs(miner(descriptors, labels, ref_emb, ref_labels), positions, len(ref_labels))
+        loss = xbm_loss(memory, descriptors, labels, positions, loss_fn, miner)
+
+        if b == 0:
+            # the memory only holds the current batch, there is no cross-batch pair
+            assert len(a2) == 0 and loss.item() == 0
+            continue
+        # the labels of the past batches are all different, their descriptors are hard negatives
+        assert len(a2) > 0 and loss.item() > 0
+        grad, = torch.autograd.grad(loss, descriptors)
+        assert torch.isfinite(grad).all() and grad.abs().sum() > 0
+
+
+def test_xbm_loss_is_zero_with_only_the_current_batch_in_memory():
+    # the in-batch pairs are already counted by the loss of the batch, xbm_weight must not scale them
+    descriptors, labels = next(gsv_like_batches(num_batches=1, places=8, img_per_place=4, dim=32))
+    for miner in (None, get_miner('MultiSimilarityMiner', 0.1)):
+        memory = CrossBatchMemory(size=64)
+        positions = memory.enqueue(descriptors, labels)
+        loss = xbm_loss(memory, descriptors, labels, positions, get_loss('MultiSimilarityLoss'), miner)
+        assert loss.item() == 0
+
+
+def test_pairs_with_the_current_batch_are_removed():
+    memory = CrossBatchMemory(size=16)
+    memory.enqueue(F.normalize(torch.randn(4, 32), dim=1), torch.tensor([100, 100, 101, 101]))
+    descriptors = F.normalize(torch.randn(8, 32), dim=1)
+    labels = torch.arange(4).repeat_interleave(2)
+    positions = memory.enqueue(descriptors, labels)
+    assert positions.tolist() == list(range(4, 12))
+
+    _, ref_labels = memory.get()
+    a1, p, a2, n = remove_batch_pairs(lmu.get_all_pairs_indices(labels, ref_labels), positions, len(ref_labels))
+    # no past descriptor shares a label with the batch, the 4 past descriptors are negatives of every anchor
+    assert len(a1) == 0
+    assert len(a2) == 8 * 4 and (n < 4).all()
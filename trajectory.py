@@ -0,0 +1,65 @@
+""" Keyframe trajectories saved by ORB-SLAM (KeyFrameTrajectory.txt).
+
+Each line is `frame_id timestamp tx ty tz [qx qy qz qw]`. The file is read once into arrays
+sorted by frame id, so the lookups of whole arrays of frame ids (ex. all the ground-truth loop
+frames, which are mostly not keyframes) are vectorized binary searches (np.searchsorted).
+
+Example:
+    trajectory = KeyFrameTrajectory.from_file('00001_KeyFrameTrajectory.txt')
+    xyz = trajectory.nearest_translations(loop_frame_ids)
+"""
+import numpy as np
+
+
+class KeyFrameTrajectory:
+    """Keyframe poses indexed by frame id
+
+    Args:
+        frame_ids (array): frame id of each keyframe.
+        timestamps (array): timestamp of each keyframe.
+        translations (array): (num_keyframes x 3) positions.
+        rotations (array, optional): (num_keyframes x 4) quaternions. Defaults to None.
+    """
+    def __init__(self, frame_ids, timestamps, translations, rotations=None):
+        order = np.argsort(frame_ids, kind='stable')
+        self.frame_ids = np.asarray(frame_ids, dtype=np.int64)[order]
+        self.timestamps = np.asarray(timestamps)[order]
+        self.translations = np.asarray(translations)[order]
+        self.rotations = None if rotations is None else np.asarray(rotations)[order]
+
+    @classmethod
+    def from_file(cls, path):
+        data = np.loadtxt(path, ndmin=2)
+        rotations = data[:, 5:9] if data.shape[1] >= 9 else None
+        return cls(data[:, 0].astype(np.int64), data[:, 1], data[:, 2:5], rotations)
+
+    def __len__(self):
+        return len(self.frame_ids)
+
+    def contains(self, frame_ids):
+        """Whether each frame is a keyframe"""
+        frame_ids = np.asarray(frame_ids, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.frame_ids, frame_ids), len(self.frame_ids) - 1)
+        return self.frame_ids[pos] == frame_ids
+
+    def nearest(self, frame_ids):
+        """Index of the keyframe with the closest frame id to each frame (the lower one on ties)"""
+        frame_ids = np.asarray(frame_ids, dtype=np.int64)
+        right = np.clip(np.searchsorted(self.frame_ids, frame_ids), 1, len(self.frame_ids) - 1)
+        left = right - 1
+        if len(self.frame_ids) == 1:
+            return np.zeros(frame_ids.shape, dtype=np.int64)
+        use_right = np.abs(self.frame_ids[right] - frame_ids) < np.abs(frame_ids - self.frame_ids[left])
+        return np.where(use_right, right, left)
+
+    def nearest_frame_ids(self, frame_ids):
+        return self.frame_ids[self.nearest(frame_ids)]
+
+    def nearest_translations(self, frame_ids):
+        """(len(frame_ids) x 3) positions of the nearest keyframe of each frame"""
+        return self.translations[self.nearest(frame_ids)]
+
+    def translations_of(self, frame_ids):
+        """Positions of the frames that are keyframes, the other frames are dropped"""
+        frame_ids = np.asarray(frame_ids, dtype=np.int64)
+        return self.nearest_translations(frame_ids[self.contains(frame_ids)])
@@ -1,2 +1,5 @@
 from .losses import get_miner, get_loss
-from .validation import get_validation_recalls
+from .validation import get_validation_recalls, get_references_and_positives, recall_stderr, StreamingRecall
+from .xbm import CrossBatchMemory, xbm_loss
+from .metrics import mined_batch_accuracy, RunningMean
+from .async_validation import AsyncValidation
@@ -0,0 +1,173 @@
+import json
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import pytorch_lightning as pl
+from torch.utils.data import DataLoader
+
+from .validation import get_validation_recalls, get_references_and_positives
+
+
+def evaluate_checkpoint(ckpt_path, model_class, model_hparams, datamodule_class, datamodule_hparams,
+                        k_values, faiss_gpu=False, device='cpu', num_threads=None):
+    """Computes the recalls of a weights-only checkpoint on the validation sets of the datamodule.
+    This runs in the evaluation process of AsyncValidation, the model and the datamodule
+    are rebuilt there from their hyperparameters.
+
+    Returns:
+        dict: {'<val_set_name>/R<k>': recall} for each validation set and each k in k_values
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    # the backbone weights come from the checkpoint, no need to download the pretrained ones
+    model = model_class(**{**model_hparams, 'pretrained': False})
+    model.load_state_dict(torch.load(ckpt_path, map_location='cpu')['state_dict'])
+    model = model.eval().to(device)
+
+    # full validation sets, without profiling
+    dm = datamodule_class(**{**datamodule_hparams, 'show_data_stats': False, 'profile_data': False,
+                             'val_subset_queries': None})
+    dm.setup('validate')
+
+    metrics = {}
+    for val_set_name, val_dataset in zip(dm.val_set_names, dm.val_datasets):
+        feats = np.zeros((len(val_dataset), 0), dtype=np.float32)
+        with torch.no_grad():
+            for imgs, indices in DataLoader(val_dataset, **dm.valid_loader_config):
+                descriptors = model(imgs.to(device)).float().cpu().numpy()
+                if feats.shape[1] == 0:
+                    feats = np.zeros((len(val_dataset), descriptors.shape[1]), dtype=np.float32)
+                feats[indices.numpy()] = descriptors
+
+        num_references, positives = get_references_and_positives(val_set_name, val_dataset)
+        recalls = get_validation_recalls(r_list=feats[:num_references],
+                                         q_list=feats[num_references:],
+                                         k_values=k_values,
+                                         gt=positives,
+                                         print_results=False,
+                                         faiss_gpu=faiss_gpu,
+                                         dataset_name=val_set_name)
+        for k in k_values:
+            metrics[f'{val_set_name}/R{k}'] = float(recalls[k])
+    return metrics
+
+
+class AsyncValidation(pl.Callback):
+    """Runs the validation in a separate process, so that training doesn't stall during it.
+
+    At each training epoch end, the weights are saved to a checkpoint and handed to the
+    evaluation process, which computes recall@K with get_validation_recalls. When the results
+    come back they are sent to the trainer's logger, appended to `metrics.jsonl` in dirpath,
+    and the checkpoints that are not in the top-k w.r.t. the monitored metric are deleted.
+    The pending evaluations are awaited at the end of training.
+
+    Use it instead of the in-loop validation (ex. Trainer(limit_val_batches=0)) and of ModelCheckpoint.
+
+    Args:
+        dirpath (str): folder where the checkpoints and the metrics are written.
+        monitor (str, optional): the metric used to rank the checkpoints. Defaults to 'pitts30k_val/R1'.
+        save_top_k (int, optional): number of checkpoints kept. Defaults to 3.
+        mode (str, optional): 'max' or 'min'. Defaults to 'max'.
+        k_values (list, optional): the values of K. Defaults to [1, 5, 10, 15, 20, 50, 100].
+        device (str, optional): device of the evaluation process. Defaults to 'cpu'.
+        num_threads (int, optional): torch threads of the evaluation process, to leave cores to the training. Defaults to None.
+        faiss_gpu (bool, optional): Defaults to False.
+    """
+    def __init__(self,
+                 dirpath,
+                 monitor='pitts30k_val/R1',
+                 save_top_k=3,
+                 mode='max',
+                 k_values=[1, 5, 10, 15, 20, 50, 100],
+                 device='cpu',
+                 num_threads=None,
+                 faiss_gpu=False,
+                 ):
+        super().__init__()
+        assert mode in ('max', 'min'), f'Unsupported mode {mode}'
+        self.dirpath = dirpath
+        self.monitor = monitor
+        self.save_top_k = save_top_k
+        self.mode = mode
+        self.k_values = k_values
+        self.device = device
+        self.num_threads = num_threads
+        self.faiss_gpu = faiss_gpu
+
+        self.executor = None
+        self.pending = [] # (future, ckpt_path, epoch, step)
+        self.best_checkpoints = [] # (score, ckpt_path), the current top-k
+
+    def on_fit_start(self, trainer, pl_module):
+        if trainer.is_global_zero:
+            os.makedirs(self.dirpath, exist_ok=True)
+            # spawn, the evaluation process must not inherit the state of the training (CUDA, dataloaders)
+            self.executor = ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn'))
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        if not trainer.is_global_zero:
+            return
+        self.collect(trainer)
+
+        epoch, step = trainer.current_epoch, trainer.global_step
+        ckpt_path = os.path.join(self.dirpath, f'{pl_module.encoder_arch}_epoch({epoch:02d})_step({step:04d}).ckpt')
+        # weights-only checkpoint, it can also be loaded with VPRModel.load_from_checkpoint
+        torch.save({'epoch': epoch,
+                    'global_step': step,
+                    'pytorch-lightning_version': pl.__version__,
+                    'state_dict': pl_module.state_dict(),
+                    'hyper_parameters': dict(pl_module.hparams)}, ckpt_path)
+
+        future = self.executor.submit(evaluate_checkpoint, ckpt_path,
+                                      type(pl_module), dict(pl_module.hparams),
+                                      type(trainer.datamodule), dict(trainer.datamodule.hparams),
+                                      self.k_values, self.faiss_gpu, self.device, self.num_threads)
+        self.pending.append((future, ckpt_path, epoch, step))
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        # report the results as soon as they are ready, without waiting for the epoch end
+        if trainer.is_global_zero and any(future.done() for future, *_ in self.pending):
+            self.collect(trainer)
+
+    def on_fit_end(self, trainer, pl_module):
+        if trainer.is_global_zero:
+            self.collect(trainer, wait=True)
+            self.executor.shutdown()
+            self.executor = None
+
+    def collect(self, trainer, wait=False):
+        """Reports the finished evaluations (all of them if wait is True)"""
+        still_pending = []
+        for future, ckpt_path, epoch, step in self.pending:
+            if not (wait or future.done()):
+                still_pending.append((future, ckpt_path, epoch, step))
+                continue
+            try:
+                metrics = future.result()
+            except Exception as e:
+                print(f'Asynchronous validation of {ckpt_path} failed: {e!r}')
+                continue
+
+            if trainer.logger is not None:
+                trainer.logger.log_metrics(metrics, step=step)
+            with open(os.path.join(self.dirpath, 'metrics.jsonl'), 'a') as f:
+                f.write(json.dumps({'epoch': epoch, 'step': step, 'ckpt_path': ckpt_path, **metrics}) + '\n')
+            print(f'Epoch {epoch} (asynchronous validation): ' +
+                  ', '.join(f'{k}={v:.4f}' for k, v in metrics.items() if k.endswith(('/R1', '/R5'))))
+            self.update_top_k(metrics[self.monitor], ckpt_path)
+        self.pending = still_pending
+
+    def update_top_k(self, score, ckpt_path):
+        self.best_checkpoints.append((score, ckpt_path))
+        self.best_checkpoints.sort(key=lambda x: x[0], reverse=self.mode == 'max')
+        for _, path in self.best_checkpoints[self.save_top_k:]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.best_checkpoints = self.best_checkpoints[:self.save_top_k]
+
+    @property
+    def best_model_path(self):
+        return self.best_checkpoints[0][1] if self.best_checkpoints else None
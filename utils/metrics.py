@@ -0,0 +1,40 @@
+import torch
+
+
+def mined_batch_accuracy(miner_outputs, nb_samples):
+    """Returns the % of trivial samples of the batch, i.e. the samples that are not
+    an anchor of any mined pair/triplet (they don't contribute to the loss value).
+    It is computed with on-device ops only, so it doesn't force a device-to-host sync.
+
+    Args:
+        miner_outputs (tuple): the indices returned by the miner, the first element being the anchors.
+        nb_samples (int): number of samples in the batch.
+
+    Returns:
+        torch.Tensor: a scalar tensor on the same device as the miner outputs.
+    """
+    anchors = miner_outputs[0]
+    is_mined = torch.zeros(nb_samples, dtype=torch.bool, device=anchors.device)
+    is_mined[anchors] = True
+    return 1.0 - is_mined.float().mean()
+
+
+class RunningMean:
+    """Running mean of a (tensor) value over an epoch. The sum is kept on
+    the value's device, so updating it never syncs with the host.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.total = 0.
+        self.count = 0
+
+    def update(self, value):
+        if torch.is_tensor(value):
+            value = value.detach()
+        self.total = self.total + value
+        self.count += 1
+
+    def compute(self):
+        return self.total / max(self.count, 1)
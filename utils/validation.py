@@ -5,43 +5,150 @@ from prettytable import PrettyTable
 
 
 def get_validation_recalls(r_list, q_list, k_values, gt, print_results=True, faiss_gpu=False, dataset_name='dataset without name ?'):
-        
+
         embed_size = r_list.shape[1]
-        if faiss_gpu:
-            res = faiss.StandardGpuResources()
-            flat_config = faiss.GpuIndexFlatConfig()
-            flat_config.useFloat16 = True
-            flat_config.device = 0
-            faiss_index = faiss.GpuIndexFlatL2(res, embed_size, flat_config)
-        # build index
-        else:
-            faiss_index = faiss.IndexFlatL2(embed_size)
-        
+        faiss_index = get_faiss_index(embed_size, faiss_gpu)
+
         # add references
         faiss_index.add(r_list)
 
         # search for queries in the index
         _, predictions = faiss_index.search(q_list, max(k_values))
-        
-        
-        
+
+
+
         # start calculating recall_at_k
-        correct_at_k = np.zeros(len(k_values))
-        for q_idx, pred in enumerate(predictions):
-            for i, n in enumerate(k_values):
-                # if in top N then also in top NN, where NN > N
-                if np.any(np.in1d(pred[:n], gt[q_idx])):
-                    correct_at_k[i:] += 1
-                    break
-        
+        correct_at_k = count_correct_at_k(predictions, range(len(predictions)), gt, k_values)
+
         correct_at_k = correct_at_k / len(predictions)
         d = {k:v for (k,v) in zip(k_values, correct_at_k)}
 
         if print_results:
-            print() # print a new line
-            table = PrettyTable()
-            table.field_names = ['K']+[str(k) for k in k_values]
-            table.add_row(['Recall@K']+ [f'{100*v:.2f}' for v in correct_at_k])
-            print(table.get_string(title=f"Performances on {dataset_name}"))
-        
+            print_recalls(correct_at_k, k_values, dataset_name)
+
         return d
+
+
+def get_faiss_index(embed_size, faiss_gpu=False):
+    if faiss_gpu:
+        res = faiss.StandardGpuResources()
+        flat_config = faiss.GpuIndexFlatConfig()
+        flat_config.useFloat16 = True
+        flat_config.device = 0
+        return faiss.GpuIndexFlatL2(res, embed_size, flat_config)
+    return faiss.IndexFlatL2(embed_size)
+
+
+def count_correct_at_k(predictions, q_indices, gt, k_values):
+    """Returns, for each k in k_values, the number of queries with at least
+    one groundtruth positive in their top-k predictions.
+    """
+    correct_at_k = np.zeros(len(k_values))
+    for q_idx, pred in zip(q_indices, predictions):
+        for i, n in enumerate(k_values):
+            # if in top N then also in top NN, where NN > N
+            if np.any(np.in1d(pred[:n], gt[q_idx])):
+                correct_at_k[i:] += 1
+                break
+    return correct_at_k
+
+
+def print_recalls(recalls, k_values, dataset_name):
+    print() # print a new line
+    table = PrettyTable()
+    table.field_names = ['K']+[str(k) for k in k_values]
+    table.add_row(['Recall@K']+ [f'{100*v:.2f}' for v in recalls])
+    print(table.get_string(title=f"Performances on {dataset_name}"))
+
+
+def get_references_and_positives(val_set_name, val_dataset):
+    """Returns the number of references and the groundtruth positives of each query
+    for the validation sets of this project (MSLS val, Pittburg val), where the dataset
+    always yields the references then the queries [R1, R2, ..., Rn, Q1, Q2, ...]
+    """
+    if getattr(val_dataset, 'is_subset', False):
+        # ValidationSubset, the groundtruth is already remapped to the subset
+        return val_dataset.num_references, val_dataset.positives
+    if 'pitts' in val_set_name:
+        return val_dataset.dbStruct.numDb, val_dataset.getPositives()
+    elif 'msls' in val_set_name:
+        return val_dataset.num_references, val_dataset.pIdx
+    raise NotImplementedError(f'Please implement get_references_and_positives for {val_set_name}')
+
+
+def recall_stderr(recall, num_queries, total_queries):
+    """Standard error of a recall measured on num_queries queries sampled from total_queries
+    (binomial, with finite population correction). It is 0 when all the queries are used.
+    """
+    if num_queries >= total_queries:
+        return 0.0
+    fpc = (total_queries - num_queries) / (total_queries - 1)
+    return float(np.sqrt(recall * (1 - recall) / num_queries * fpc))
+
+
+class StreamingRecall:
+    """Recall@K computed while the validation set is being processed.
+    Reference descriptors are added to the faiss index as their batches arrive, queries are
+    searched batch by batch and only the running counts are kept. The memory therefore
+    doesn't depend on the number of queries.
+
+    The references have to arrive before the queries ([R1, R2, ..., Rn, Q1, Q2, ...]),
+    references that are added twice (ex. the padding of a DistributedSampler) are skipped.
+
+    Args:
+        num_references (int): number of references, the dataset indices below it are references.
+        num_queries (int): number of queries.
+        gt (array): groundtruth positives (reference indices) of each query.
+        k_values (list): the values of K.
+        faiss_gpu (bool, optional): Defaults to False.
+    """
+    def __init__(self, num_references, num_queries, gt, k_values, faiss_gpu=False):
+        self.num_references = num_references
+        self.gt = gt
+        self.k_values = k_values
+        self.faiss_gpu = faiss_gpu
+        self.faiss_index = None
+        self.is_added = np.zeros(num_references, dtype=bool)
+        self.is_searched = np.zeros(num_queries, dtype=bool)
+        self.correct_at_k = np.zeros(len(k_values))
+        self.num_queries = 0
+
+    def add_references(self, feats, indices):
+        """Adds reference descriptors (float32 array) with their dataset indices"""
+        indices, first = np.unique(indices, return_index=True)
+        keep = ~self.is_added[indices]
+        feats, indices = feats[first[keep]], indices[keep]
+        if len(indices) == 0:
+            return
+        if self.faiss_index is None:
+            # the index maps back to dataset indices, the references may arrive out of order
+            self.faiss_index = faiss.IndexIDMap(get_faiss_index(feats.shape[1], self.faiss_gpu))
+        self.faiss_index.add_with_ids(np.ascontiguousarray(feats, dtype=np.float32), indices.astype(np.int64))
+        self.is_added[indices] = True
+
+    def search_queries(self, feats, indices):
+        """Searches query descriptors (float32 array) and updates the recall counts"""
+        q_indices = indices - self.num_references
+        q_indices, first = np.unique(q_indices, return_index=True)
+        keep = ~self.is_searched[q_indices]
+        feats, q_indices = feats[first[keep]], q_indices[keep]
+        if len(q_indices) == 0:
+            return
+        _, predictions = self.faiss_index.search(np.ascontiguousarray(feats, dtype=np.float32), max(self.k_values))
+        self.correct_at_k += count_correct_at_k(predictions, q_indices, self.gt, self.k_values)
+        self.num_queries += len(q_indices)
+        self.is_searched[q_indices] = True
+
+    def update(self, feats, indices):
+        """Adds the references and searches the queries of a batch"""
+        is_ref = indices < self.num_references
+        if is_ref.any():
+            self.add_references(feats[is_ref], indices[is_ref])
+        if (~is_ref).any():
+            self.search_queries(feats[~is_ref], indices[~is_ref])
+
+    def compute(self, print_results=True, dataset_name='dataset without name ?'):
+        recalls = self.correct_at_k / max(self.num_queries, 1)
+        if print_results:
+            print_recalls(recalls, self.k_values, dataset_name)
+        return {k:v for (k,v) in zip(self.k_values, recalls)}
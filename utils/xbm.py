@@ -0,0 +1,100 @@
+import torch
+from pytorch_metric_learning.utils import loss_and_miner_utils as lmu
+
+
+class CrossBatchMemory:
+    """Cross-batch memory (XBM) as in https://arxiv.org/abs/1912.06798
+    A fixed-size ring buffer of the most recent descriptors and their labels.
+    The descriptors are detached and stored in float16, so that the miner and the loss
+    can draw negatives from many past batches at (almost) constant memory.
+
+    Args:
+        size (int): number of descriptors kept in the memory.
+        dtype (torch.dtype, optional): storage type of the descriptors. Defaults to torch.float16.
+    """
+    def __init__(self, size, dtype=torch.float16):
+        self.size = size
+        self.dtype = dtype
+        self.feats = None # allocated at the first enqueue, when we know the descriptor size and device
+        self.labels = None
+        self.ptr = 0
+        self.is_full = False
+
+    def enqueue(self, feats, labels):
+        """Adds a batch to the memory (the oldest descriptors are overwritten)
+
+        Returns:
+            torch.Tensor: the position of each descriptor of the batch in the memory,
+                          -1 for the ones that did not fit (batch larger than the memory).
+        """
+        positions = torch.full((feats.shape[0],), -1, dtype=torch.long, device=feats.device)
+        feats, labels = feats.detach()[-self.size:], labels.detach()[-self.size:]
+        if self.feats is None:
+            self.feats = torch.zeros(self.size, feats.shape[1], dtype=self.dtype, device=feats.device)
+            self.labels = torch.zeros(self.size, dtype=labels.dtype, device=labels.device)
+        elif self.feats.device != feats.device:
+            self.feats = self.feats.to(feats.device)
+            self.labels = self.labels.to(labels.device)
+
+        n = feats.shape[0]
+        idx = (self.ptr + torch.arange(n, device=feats.device)) % self.size
+        self.feats[idx] = feats.to(self.dtype)
+        self.labels[idx] = labels
+        self.is_full = self.is_full or self.ptr + n >= self.size
+        self.ptr = (self.ptr + n) % self.size
+        positions[-n:] = idx
+        return positions
+
+    def get(self, dtype=torch.float32):
+        """Returns the stored descriptors (casted to dtype) and their labels"""
+        n = len(self)
+        return self.feats[:n].to(dtype), self.labels[:n]
+
+    def __len__(self):
+        return self.size if self.is_full else self.ptr
+
+
+def remove_batch_pairs(indices_tuple, positions, num_references):
+    """Removes the pairs/triplets whose reference (positive or negative) is a descriptor of the current batch,
+    only the pairs with the past batches are left (the in-batch pairs are already in the loss of the batch)
+
+    Args:
+        indices_tuple (tuple): (anchors, positives, anchors, negatives) or (anchors, positives, negatives).
+        positions (torch.Tensor): position of each descriptor of the batch in the memory (see CrossBatchMemory.enqueue).
+        num_references (int): number of descriptors in the memory.
+    """
+    in_batch = torch.zeros(num_references, dtype=torch.bool, device=positions.device)
+    in_batch[positions[positions >= 0]] = True
+    if len(indices_tuple) == 4:
+        a1, p, a2, n = indices_tuple
+        keep_pos, keep_neg = ~in_batch[p], ~in_batch[n]
+        return a1[keep_pos], p[keep_pos], a2[keep_neg], n[keep_neg]
+    a, p, n = indices_tuple
+    keep = ~in_batch[p] & ~in_batch[n]
+    return a[keep], p[keep], n[keep]
+
+
+def xbm_loss(memory, descriptors, labels, positions, loss_fn, miner=None):
+    """Loss between a batch and the past batches held in the memory.
+    The batch must already be in the memory: the miner sees the memory plus the current batch,
+    so that its hardness thresholds come from the in-batch positives (GSVCities yields each place
+    once per epoch, the memory alone has no positive for the batch). Then the pairs with the
+    current batch are dropped, they are already counted by the loss of the batch itself,
+    so xbm_weight only scales the cross-batch pairs.
+
+    Args:
+        memory (CrossBatchMemory): the memory, holding the current batch.
+        descriptors (torch.Tensor): the descriptors of the batch (with their gradient).
+        labels (torch.Tensor): the labels of the batch.
+        positions (torch.Tensor): the positions of the batch in the memory, returned by memory.enqueue.
+        loss_fn: a pytorch_metric_learning loss.
+        miner (optional): a pytorch_metric_learning miner. Defaults to None (all the pairs).
+    """
+    ref_emb, ref_labels = memory.get(descriptors.dtype)
+    if miner is not None:
+        indices_tuple = miner(descriptors, labels, ref_emb, ref_labels)
+    else:
+        indices_tuple = lmu.get_all_pairs_indices(labels, ref_labels)
+    indices_tuple = remove_batch_pairs(indices_tuple, positions, len(ref_labels))
+    loss = loss_fn(descriptors, labels, indices_tuple, ref_emb, ref_labels)
+    return loss[0] if type(loss) == tuple else loss